@@ -0,0 +1,61 @@
+"""
+Compare speed and results of vertical interpolation backends on a synthetic
+s-coordinate field, with the size of a SYMPHONIE output.
+"""
+import time
+
+import numpy as np
+import xarray as xr
+
+from utilities.interpolation import interp_variable, interplevel, numba
+
+#%%
+if __name__ == '__main__':
+
+    PARAMS = dict(
+        n_time=10,
+        n_levels=40,
+        n_lat=200,
+        n_lon=250,
+        depth=np.linspace(0, 500, 100),
+        n_repeat=3,
+    )
+
+    # %% Synthetic data : sigma levels over a varying bathymetry, index 0 = bottom
+    rng = np.random.default_rng(0)
+    bathy = rng.uniform(50, 4000, (PARAMS["n_lat"], PARAMS["n_lon"]))
+    sigma = -np.linspace(1, 0, PARAMS["n_levels"]) ** 1.5
+    depth3d = xr.DataArray(
+        sigma[:, None, None] * bathy,
+        dims=("nk", "lat_t", "lon_t"),
+    )
+    tem = xr.DataArray(
+        30 * np.exp(depth3d.values / 800)[None]
+        + rng.normal(0, 0.1, (PARAMS["n_time"], *depth3d.shape)),
+        dims=("time", "nk", "lat_t", "lon_t"),
+    )
+
+    # %% Benchmark
+    cases = [("numpy", "linear"), ("numpy", "conservative")]
+    if numba is not None:
+        cases += [("numba", "linear"), ("numba", "conservative")]
+    if interplevel is not None:
+        cases += [("wrf", "linear")]
+
+    reference = None
+    for backend, method in cases:
+        timings = []
+        for _ in range(PARAMS["n_repeat"]):
+            t0 = time.time()
+            out = interp_variable(
+                tem, depth3d, PARAMS["depth"], method=method, backend=backend
+            ).transpose("time", "depth_t", "lat_t", "lon_t").values
+            timings.append(time.time() - t0)
+        print(f"{backend:>6} | {method:<12} : {min(timings):.3f}s (best of {PARAMS['n_repeat']})")
+
+        # Check that linear backends agree
+        if method == "linear":
+            if reference is None:
+                reference = out
+            else:
+                print(f"         max |{backend} - numpy| : {np.nanmax(np.abs(out - reference)):.2e}")
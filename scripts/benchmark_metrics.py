@@ -0,0 +1,60 @@
+"""
+Compare speed and results of compute_metrics (shared intermediates) against
+each function of my_metrics, on random fields with missing values, zeros in
+the reference and a fully masked time step.
+"""
+import time
+
+import numpy as np
+import xarray as xr
+
+from utilities.metrics import compute_metrics, my_metrics
+
+#%%
+if __name__ == '__main__':
+
+    PARAMS = dict(
+        n_time=4,
+        n_lat=200,
+        n_lon=300,
+        dim=["lat", "lon"],
+        rtol=1e-6,
+        n_repeat=3,
+    )
+
+    # %% Synthetic data
+    rng = np.random.default_rng(0)
+    shape = (PARAMS["n_time"], PARAMS["n_lat"], PARAMS["n_lon"])
+    d_ref = xr.DataArray(rng.normal(10, 1, shape), dims=("time", "lat", "lon"))
+    d1 = d_ref + rng.normal(0, 0.5, shape)
+    d1 = d1.where(rng.random(shape) > 0.2)
+    d1[0] = np.nan
+    # 0 / 0 relative errors, left out of mare
+    d_ref[1, :10] = 0
+    d1[1, :10] = 0
+    weights = xr.DataArray(np.cos(np.deg2rad(np.linspace(-10, 10, shape[1]))), dims="lat")
+
+    # %% Benchmark and check
+    for case_weights in [None, weights]:
+        label = "uniform" if case_weights is None else "weighted"
+
+        timings = []
+        for _ in range(PARAMS["n_repeat"]):
+            t0 = time.time()
+            fused = compute_metrics(d1, d_ref, weights=case_weights, dim=PARAMS["dim"])
+            timings.append(time.time() - t0)
+        print(f"{label:>8} | compute_metrics : {min(timings):.3f}s (best of {PARAMS['n_repeat']})")
+
+        timings = []
+        for _ in range(PARAMS["n_repeat"]):
+            t0 = time.time()
+            separate = {
+                name: metric(d1, d_ref, weights=case_weights, dim=PARAMS["dim"])
+                for name, metric in my_metrics.items()
+            }
+            timings.append(time.time() - t0)
+        print(f"{label:>8} | my_metrics      : {min(timings):.3f}s (best of {PARAMS['n_repeat']})")
+
+        for name, result in separate.items():
+            xr.testing.assert_allclose(fused.sel(metric=name, drop=True), result, rtol=PARAMS["rtol"])
+    print("compute_metrics matches my_metrics.")
@@ -2,6 +2,7 @@
 import numpy as np
 
 from data.sources import GriddedSource, DataSource
+from data.features import get_argo_features
 
 # # Plotting
 from plotting.display import set_style
@@ -50,13 +51,15 @@ edge_sizes = {
 if __name__ == '__main__':
 
     # Get grid information
-    grid = GriddedSource("grid_VQSF", "")
-    bathy = grid.d.hm_w  # max depth
+    grid = GriddedSource("grid_VQSF")  # static fields are memory-mapped, grid is not loaded
+    bathy = grid.get_bathymetry()  # max depth
 
     # Get information on ARGO profiles
-    argo = DataSource("ARGO_features", "").d
+    argo_index = get_argo_features()
     # Filter data
-    argo = argo[((argo["year"] == 2017) | (argo["year"] == 2018)) & (argo["zone"] != "SORTIENA")]
+    argo = argo_index.query(
+        years=[2017, 2018], zones=[z for z in argo_index.zones() if z != "SORTIENA"]
+    )
 
 #%%
     grid_lon = grid.get_lon()
@@ -14,10 +14,7 @@ from mpl_toolkits.axes_grid1 import ImageGrid
 import cmocean.cm as cmo
 import cmcrameri.cm as cmc
 
-from utilities.interpolation import interp_variable
-
-
-from scipy.interpolate import interpn
+from preprocessings.hovmollers import hovmoller, build_hovmollers
 
 #%%
 PATH = paths.primary_data_path / "SYMPHONIE"
@@ -31,6 +28,7 @@ PARAMS = dict(
         "SEA_312_NT_H1V1_V_Q2",
     ],
     loc="mid_scs",
+    zone=None,  # if set, Hovmöllers are built from raw outputs over this zone (see preprocessings.hovmollers)
     var="sal",
     transparent=True,
     dpi=300
@@ -38,30 +36,22 @@ PARAMS = dict(
 
 SIMS = PARAMS["sims"]
 
-#%% Get data
-
-data = {
-    sim: xr.open_dataset(PATH / f"{sim}_tem_sal_profiles_{PARAMS['loc']}.nc") for sim in SIMS
-}
-
-#%% Compute mean profile
+#%% Get data, compute mean profiles
 time_slice = slice("2017-01-03", "2018-12-30")
-#%%
-
 depth = np.linspace(0, 500, 100)
-data_interp = {
-    sim: interp_variable(data[sim][PARAMS["var"]], data[sim].depth_t, depth, h_sign=1)
-    for sim in data
-}
-data_interp["GLORYS"] = data_interp["GLORYS"].interp(depth_t=depth)
-print("Interpolated !")
-
 
-#%%
-data_mean = {
-    sim: data_interp[sim].sel(time=time_slice).mean(dim=["lon_t", "lat_t"])
-    for sim in data
-}
+if PARAMS["zone"] is None:
+    data = {
+        sim: xr.open_dataset(PATH / f"{sim}_tem_sal_profiles_{PARAMS['loc']}.nc") for sim in SIMS
+    }
+    # horizontal mean first where levels are flat (GLORYS), interpolation first otherwise
+    data_mean = {
+        sim: hovmoller(data[sim].sel(time=time_slice), PARAMS["var"], depth)
+        for sim in data
+    }
+else:
+    data_mean = build_hovmollers(PARAMS["zone"], SIMS, PARAMS["var"], depths=depth, time_slice=time_slice)
+print("Interpolated !")
 
 #%%
 
@@ -92,8 +82,6 @@ N_SIMS = len(SIMS)
 FIG_LEN = 8
 FIG_WID_PER_PLOT = 1
 
-LON_MEAN = data[SIMS[0]].lon_t.mean().values
-LAT_MEAN = data[SIMS[0]].lat_t.mean().values
 
 #%%
 
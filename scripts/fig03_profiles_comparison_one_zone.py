@@ -9,7 +9,7 @@ from utilities.paths import paths
 from utilities.names import zone_names, get_simple_names
 import utilities.units as units
 
-from preprocessings.load_profiles import load_sims
+from preprocessings.load_profiles import load_sims, profiles_mean_std
 
 from plotting.display import set_style
 from plotting.misc import get_color_from_simulation_name
@@ -44,8 +44,7 @@ argo = load_sims(PARAMS["SIMS"])
 
 #%%
 
-argo_mean = argo.mean(["cycle"])
-argo_std = argo.std(["cycle"])
+argo_mean, argo_std = profiles_mean_std(argo)
 
 # %% Plotting
 
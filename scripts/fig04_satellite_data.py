@@ -1,10 +1,35 @@
-#%%
-if __name__ == '__main__':
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from data.sources import GriddedSource, DataSource, submit_sources
+from data.selection import Selection
+from data.chunks import dataset_chunk_bytes
+
+from utilities.paths import paths
+from utilities.dask import init_dask_cluster, close_dask_cluster
+from utilities.regridding import Regridder
+from utilities.zones import get_mask_zone, get_zone_path
+
+from plotting.display import set_style
+
+import matplotlib.pyplot as plt
+from mpl_toolkits.axes_grid1 import ImageGrid
+from matplotlib.ticker import MultipleLocator
+
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+from cartopy.mpl.geoaxes import GeoAxes
+
+from cmocean import cm as cmo
+from cmcrameri import cm as cmc
+
+import matplotlib.patches as mpatches
+import matplotlib.patheffects as path_effects
 
-    cluster, client = init_dask_cluster("local")  #, walltime="00:15:00")
-    client
 
-# %%
+#%%
+if __name__ == '__main__':
 
     PARAMS = dict(
         var="tem",
@@ -16,19 +41,38 @@ if __name__ == '__main__':
 #%%
     # Satellite data
     sat_data = dict(
-        ostia=GriddedSource(PARAMS["sat_dataset"], ""),
+        ostia=GriddedSource(PARAMS["sat_dataset"]),
     )
 
 #%%
 
     # SYMPHONIE data
     sym_data = {
-        "T0": GriddedSource("SEA_312_T_H0V0_V_Q2_surface_monthly", ""),
-        "NT0": GriddedSource("SEA_312_NT_H0V0_V_Q2_surface_monthly", ""),
-        "T1": GriddedSource("SEA_312_T_H1V1_V+_Q2_surface_monthly", ""),
-        "NT1": GriddedSource("SEA_312_NT_H1V1_V_Q2_surface_monthly", ""),
+        "T0": GriddedSource("SEA_312_T_H0V0_V_Q2_surface_monthly"),
+        "NT0": GriddedSource("SEA_312_NT_H0V0_V_Q2_surface_monthly"),
+        "T1": GriddedSource("SEA_312_T_H1V1_V+_Q2_surface_monthly"),
+        "NT1": GriddedSource("SEA_312_NT_H1V1_V_Q2_surface_monthly"),
     }
 
+    # Load all sources together, opening only needed variable (and time range for models)
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = {
+            **submit_sources(
+                sat_data.values(), executor=executor,
+                selection=Selection(variables=PARAMS["var"]),
+            ),
+            **submit_sources(
+                sym_data.values(), executor=executor,
+                selection=Selection(time=PARAMS["time_slice"], variables=PARAMS["var"]),
+            ),
+        }
+        for future in futures.values():
+            future.result()  # raise loading errors, if any
+
+    # Workers sized from chunks of loaded (lazy) data
+    chunk_bytes = dataset_chunk_bytes(*[sr.d for sr in [*sat_data.values(), *sym_data.values()]])
+    cluster, client = init_dask_cluster("local", adaptive=True, chunk_bytes=chunk_bytes)  #, walltime="00:15:00")
+
 #%%
 
     N_REF = 0
@@ -38,12 +82,14 @@ if __name__ == '__main__':
 #%%
     # Satellite data
     mean_sat = sat_data[PARAMS["sat_ref"]].d[PARAMS["var"]]
-    mean_sat = mean_sat.interp(lon=REF_LON, lat=REF_LAT).mean("time")
+    # weights OSTIA -> SEA312 are computed once, then read from cache
+    to_ref_grid = Regridder(mean_sat.lon, mean_sat.lat, REF_LON, REF_LAT, method="bilinear")
+    mean_sat = to_ref_grid(mean_sat).mean("time")
 
 #%%
     # Model data
     mean_sym = {
-        sim: sym_data[sim].d[PARAMS['var']].sel(time=PARAMS['time_slice']).mean(dim='time').squeeze().compute()
+        sim: sym_data[sim].d[PARAMS['var']].mean(dim='time').squeeze().compute()
         for sim in sym_data
     }
 #%%
@@ -52,54 +98,6 @@ if __name__ == '__main__':
         sim: mean_sym[sim] - mean_sat
         for sim in mean_sym
     }
-#%%
-import numpy as np
-
-from data.sources import GriddedSource, DataSource
-
-from utilities.paths import paths
-from utilities.dask import init_dask_cluster
-
-from plotting.display import set_style
-
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import ImageGrid
-from matplotlib.ticker import MultipleLocator
-
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-from cartopy.mpl.geoaxes import GeoAxes
-
-from cmocean import cm as cmo
-from cmcrameri import cm as cmc
-
-from matplotlib import path as mpath
-import matplotlib.patches as mpatches
-import matplotlib.patheffects as path_effects
-import pandas as pd
-
-
-def get_mask_zone(zone,lons, lats, grid_name=""):
-    pth_to_npy = paths.raw_data_path / "ZONES" / f"{zone}_{grid_name}.npy"
-
-    if pth_to_npy.is_file():
-        with open(pth_to_npy, "rb") as f:
-            mask = np.load(f)
-    else:
-        coord = pd.read_csv(paths.raw_data_path / "ZONES" / f"{zone}.csv")
-        zone = mpath.Path(coord[["longitude", "latitude"]].values)
-
-        mask = np.zeros((lons.size, lats.size))
-        for i, ln in enumerate(lons):
-            print(f"{i} / {lons.size}", end="\r")
-            for j, lt in enumerate(lats):
-                mask[i, j] = zone.contains_point((ln, lt))
-
-        # Save data
-        with open(pth_to_npy, "rb") as f:
-            np.save(f, mask)
-
-    return mask
 
 #%%
     # Mean diff
@@ -108,15 +106,15 @@ def get_mask_zone(zone,lons, lats, grid_name=""):
 #%%
     MASK_ZONE_NAME = "SEA"
     MASK_ZONE_GRID = "SEA312"
-    MASK_ZONE = get_mask_zone(MASK_ZONE_NAME, REF_LON, REF_LAT, MASK_ZONE_GRID).astype(bool)
+    MASK_ZONE = get_mask_zone(MASK_ZONE_NAME, REF_LON, REF_LAT, MASK_ZONE_GRID)
 
     # Get Path
-    _coord = pd.read_csv(paths.raw_data_path / "ZONES" / f"{MASK_ZONE_NAME}.csv")
-    ZONE_PATH = mpath.Path(_coord[["longitude", "latitude"]].values)
+    ZONE_PATH = get_zone_path(MASK_ZONE_NAME)
 
-    grid = GriddedSource("grid_VQSF", "")
+    grid = GriddedSource("grid_VQSF")  # static fields are memory-mapped, grid is not loaded
     grid_lon = grid.get_lon()
     grid_lat = grid.get_lat()
+    bathy = grid.get_bathymetry()
 
 #%%
 
@@ -210,8 +208,8 @@ def get_mask_zone(zone,lons, lats, grid_name=""):
         )
 
         ctr = ax.contour(
-            grid_lon, grid_lat, grid.d.hm_w, [100, 500, 1000], colors="grey", transform=ccrs.PlateCarree(), linewidths=0.2
-            # grid_lon, grid_lat, grid.d.hm_w, [200, 400, 600, 800, 1000], colors="grey", transform=ccrs.PlateCarree(), linewidths=0.2
+            grid_lon, grid_lat, bathy, [100, 500, 1000], colors="grey", transform=ccrs.PlateCarree(), linewidths=0.2
+            # grid_lon, grid_lat, bathy, [200, 400, 600, 800, 1000], colors="grey", transform=ccrs.PlateCarree(), linewidths=0.2
         )
 
         gl = ax.gridlines(
@@ -246,5 +244,6 @@ def get_mask_zone(zone,lons, lats, grid_name=""):
     )
     print("saved")
 #%%
+    close_dask_cluster(cluster, client)
 
 #%%
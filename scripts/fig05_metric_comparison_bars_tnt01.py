@@ -8,9 +8,9 @@ from data.sources import DataSource
 from utilities.paths import paths
 from utilities.names import sim_names, zone_names, get_simple_names, zone_names_with_break
 from utilities.argo import get_weights_from_std
-from utilities.metrics import my_metrics
+from utilities.metrics import evaluate_against_reference
 import utilities.units as units
-from preprocessings.load_profiles import load_sims
+from preprocessings.load_profiles import load_sims, profiles_mean_std
 
 from plotting.display import set_style
 
@@ -66,8 +66,7 @@ if __name__ == "__main__":
 
 #%%
 
-    argo_mean = argo.mean(["cycle"])
-    argo_std = argo.std(["cycle"])
+    argo_mean, argo_std = profiles_mean_std(argo)
 # %% Reduce data
 
     # argo = argo[PARAMS['VAR']]
@@ -85,26 +84,19 @@ if __name__ == "__main__":
         raise ValueError(f"Weights option <{PARAMS ['WEIGHTS']}> unknown.")
 
 # %% Compute values
-    data_to_plot = []
-
-    for zone in PARAMS["ZONES"]:
-
-        metrics = []
-        for sim in PARAMS["SIMS"][1:]:
-
-            # Compute metric
-            d1 = argo_mean.sel(zone=zone, sim=sim)
-            d2 = argo_mean.sel(zone=zone, sim=PARAMS["REF_SIM"])
-            w = weights.sel(zone=zone)
-
-            metric = my_metrics[PARAMS['METRIC']](d1, d2, w, dim="depth").values
-            # Save metric
-            metrics.append(metric)
-
-        # Save metrics
-        data_to_plot.append(metrics)
+    metrics = evaluate_against_reference(
+        argo_mean.sel(zone=PARAMS["ZONES"]),
+        PARAMS["REF_SIM"],
+        metrics=[PARAMS["METRIC"]],
+        weights=weights.sel(zone=PARAMS["ZONES"]),
+        dim="depth",
+        as_table=False,
+    )
 
-    data_to_plot = np.array(data_to_plot)
+    # (zone, sim) array
+    data_to_plot = metrics.sel(
+        metric=PARAMS["METRIC"], sim=PARAMS["SIMS"][1:]
+    ).transpose("zone", "sim").values
 
 
 # %% Plot
@@ -1,6 +1,7 @@
 import numpy as np
 
 from data.sources import GriddedSource, DataSource
+from data.features import get_argo_features
 
 from plotting.display import set_style
 
@@ -42,18 +43,25 @@ if __name__ == '__main__':
     }
 
     # Get grid information
-    grid = GriddedSource("grid_VQSF", "")
-    bathy = grid.d.hm_w  # max depth
+    grid = GriddedSource("grid_VQSF")  # static fields are memory-mapped, grid is not loaded
+    bathy = grid.get_bathymetry()  # max depth
 
     # Get information on ARGO profiles
-    argo = DataSource("ARGO_features", "").d
+    argo_index = get_argo_features()
     # Filter data
-    argo = argo[
-        (
-                # (argo["year"] == 2017) |
-                (argo["year"] == 2018)
-        ) & (argo["zone"] != "SORTIENA")
-    ]
+    argo_query = dict(
+        years=[
+            # 2017,
+            2018,
+        ],
+        zones=[z for z in argo_index.zones() if z != "SORTIENA"],
+    )
+    argo = argo_index.query(**argo_query)
+    # Number of profiles and mean position of each zone
+    argo_zones = argo_index.zone_aggregates(**argo_query)
+    # zones without profiles in selected years : no profile, no mean position
+    argo_zones = argo_zones.reindex(zones)
+    argo_zones["n_profiles"] = argo_zones["n_profiles"].fillna(0).astype(int)
     #%%
     grid_lon = grid.get_lon()
     grid_lat = grid.get_lat()
@@ -103,11 +111,9 @@ if __name__ == '__main__':
     col_pal = sns.color_palette("hls", len(zones))
     for i, z in enumerate(zones):
         print(z)
-        df = argo[argo["zone"] == z]
-
-        mean_lon = df["lon"].mean()
-        mean_lat = df["lat"].mean()
-        n_prf = len(df)
+        mean_lon = argo_zones.loc[z, "lon"]
+        mean_lat = argo_zones.loc[z, "lat"]
+        n_prf = argo_zones.loc[z, "n_profiles"]
 
         ax.scatter(
             mean_lon,
@@ -150,7 +156,7 @@ if __name__ == '__main__':
     col_pal = sns.color_palette("hls", len(zones))
     for i, z in enumerate(zones):
         print(z)
-        df = argo[argo["zone"] == z]
+        df = argo_index.query(zones=[z], years=argo_query["years"])
         ax.plot(
             df["lon"],
             df["lat"],
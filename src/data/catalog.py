@@ -0,0 +1,164 @@
+from typing import Dict, List
+
+import os
+import yaml
+import pickle
+import hashlib
+from pathlib import Path
+from copy import deepcopy
+
+from utilities.paths import paths
+
+CACHE_LOCATION = paths.cache_path / "catalogs"
+
+
+def _file_signature(file_path: Path) -> tuple:
+    """ Values used to decide whether a file changed since it was last parsed. """
+    stat = file_path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+class SourceCatalog:
+    """
+        Process-wide index of all data sources described by the .yml files
+    of a given location.
+
+    Each file is parsed only once, and parsed contents are kept in a pickle
+    on disk, so that later processes do not need to call yaml.safe_load at all.
+    A file is parsed again only if its modification time (or size) changed.
+    """
+
+    def __init__(self, location: Path, cache_location: Path = CACHE_LOCATION):
+        """
+
+        Parameters
+        ----------
+        location:       Path
+                        Path to directory where .yml information files are stored.
+
+        cache_location: Path
+                        Path to directory where parsed files are pickled.
+
+        """
+        self.location = Path(location)
+
+        # one cache file per catalog location
+        location_hash = hashlib.sha1(str(self.location.resolve()).encode()).hexdigest()[:12]
+        self.cache_file = Path(cache_location) / f"catalog_{location_hash}.pkl"
+
+        self._files = {}  # file name -> (signature, parsed content)
+        self._index = {}  # source name -> file name
+        self._loaded_from_cache = False
+
+    # Loading
+    # -------
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_file, "rb") as f:
+                self._files = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            self._files = {}  # missing or corrupted cache : start from scratch
+        self._loaded_from_cache = True
+
+    def _write_cache(self):
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_file.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_file, "wb") as f:
+                pickle.dump(self._files, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.cache_file)  # atomic : no half-written cache
+        except OSError as e:
+            print(f"Could not write catalog cache at {self.cache_file} : {e}")
+
+    def refresh(self) -> bool:
+        """
+            Parse again only .yml files that were added or modified since last call,
+        and forget removed ones. Return True if anything changed.
+        """
+        if not self._loaded_from_cache:
+            self._read_cache()
+
+        list_of_files = sorted(f for f in self.location.iterdir() if f.suffix == ".yml")
+        current = {f.name: f for f in list_of_files}
+
+        changed = False
+        for name in list(self._files):
+            if name not in current:  # removed file
+                del self._files[name]
+                changed = True
+
+        for name, file_path in current.items():
+            signature = _file_signature(file_path)
+            if name in self._files and self._files[name][0] == signature:
+                continue  # up to date
+
+            with open(file_path, "r") as f:
+                content = yaml.safe_load(f)
+            if content is None:  # empty file
+                content = {}
+            self._files[name] = (signature, content)
+            changed = True
+
+        if changed or not self._index:
+            self._build_index()
+        if changed:
+            self._write_cache()
+
+        return changed
+
+    def _build_index(self):
+        # Files are merged in alphabetical order, as a dict.update would do.
+        self._index = {}
+        for name in sorted(self._files):
+            for source_name in self._files[name][1]:
+                self._index[source_name] = name
+
+    # Access
+    # ------
+
+    def names(self) -> List[str]:
+        self.refresh()
+        return list(self._index)
+
+    def file_of(self, source_name: str) -> Path:
+        """ Return path of the .yml file describing given source. """
+        self.refresh()
+        return self.location / self._index[source_name]
+
+    def get(self, source_name: str) -> dict:
+        """
+            Return information about given source. A copy is returned so that
+        modifying it (e.g. kwargs) does not affect other sources.
+        """
+        self.refresh()
+        if source_name not in self._index:
+            raise KeyError(
+                f"Unknown data source <{source_name}> in {self.location}. "
+                f"Please provide one of the following : ",
+                tuple(self._index.keys()),
+            )
+        return deepcopy(self._files[self._index[source_name]][1][source_name])
+
+    def __getitem__(self, source_name: str) -> dict:
+        return self.get(source_name)
+
+    def __contains__(self, source_name: str) -> bool:
+        self.refresh()
+        return source_name in self._index
+
+    def to_dict(self) -> dict:
+        """ All sources information, merged into one dict. """
+        self.refresh()
+        return {source_name: self.get(source_name) for source_name in self._index}
+
+
+_catalogs: Dict[Path, SourceCatalog] = {}
+
+
+def get_catalog(location: Path) -> SourceCatalog:
+    """ Return the (unique in process) catalog of given location. """
+    location = Path(location)
+    if location not in _catalogs:
+        _catalogs[location] = SourceCatalog(location)
+    return _catalogs[location]
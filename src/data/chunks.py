@@ -0,0 +1,130 @@
+from typing import Dict, Optional
+
+import numpy as np
+import xarray as xr
+
+from utilities.func import check_matching
+
+TARGET_CHUNK_BYTES = 128e6  # dask default "array.chunk-size"
+
+# Kind of dimensions to favour (i.e. keep whole in chunks) first, for each access pattern
+ACCESS_PATTERNS = {
+    "time-series": ["time", "vertical", "horizontal"],
+    "map": ["horizontal", "vertical", "time"],
+    "profile": ["vertical", "time", "horizontal"],
+}
+
+TIME_DIMS = ["time", "time_counter"]
+VERTICAL_PREFIXES = ["depth", "nk", "lev", "z"]
+
+
+def dim_kind(dim: str) -> str:
+    """ Kind of dimension from its name : "time", "vertical" or "horizontal". """
+    if dim in TIME_DIMS:
+        return "time"
+    if any(dim.startswith(prefix) for prefix in VERTICAL_PREFIXES):
+        return "vertical"
+    return "horizontal"
+
+
+def disk_chunks(ds: xr.Dataset) -> Dict[str, int]:
+    """
+        On-disk chunk size along each dimension, read from encoding of variables
+    (NetCDF4 "chunksizes" or Zarr "chunks"). Dimensions of contiguous variables
+    are not returned. Largest variables come first, as they weigh most on I/O.
+    """
+    chunks = {}
+    variables = sorted(ds.data_vars.values(), key=lambda v: v.size, reverse=True)
+    for var in variables:
+        sizes = var.encoding.get("chunksizes") or var.encoding.get("chunks")
+        if sizes is None or var.encoding.get("contiguous", False):
+            continue
+        for dim, size in zip(var.dims, sizes):
+            chunks.setdefault(dim, int(size))
+    return chunks
+
+
+def plan_chunks(
+        sizes: Dict[str, int],
+        itemsize: int,
+        access_pattern: str = "map",
+        on_disk: Optional[Dict[str, int]] = None,
+        target_bytes: float = TARGET_CHUNK_BYTES,
+) -> Dict[str, int]:
+    """
+        Choose dask chunks aligned on disk chunks, close to target_bytes, and
+    as long as possible along dimensions used together by access_pattern.
+
+    Starting from disk chunks, dimensions are grown in the order of the access
+    pattern (e.g. for "time-series" : time, then depth, then lon / lat), each
+    one to the largest multiple of its disk chunk that fits in the remaining
+    budget. A chunk never splits a disk chunk, so each one is read only once.
+
+    Parameters
+    ----------
+    sizes:          dict
+                    Dimension -> length.
+
+    itemsize:       int
+                    Size of one value, in bytes.
+
+    access_pattern: str
+                    "time-series", "map" or "profile".
+
+    on_disk:        dict, optional.
+                    Dimension -> disk chunk size. Missing dimensions are
+                    considered contiguous.
+
+    target_bytes:   float
+                    Target size of one chunk, in bytes.
+
+    Returns
+    -------
+    Dimension -> chunk size.
+    """
+    check_matching(access_pattern, ACCESS_PATTERNS, "access pattern")
+    on_disk = on_disk or {}
+
+    base = {dim: min(on_disk.get(dim, 1), size) for dim, size in sizes.items()}
+    chunks = dict(base)
+
+    order = ACCESS_PATTERNS[access_pattern]
+    dims = sorted(sizes, key=lambda d: order.index(dim_kind(d)))
+    for dim in dims:
+        others = np.prod([chunks[d] for d in sizes if d != dim], dtype=float)
+        budget = target_bytes / (itemsize * others)  # max chunk length along dim
+        n_base = max(int(budget // base[dim]), 1)
+        chunks[dim] = min(n_base * base[dim], sizes[dim])
+
+    return chunks
+
+
+def plan_dataset_chunks(
+        ds: xr.Dataset,
+        access_pattern: str = "map",
+        target_bytes: float = TARGET_CHUNK_BYTES,
+        sizes: Optional[Dict[str, int]] = None,
+) -> Dict[str, int]:
+    """
+        Plan chunks of a (lazily opened) dataset, from its disk chunks and
+    dimensions (see plan_chunks). Sizes can be overridden, e.g. with the full
+    length of the concatenation dimension when ds is only one file of many.
+    """
+    itemsize = max([v.dtype.itemsize for v in ds.data_vars.values()], default=8)
+    sizes = {**dict(ds.sizes), **(sizes or {})}
+    return plan_chunks(
+        sizes, itemsize, access_pattern=access_pattern,
+        on_disk=disk_chunks(ds), target_bytes=target_bytes,
+    )
+
+
+def dataset_chunk_bytes(*datasets: xr.Dataset) -> float:
+    """
+        Size in bytes of the largest dask chunk of given (lazily loaded) datasets,
+    e.g. to size workers (see utilities.dask.resource_aware_workers).
+    """
+    sizes = [
+        np.prod([max(c) for c in var.chunks], dtype=float) * var.dtype.itemsize
+        for ds in datasets for var in ds.data_vars.values() if var.chunks is not None
+    ]
+    return max(sizes, default=TARGET_CHUNK_BYTES)
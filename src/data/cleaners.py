@@ -1,7 +1,7 @@
 from typing import Protocol, TypeVar
 
 from utilities.paths import paths
-from utilities.grids import get_grid
+from utilities.grids import get_grid_coordinates, GridCoordinates
 from utilities.func import check_matching
 
 import xarray as xr
@@ -40,6 +40,43 @@ class Cleaner(Protocol[T]):
 
 
 #%%
+def rewrite_coordinates(
+        dataset: xr.Dataset,
+        values: dict,
+        renaming: dict,
+        to_drop: list,
+) -> xr.Dataset:
+    """
+        Drop, set and rename variables of a dataset as one batch of operations.
+    Only metadata is modified : dask-backed variables stay lazy, and no data
+    is copied.
+
+    Parameters
+    ----------
+    dataset:    xr.Dataset
+                Dataset to modify.
+
+    values:     dict
+                New values of variables / coordinates (variables or arrays).
+
+    renaming:   dict
+                Old name -> new name. Names not in dataset are ignored.
+
+    to_drop:    list
+                Names of variables to remove. Names not in dataset are ignored.
+
+    Returns
+    -------
+    xr.Dataset
+    """
+    dataset = dataset.drop_vars(to_drop, errors="ignore")
+
+    # Values given as Variables carry no coordinates, hence the order in
+    # which they are set does not matter (no conflict with dimensions).
+    dataset = dataset.assign(values)
+
+    present = set(dataset.variables) | set(dataset.dims)
+    return dataset.rename({k: it for k, it in renaming.items() if k in present})
 
 
 class IdentityCleaner:
@@ -75,56 +112,28 @@ class SEA312Cleaner(Cleaner):
     var_types = ["t", "u", "v"]
     depths = ["depth_t", "depth_u", "depth_v", "depth_w"]
 
-    def _get_values_from_grid(self, grid):
+    def _get_values_from_grid(self, grid: GridCoordinates):
         """
-        Extract explicit coordinates values from given SYMPHONY grid.
+        Select explicit coordinates values from given SYMPHONY grid coordinates.
         """
 
-        lon, lat = {}, {}
-        for var_type in self.var_types:
-            masked_lon, masked_lat = (
-                grid.variables[f"longitude_{var_type}"][:],
-                grid.variables[f"latitude_{var_type}"][:],
-            )
-            lon[var_type] = masked_lon.mean(axis=0)
-            lat[var_type] = masked_lat.mean(axis=1)
+        lon, lat = grid.lon, grid.lat
         values = {f"ni_{v}": lon[v] for v in self.var_types}
         values.update({f"nj_{v}": lat[v] for v in self.var_types})
 
         # set "lon_w" to "lon_t"
         values.update({"ni_w": lon["t"].values})
         values.update({"nj_w": lat["t"].values})
-        values.update({d: getattr(grid, d) for d in self.depths})
+        values.update({d: grid.depths[d] for d in self.depths})
 
         return values
 
     def _change_coordinate_values(self, dataset, values_dict):
         """
         Change and rename a given set of dimensions with given new values
-        and new names. Also
+        and new names. Also remove useless fields.
         """
-
-        ds_rename = dataset.copy()
-
-        for d in values_dict:
-            # we first add depth arrays in order to avoid conflicts with dimensions
-            if d[:5] == "depth":
-                ds_rename[d] = values_dict[d]
-
-        for d in values_dict:
-            if d[:5] != "depth":
-                ds_rename[d] = values_dict[d]
-        ds_rename = ds_rename.rename(self.renaming)
-
-        # Remove useless fields
-        try:
-            ds_rename = ds_rename.drop(self.to_drop, errors="ignore")
-        except ValueError:
-            print(self.to_drop)
-            print()
-            print([k for k in ds_rename])
-
-        return ds_rename
+        return rewrite_coordinates(dataset, values_dict, self.renaming, self.to_drop)
 
     def clean(self, data: xr.Dataset, **kwargs) -> xr.Dataset:
         """
@@ -137,14 +146,14 @@ class SEA312Cleaner(Cleaner):
                 SYMPHONIE Dataset output to clean.
 
         kwargs: dict
-                Keywords arguments for get_grid : configuration, coordinates.
+                Keywords arguments for get_grid_coordinates : configuration, coordinates.
 
         Returns
         -------
         xr.Dataset
 
         """
-        grid = get_grid(**kwargs)
+        grid = get_grid_coordinates(**kwargs)
         vls = self._get_values_from_grid(grid)
         return self._change_coordinate_values(data, vls)
 
@@ -176,64 +185,27 @@ class SEA312SurfaceCleaner(Cleaner):
 
     var_types = ["t", "u", "v", "w"]
 
-    def _get_values_from_grid(self, grid):
+    def _get_values_from_grid(self, grid: GridCoordinates):
         """
-        Extract explicit coordinates values from given SYMPHONY grid.
+        Select explicit coordinates values from given SYMPHONY grid coordinates.
         """
 
-        lon, lat = {}, {}
-        excluded = []
-        for var_type in self.var_types:
-            try:
-                masked_lon, masked_lat = (
-                    grid.variables[f"longitude_{var_type}"][:],
-                    grid.variables[f"latitude_{var_type}"][:],
-                )
-                lon[var_type] = masked_lon.mean(axis=0)
-                lat[var_type] = masked_lat.mean(axis=1)
-            except KeyError:
-                excluded.append(var_type)
-        values = {f"ni_{v}": lon[v] for v in self.var_types if v not in excluded}
-        values.update({f"nj_{v}": lat[v] for v in self.var_types if v not in excluded})
+        # variable types not in grid are excluded
+        lon, lat = grid.lon, grid.lat
+        values = {f"ni_{v}": lon[v] for v in self.var_types if v in lon}
+        values.update({f"nj_{v}": lat[v] for v in self.var_types if v in lat})
 
         return values
 
     def _change_coordinate_values(self, dataset, values_dict):
         """
         Change and rename a given set of dimensions with given new values
-        and new names. Also
+        and new names. Also remove useless fields.
         """
-
-        ds_rename = dataset.copy()
-
-        for d in values_dict:
-            # we first add depth arrays in order to avoid conflicts with dimensions
-            if d[:5] == "depth":
-                ds_rename[d] = values_dict[d]
-
-        for d in values_dict:
-            if d[:5] != "depth":
-                ds_rename[d] = values_dict[d]
-
-        for k, it in self.renaming.items():
-            try:
-                ds_rename = ds_rename.rename({k: it})
-            except (ValueError, KeyError) as e:
-                print(e)
-                pass
-
-        # Remove useless fields
-        try:
-            ds_rename = ds_rename.drop(self.to_drop, errors="ignore")
-        except ValueError:
-            print(self.to_drop)
-            print()
-            print([k for k in ds_rename])
-
-        return ds_rename
+        return rewrite_coordinates(dataset, values_dict, self.renaming, self.to_drop)
 
     def clean(self, data: xr.Dataset, **kwargs) -> xr.Dataset:
-        grid = get_grid(**kwargs)
+        grid = get_grid_coordinates(**kwargs)
         vls = self._get_values_from_grid(grid)
         out = self._change_coordinate_values(data, vls)
         try:
@@ -254,23 +226,27 @@ class SYMPHONIEGridCleaner(Cleaner):
 
 #%% Satellites
 class OSTIACleaner(Cleaner):
+
+    renaming = {"analysed_sst": "tem"}
+
     def clean(self, data: xr.Dataset, **kwargs) -> xr.Dataset:
-        renaming_dict = {"analysed_sst": "tem"}
-        data["analysed_sst"] = data.analysed_sst - 273.15  # K -> °C
-        return data.rename(renaming_dict)
+        if "analysed_sst" in data:  # might not be loaded (see Selection)
+            data["analysed_sst"] = data.analysed_sst - 273.15  # K -> °C
+        return rewrite_coordinates(data, {}, self.renaming, [])
 
 
 class GLORYSCleaner(Cleaner):
-    def clean(self, data: xr.Dataset, **kwargs) -> xr.Dataset:
-        renaming_dict = {
-            "latitude": "lat_t",
-            "longitude": "lon_t",
-            "depth": "depth_t",
-            "thetao": "tem",
-            "so": "sal",
-        }
 
-        return data.rename(renaming_dict)
+    renaming = {
+        "latitude": "lat_t",
+        "longitude": "lon_t",
+        "depth": "depth_t",
+        "thetao": "tem",
+        "so": "sal",
+    }
+
+    def clean(self, data: xr.Dataset, **kwargs) -> xr.Dataset:
+        return rewrite_coordinates(data, {}, self.renaming, [])
 
 
 def get_renaming_dict(nemo_config: str, var: str="t"):
@@ -0,0 +1,401 @@
+from typing import Iterable, List, Optional, Tuple
+
+import os
+import shutil
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+try:
+    from scipy.spatial import cKDTree
+except ModuleNotFoundError:
+    cKDTree = None
+
+from utilities.paths import paths
+from utilities.func import check_matching
+from utilities.interpolation import VerticalInterpolator
+
+COLOCATION_PATH = paths.cache_path / "colocation"
+
+PROFILE_DIM = "file"  # as in ALL_<SIM>_0_2000.nc files and argo_features.csv index
+CORNER_DIM = "corner"
+METHODS = {"nearest": 1, "bilinear": 4}  # method -> number of grid points per profile
+
+
+def _axis_position(axis: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """ Fractional index of x along a monotonic axis, NaN outside of it. """
+    if axis[0] > axis[-1]:
+        return axis.size - 1 - _axis_position(axis[::-1], x)
+    i = np.clip(np.searchsorted(axis, x) - 1, 0, axis.size - 2)
+    position = i + (x - axis[i]) / (axis[i + 1] - axis[i])
+    return np.where((x < axis[0]) | (x > axis[-1]), np.nan, position)
+
+
+class HorizontalIndex:
+    """
+        Grid indices of points given by longitude / latitude, built once per grid.
+    Rectilinear grids (1-D coordinates, e.g. cleaned SYMPHONIE lon_t / lat_t) are
+    searched by bisection along each axis, curvilinear ones (2-D coordinates)
+    through a KD-tree (nearest points only, points farther than one cell from
+    their nearest grid point being out of grid).
+    """
+
+    def __init__(self, lon: xr.DataArray, lat: xr.DataArray):
+        self.rectilinear = lon.ndim == 1
+        if self.rectilinear:
+            self.lat_dim, self.lon_dim = lat.dims[0], lon.dims[0]
+            self._lon, self._lat = np.asarray(lon.values, float), np.asarray(lat.values, float)
+            return
+
+        if cKDTree is None:
+            raise ModuleNotFoundError("scipy is needed to index 2-D coordinates.")
+        self.lat_dim, self.lon_dim = lon.dims
+        self._shape = lon.shape
+        self._tree = cKDTree(np.column_stack([lon.values.ravel(), lat.values.ravel()]))
+        self._spacing = self._cell_spacing(np.asarray(lon.values, float), np.asarray(lat.values, float))
+
+    @staticmethod
+    def _cell_spacing(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """
+            (ny * nx,) largest distance between each grid point and its neighbours :
+        points farther than it from their nearest grid point are out of the grid.
+        """
+        spacing = np.zeros(lon.shape)
+        for axis in [0, 1]:
+            step = np.hypot(np.diff(lon, axis=axis), np.diff(lat, axis=axis))
+            before = np.take(step, [0], axis=axis)  # edges : step of neighbouring cell
+            after = np.take(step, [-1], axis=axis)
+            step_before = np.concatenate([before, step], axis=axis)
+            step_after = np.concatenate([step, after], axis=axis)
+            spacing = np.fmax(spacing, np.fmax(step_before, step_after))
+        return spacing.ravel()
+
+    def stencil(self, lon: np.ndarray, lat: np.ndarray, method="nearest"):
+        """
+            Grid points used for each (lon, lat) point.
+
+        Returns
+        -------
+        j, i:       np.ndarray
+                    (n_points, n_corners) indices along latitude / longitude dims.
+
+        weight:     np.ndarray
+                    (n_points, n_corners) weight of each grid point.
+
+        inside:     np.ndarray
+                    (n_points,) whether points are inside grid.
+        """
+        check_matching(method, METHODS, "co-location method")
+        lon, lat = np.asarray(lon, float), np.asarray(lat, float)
+
+        if not self.rectilinear:
+            if method != "nearest":
+                raise ValueError("Only nearest co-location is available on 2-D coordinates.")
+            distance, flat = self._tree.query(np.column_stack([lon, lat]))
+            inside = distance <= self._spacing[flat]
+            j, i = np.unravel_index(flat, self._shape)
+            return j[:, None], i[:, None], np.ones((lon.size, 1)), inside
+
+        pos_j, pos_i = _axis_position(self._lat, lat), _axis_position(self._lon, lon)
+        inside = ~(np.isnan(pos_j) | np.isnan(pos_i))
+        pos_j, pos_i = np.where(inside, pos_j, 0), np.where(inside, pos_i, 0)
+
+        if method == "nearest":
+            j, i = np.rint(pos_j).astype(int), np.rint(pos_i).astype(int)
+            return j[:, None], i[:, None], np.ones((lon.size, 1)), inside
+
+        j0 = np.clip(np.floor(pos_j).astype(int), 0, self._lat.size - 2)
+        i0 = np.clip(np.floor(pos_i).astype(int), 0, self._lon.size - 2)
+        wj, wi = pos_j - j0, pos_i - i0
+        j = np.column_stack([j0, j0, j0 + 1, j0 + 1])
+        i = np.column_stack([i0, i0 + 1, i0, i0 + 1])
+        weight = np.column_stack([(1 - wj) * (1 - wi), (1 - wj) * wi, wj * (1 - wi), wj * wi])
+        return j, i, weight, inside
+
+
+def nearest_time_index(times: np.ndarray, t: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Index of nearest model time of each time t, and whether t is in model time range. """
+    t = np.asarray(t, dtype=times.dtype)
+    in_range = (t >= times[0]) & (t <= times[-1])
+    if times.size == 1:
+        return np.zeros(t.size, int), in_range
+
+    after = np.clip(np.searchsorted(times, t), 1, times.size - 1)
+    before = after - 1
+    index = np.where(np.abs(t - times[before]) <= np.abs(times[after] - t), before, after)
+    return index, in_range
+
+
+class Colocator:
+    """
+        Sample a gridded model dataset at ARGO profiles (time, longitude, latitude),
+    then interpolate sampled columns to fixed depth levels.
+
+    Profiles are processed by blocks of model time chunks : each chunk is read
+    once, only at needed grid points. Blocks are appended one after another to a
+    Zarr store, so that memory is bounded by max_profiles whatever the number of
+    profiles.
+    """
+
+    def __init__(
+            self,
+            data: xr.Dataset,
+            index: HorizontalIndex,
+            levels: np.ndarray,
+            var_type="t",
+            method="nearest",
+            time_name="time",
+            h_sign=1,
+            interp_method="linear",
+            backend="numpy",
+    ):
+        """
+
+        Parameters
+        ----------
+        data:           xr.Dataset
+                        Cleaned model data, with a depth_<var_type> field.
+
+        index:          HorizontalIndex
+                        Index of the grid of data (see HorizontalIndex).
+
+        levels:         np.ndarray
+                        Depth levels of output profiles (e.g. those of ARGO profiles).
+
+        var_type:       str
+                        Type of grid points of sampled variables ("t", "u"...).
+
+        method:         str, default: "nearest"
+                        "nearest" or "bilinear" horizontal co-location.
+
+        time_name:      str
+                        Name of time dimension of data.
+
+        h_sign:         int
+                        Sign convention of levels (see interp_variable).
+
+        interp_method:  str, default: "linear"
+                        Vertical interpolation method (see VerticalInterpolator).
+
+        backend:        str, default: "numpy"
+                        Vertical interpolation backend (see VerticalInterpolator).
+        """
+        check_matching(method, METHODS, "co-location method")
+        self.data = data
+        self.index = index
+        self.levels = np.asarray(levels, dtype=float)
+        self.method = method
+        self.time_name = time_name
+        self.interp_kwargs = dict(h_sign=h_sign, method=interp_method, backend=backend)
+
+        self.depth = data[f"depth_{var_type}"]
+        horizontal = [index.lat_dim, index.lon_dim, time_name]
+        self.z_dim = [d for d in self.depth.dims if d not in horizontal][0]
+
+    def default_variables(self) -> List[str]:
+        """ 3-D (or 4-D) variables on the grid of depth field, depth fields excluded. """
+        dims = {self.z_dim, self.index.lat_dim, self.index.lon_dim}
+        return [
+            v for v in self.data.data_vars
+            if dims <= set(self.data[v].dims) and v[:5] != "depth"
+        ]
+
+    def _sample(self, var: xr.DataArray, t, j, i, weight) -> xr.DataArray:
+        """ (profile, z) columns of var at given grid points, weighted over corners. """
+        dims = (PROFILE_DIM, CORNER_DIM)
+        indexers = {
+            self.index.lat_dim: xr.DataArray(j, dims=dims),
+            self.index.lon_dim: xr.DataArray(i, dims=dims),
+        }
+        if self.time_name in var.dims:
+            indexers[self.time_name] = xr.DataArray(np.broadcast_to(t[:, None], j.shape), dims=dims)
+        values = var.isel(indexers)
+
+        # masked (land) grid points are left out of weighting
+        weights = xr.DataArray(weight, dims=dims).where(values.notnull(), 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out = (values.fillna(0) * weights).sum(CORNER_DIM) / weights.sum(CORNER_DIM)
+        return out.transpose(PROFILE_DIM, self.z_dim)
+
+    def _colocate_block(self, variables, t, j, i, weight) -> xr.Dataset:
+        depth = self._sample(self.depth, t, j, i, weight).compute()
+        interpolator = VerticalInterpolator(
+            depth.transpose(self.z_dim, PROFILE_DIM), self.levels, z_dim=self.z_dim, **self.interp_kwargs
+        )
+        sampled = xr.Dataset({v: self._sample(self.data[v], t, j, i, weight) for v in variables}).compute()
+        return xr.Dataset({v: interpolator(sampled[v]) for v in variables})
+
+    def _empty_result(self, variables) -> xr.Dataset:
+        """ Result without any profile, with the same variables and coordinates as others. """
+        sign = np.sign(self.levels.mean()) * self.interp_kwargs["h_sign"]  # as VerticalInterpolator
+        profiles = np.empty(0)
+        return xr.Dataset(
+            {v: ((PROFILE_DIM, "depth"), np.empty((0, self.levels.size))) for v in variables},
+            coords={
+                PROFILE_DIM: profiles.astype(object),
+                "depth": sign * self.levels,
+                "lon": (PROFILE_DIM, profiles),
+                "lat": (PROFILE_DIM, profiles),
+                "time": (PROFILE_DIM, profiles.astype("datetime64[ns]")),
+                "model_time": (PROFILE_DIM, profiles.astype("datetime64[ns]")),
+            },
+        )
+
+    def _blocks(self, t: np.ndarray, max_profiles: int) -> List[np.ndarray]:
+        """ Positions of profiles (sorted by time) of each block : one model time chunk at most. """
+        order = np.argsort(t, kind="stable")
+        chunks = self.data.chunks.get(self.time_name) if self.data.chunks else None
+        if chunks is None:
+            chunk_of = np.zeros(t.size, int)
+        else:
+            bounds = np.cumsum((0,) + tuple(chunks))
+            chunk_of = np.searchsorted(bounds, t[order], side="right") - 1
+
+        blocks = []
+        for chunk in np.unique(chunk_of):
+            positions = order[chunk_of == chunk]
+            blocks.extend(np.array_split(positions, int(np.ceil(positions.size / max_profiles))))
+        return blocks
+
+    def colocate(
+            self,
+            features: pd.DataFrame,
+            output: Path,
+            variables: Optional[Iterable[str]] = None,
+            max_profiles: int = 5000,
+            lon_col="lon",
+            lat_col="lat",
+            time_col="time",
+    ) -> Path:
+        """
+            Co-locate data with profiles of features (one row per profile, indexed
+        by profile file), and write (profile, depth) results to a Zarr store at
+        output. Profiles out of model domain or time range are left out.
+
+        Parameters
+        ----------
+        features:       pd.DataFrame
+                        ARGO features (e.g. ARGO_features source).
+
+        output:         Path
+                        Path of output Zarr store.
+
+        variables:      iterable of str, optional.
+                        Variables to sample. Default to all 3-D variables.
+
+        max_profiles:   int
+                        Maximum number of profiles sampled at once.
+
+        lon_col, lat_col, time_col: str
+                        Columns of features with position and time of profiles.
+
+        Returns
+        -------
+        Path of output store.
+        """
+        variables = list(variables) if variables is not None else self.default_variables()
+        output = Path(output)
+
+        times = self.data[self.time_name].values
+        t, in_time = nearest_time_index(times, pd.to_datetime(features[time_col]).values)
+        j, i, weight, inside = self.index.stencil(
+            features[lon_col].values, features[lat_col].values, method=self.method
+        )
+        kept = np.flatnonzero(in_time & inside)
+        print(f"Co-locating {kept.size} profiles ({len(features) - kept.size} out of model domain)", end=" ")
+
+        output.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = output.with_suffix(f".{os.getpid()}.tmp")
+        if kept.size == 0:
+            self._empty_result(variables).to_zarr(tmp_path, mode="w", consolidated=True)
+        for n, block in enumerate(self._blocks(t[kept], max_profiles)):
+            rows = kept[block]
+            ds = self._colocate_block(variables, t[rows], j[rows], i[rows], weight[rows])
+            ds = ds.assign_coords({
+                # variable length strings, as names of later blocks may be longer
+                PROFILE_DIM: features.index.values[rows].astype(str).astype(object),
+                "lon": (PROFILE_DIM, features[lon_col].values[rows]),
+                "lat": (PROFILE_DIM, features[lat_col].values[rows]),
+                "time": (PROFILE_DIM, pd.to_datetime(features[time_col]).values[rows]),
+                "model_time": (PROFILE_DIM, times[t[rows]]),
+            })
+            if n == 0:
+                ds.to_zarr(tmp_path, mode="w", consolidated=True)
+            else:
+                ds.to_zarr(tmp_path, append_dim=PROFILE_DIM, consolidated=True)
+
+        if output.exists():
+            shutil.rmtree(output)
+        os.replace(tmp_path, output)
+        print("=> done.")
+        return output
+
+
+def colocate_sources(
+        sources,
+        features: pd.DataFrame,
+        levels: np.ndarray,
+        location: Path = COLOCATION_PATH,
+        max_workers: int = 1,
+        var_type="t",
+        **kwargs
+) -> List[Path]:
+    """
+        Co-locate several gridded sources (e.g. all simulations) with ARGO
+    profiles. The horizontal index is built once for all sources sharing the
+    same grid. Outputs are written to <location>/<source key>.zarr.
+
+    Parameters
+    ----------
+    sources:        iterable of GriddedSource
+                    Sources to co-locate. Loaded if needed.
+
+    features:       pd.DataFrame
+                    ARGO features (e.g. ARGO_features source).
+
+    levels:         np.ndarray
+                    Depth levels of output profiles.
+
+    location:       Path
+                    Directory of output stores.
+
+    max_workers:    int, default: 1
+                    Number of sources co-located at the same time.
+
+    var_type:       str
+                    Type of grid points of sampled variables.
+
+    kwargs:         dict
+                    Kwargs passed to Colocator (method, interp_method...) and
+                    Colocator.colocate (variables, max_profiles, columns...).
+
+    Returns
+    -------
+    Paths of output stores, in order of sources.
+    """
+    colocate_kwargs = {
+        k: kwargs.pop(k) for k in ["variables", "max_profiles", "lon_col", "lat_col", "time_col"] if k in kwargs
+    }
+
+    indexes = []  # (lon, lat, index) of grids already indexed
+
+    def get_index(source) -> HorizontalIndex:
+        lon, lat = source.get_lon(var_type=var_type), source.get_lat(var_type=var_type)
+        for known_lon, known_lat, index in indexes:
+            if known_lon.equals(lon) and known_lat.equals(lat):
+                return index
+        index = HorizontalIndex(lon, lat)
+        indexes.append((lon, lat, index))
+        return index
+
+    def colocate_one(source, index) -> Path:
+        colocator = Colocator(source.d, index, levels, var_type=var_type, **kwargs)
+        return colocator.colocate(features, Path(location) / f"{source.info_file_name}.zarr", **colocate_kwargs)
+
+    sources = list(sources)
+    source_indexes = [get_index(sr) for sr in sources]  # loads sources, one after another
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="colocate") as executor:
+        return list(executor.map(colocate_one, sources, source_indexes))
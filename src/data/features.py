@@ -0,0 +1,254 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utilities.paths import paths
+from data.sources import DataSource
+from data.getters import check_path_existence
+
+FEATURES_INDEX_PATH = paths.cache_path / "argo_features"
+
+CELL_SIZE = 1.0  # size of spatial index cells, in degrees
+TIME_COLUMNS = ["time", "year"]  # rows are sorted along the first one available
+
+
+def _signature(path: Path) -> list:
+    stat = Path(path).stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class ArgoFeatureIndex:
+    """
+        Indexed table of ARGO features (one row per profile), stored as Parquet.
+
+    Rows are sorted by time, so that a time range is found by bisection. Rows
+    are also indexed by zone and by cell of a regular lon / lat grid : the
+    permutation sorting rows by zone (resp. cell) is stored with them, and rows
+    of a zone or of a bounding box are found by bisection in it. Queries then
+    only read matching rows, instead of evaluating masks on the whole table.
+
+    The index is written again only if the features file was modified.
+    """
+
+    def __init__(
+            self,
+            source_name: str = "ARGO_features",
+            location: Path = FEATURES_INDEX_PATH,
+            cell_size: float = CELL_SIZE,
+    ):
+        """
+
+        Parameters
+        ----------
+        source_name:    str
+                        Name of features source in information files.
+
+        location:       Path
+                        Directory where the index is written.
+
+        cell_size:      float
+                        Size of cells of the spatial index, in degrees.
+        """
+        self.source_name = source_name
+        self.cell_size = cell_size
+        self.location = Path(location)
+        self.table_path = self.location / f"{source_name}.parquet"
+        self.info_path = self.location / f"{source_name}.json"
+
+        self.features = None
+        self._sorted = {}  # column -> (permutation, sorted values)
+        self.time_column = None
+
+    # Building
+    # --------
+
+    def _cells(self, lon, lat) -> np.ndarray:
+        n_lon = int(np.ceil(360 / self.cell_size))
+        i = np.floor((np.asarray(lon) % 360) / self.cell_size).astype(int)
+        j = np.floor((np.asarray(lat) + 90) / self.cell_size).astype(int)
+        return j * n_lon + i
+
+    def build(self, source: DataSource, signature: list) -> pd.DataFrame:
+        """ Sort and index features of source, and write them as Parquet. """
+        features = source.d if source.d is not None else source.get_data()
+        time_column = next(c for c in TIME_COLUMNS if c in features.columns)
+        if time_column != "year":
+            features[time_column] = pd.to_datetime(features[time_column])
+
+        features = features.sort_values(time_column, kind="stable")
+        features["cell"] = self._cells(features["lon"].values, features["lat"].values)
+        for column in ["zone", "cell"]:
+            features[f"{column}_order"] = np.argsort(features[column].values, kind="stable")
+
+        print(f"Indexing {len(features)} {self.source_name}", end=" ")
+        self.location.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.table_path.with_suffix(f".{os.getpid()}.tmp")
+        features.to_parquet(tmp_path)
+        os.replace(tmp_path, self.table_path)
+        with open(self.info_path, "w") as f:
+            json.dump(dict(signature=signature, cell_size=self.cell_size, time_column=time_column), f)
+        print("=> done.")
+        return features
+
+    def load(self) -> "ArgoFeatureIndex":
+        """ Read index, (re)building it first if features file changed. """
+        source = DataSource(self.source_name)
+        signature = _signature(check_path_existence(source.file_path))
+
+        info = None
+        if self.info_path.is_file():
+            with open(self.info_path, "r") as f:
+                info = json.load(f)
+
+        if info is not None and info["signature"] == signature and info["cell_size"] == self.cell_size:
+            features = pd.read_parquet(self.table_path)
+        else:
+            features = self.build(source, signature)
+
+        self.time_column = next(c for c in TIME_COLUMNS if c in features.columns)
+        self._sorted = {}
+        for column in ["zone", "cell"]:
+            order = features.pop(f"{column}_order").values
+            self._sorted[column] = (order, features[column].values[order])
+        self.features = features
+        return self
+
+    # Queries
+    # -------
+
+    def zones(self) -> List[str]:
+        return list(pd.unique(self._sorted["zone"][1]))
+
+    def _positions(self, column: str, low, high) -> np.ndarray:
+        """ Positions (in time order) of rows with low <= column <= high. """
+        order, values = self._sorted[column]
+        start, stop = np.searchsorted(values, low, "left"), np.searchsorted(values, high, "right")
+        return order[start:stop]
+
+    def _zone_positions(self, zones: Iterable[str]) -> np.ndarray:
+        return np.concatenate([self._positions("zone", z, z) for z in zones] or [np.empty(0, int)])
+
+    def _bbox_positions(self, bbox: Tuple[float, float, float, float]) -> np.ndarray:
+        """ Rows in (lon_min, lon_max, lat_min, lat_max), from cells overlapping it. """
+        lon_min, lon_max, lat_min, lat_max = bbox
+        n_lon = int(np.ceil(360 / self.cell_size))
+        corners = self._cells([lon_min, lon_max], [lat_min, lat_max])
+        (j_min, j_max), (i_min, i_max) = divmod(corners, n_lon)
+
+        # cells of a grid row are contiguous in cell order
+        positions = np.concatenate([
+            self._positions("cell", j * n_lon + i_min, j * n_lon + i_max) for j in range(j_min, j_max + 1)
+        ])
+        lon = self.features["lon"].values[positions] % 360
+        lat = self.features["lat"].values[positions]
+        inside = (lon >= lon_min % 360) & (lon <= lon_max % 360) & (lat >= lat_min) & (lat <= lat_max)
+        return positions[inside]
+
+    def _time_bounds(self, time: Optional[slice] = None, years: Optional[Iterable[int]] = None) -> List[Tuple[int, int]]:
+        """ (start, stop) position ranges of rows in time slice and given years. """
+        n = len(self.features)
+        ranges = [(0, n)]
+        if time is not None:
+            values = self.features[self.time_column].values
+            if self.time_column != "year":
+                time = slice(
+                    None if time.start is None else np.datetime64(pd.Timestamp(time.start)),
+                    None if time.stop is None else np.datetime64(pd.Timestamp(time.stop)),
+                )
+            start = 0 if time.start is None else np.searchsorted(values, time.start, "left")
+            stop = n if time.stop is None else np.searchsorted(values, time.stop, "right")
+            ranges = [(start, stop)]
+        if years is not None:
+            # years are sorted as time
+            years_values = self.features["year"].values
+            year_ranges = [
+                (np.searchsorted(years_values, y, "left"), np.searchsorted(years_values, y, "right"))
+                for y in sorted(years)
+            ]
+            ranges = [
+                (max(a, c), min(b, d)) for a, b in ranges for c, d in year_ranges if max(a, c) < min(b, d)
+            ]
+        return ranges
+
+    def positions(
+            self,
+            zones: Optional[Iterable[str]] = None,
+            bbox: Optional[Tuple[float, float, float, float]] = None,
+            time: Optional[slice] = None,
+            years: Optional[Iterable[int]] = None,
+    ) -> np.ndarray:
+        """ Sorted positions of rows matching all given filters (see query). """
+        ranges = self._time_bounds(time, years)
+
+        candidates = []
+        if zones is not None:
+            candidates.append(np.sort(self._zone_positions(zones)))
+        if bbox is not None:
+            candidates.append(np.sort(self._bbox_positions(bbox)))
+
+        if not candidates:
+            return np.concatenate([np.arange(a, b) for a, b in ranges] or [np.empty(0, int)])
+
+        positions = candidates[0]
+        for other in candidates[1:]:
+            positions = np.intersect1d(positions, other, assume_unique=True)
+        in_time = np.zeros(positions.size, bool)
+        for a, b in ranges:
+            in_time |= (positions >= a) & (positions < b)
+        return positions[in_time]
+
+    def query(
+            self,
+            zones: Optional[Iterable[str]] = None,
+            bbox: Optional[Tuple[float, float, float, float]] = None,
+            time: Optional[slice] = None,
+            years: Optional[Iterable[int]] = None,
+    ) -> pd.DataFrame:
+        """
+            Features of profiles matching all given filters, in time order.
+
+        Parameters
+        ----------
+        zones:  iterable of str, optional.
+                Zones of profiles.
+
+        bbox:   tuple, optional.
+                (lon_min, lon_max, lat_min, lat_max) of profiles.
+
+        time:   slice, optional.
+                Time range of profiles (inclusive).
+
+        years:  iterable of int, optional.
+                Years of profiles.
+
+        Returns
+        -------
+        pd.DataFrame
+        """
+        return self.features.iloc[self.positions(zones=zones, bbox=bbox, time=time, years=years)]
+
+    def zone_aggregates(self, **query_kwargs) -> pd.DataFrame:
+        """
+            Number of profiles and mean position of profiles of each zone, among
+        profiles matching query_kwargs (see query), in one grouped pass.
+        """
+        return self.query(**query_kwargs).groupby("zone").agg(
+            n_profiles=("lon", "size"),
+            lon=("lon", "mean"),
+            lat=("lat", "mean"),
+        )
+
+
+_indexes: Dict[str, ArgoFeatureIndex] = {}
+
+
+def get_argo_features(source_name: str = "ARGO_features") -> ArgoFeatureIndex:
+    """ Return the (unique in process) loaded index of given features source. """
+    if source_name not in _indexes:
+        _indexes[source_name] = ArgoFeatureIndex(source_name).load()
+    return _indexes[source_name]
@@ -1,10 +1,19 @@
-from typing import List
+from typing import List, Optional
 
 from utilities.paths import paths
 
+import os
+import json
+import time
+import shutil
+import hashlib
 from pathlib import Path
 
+import xarray as xr
+
 from data.loaders import *
+from data.selection import Selection
+from data.rechunked import RechunkedCopies
 from data.cleaners import *
 
 DEFAULT_DIRS = [
@@ -43,6 +52,178 @@ def check_path_existence(
     return path_to_data
 
 
+#%% Cache of cleaned data
+CLEANED_CACHE_PATH = paths.cache_path / "cleaned"
+ACCESS_RESOLUTION = 3600  # in s : last access of cache entries is updated at most this often
+
+
+def input_signature(path: Path) -> list:
+    """
+        Names, sizes and modification times of data at path (of its direct
+    children for a directory), to detect modified inputs.
+    """
+    path = Path(path)
+    if path.is_dir():
+        entries = sorted(os.scandir(path), key=lambda e: e.name)
+        return [(e.name, e.stat().st_size, e.stat().st_mtime_ns) for e in entries]
+    stat = path.stat()
+    return [(path.name, stat.st_size, stat.st_mtime_ns)]
+
+
+def _directory_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+
+class CleanedCache:
+    """
+        On-disk cache of cleaned datasets, stored as chunked Zarr stores and
+    reopened lazily.
+
+    An entry is keyed by source name, cleaning name and kwargs, filtering pattern
+    and input files signature (names, sizes and modification times) : any
+    modification of these gives another entry. Total size is bounded : least
+    recently used entries are removed first.
+    """
+
+    def __init__(self, location: Path = CLEANED_CACHE_PATH, max_size: float = 50e9):
+        """
+
+        Parameters
+        ----------
+        location:   Path
+                    Directory where Zarr stores are written.
+
+        max_size:   float
+                    Maximum total size of stores, in bytes.
+        """
+        self.location = Path(location)
+        self.max_size = max_size
+
+    @staticmethod
+    def key(source_name, path, cleaning=None, cleaning_kwargs=None, loading_kwargs=None, filtering_pattern="") -> str:
+        description = json.dumps(
+            dict(
+                source=source_name,
+                cleaning=cleaning,
+                cleaning_kwargs=cleaning_kwargs or {},
+                loading_kwargs=loading_kwargs or {},
+                filtering_pattern=filtering_pattern,
+                inputs=input_signature(path),
+            ),
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+    # Paths
+    # -----
+
+    def _store_path(self, source_name, key) -> Path:
+        return self.location / f"{source_name}_{key}.zarr"
+
+    def _info_path(self, source_name, key) -> Path:
+        return self.location / f"{source_name}_{key}.json"
+
+    def _read_info(self, info_path: Path) -> dict:
+        with open(info_path, "r") as f:
+            return json.load(f)
+
+    def _write_info(self, info_path: Path, info: dict):
+        tmp_path = info_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(info, f)
+        os.replace(tmp_path, info_path)
+
+    # Access
+    # ------
+
+    def get(self, source_name, key) -> Optional[xr.Dataset]:
+        """ Return cached dataset (lazily opened), or None if not cached. """
+        info_path = self._info_path(source_name, key)
+        # info is written last : no info means no (complete) store
+        if not info_path.is_file():
+            return None
+
+        # eviction only needs a coarse order : info is not rewritten on each hit
+        info = self._read_info(info_path)
+        now = time.time()
+        if now - info["last_access"] > ACCESS_RESOLUTION:
+            info["last_access"] = now
+            self._write_info(info_path, info)
+
+        return xr.open_zarr(self._store_path(source_name, key))
+
+    def put(self, source_name, key, data: xr.Dataset) -> xr.Dataset:
+        """ Write cleaned data to cache, and return it reopened from cache. """
+        self.location.mkdir(parents=True, exist_ok=True)
+        store_path = self._store_path(source_name, key)
+        tmp_path = store_path.with_suffix(f".{os.getpid()}.tmp")
+
+        data = data.copy()
+        for var in data.variables:
+            data[var].encoding = {}  # NetCDF encodings are not valid for Zarr
+        if data.chunks:
+            # Zarr needs uniform chunks
+            data = data.chunk({dim: max(chunks) for dim, chunks in data.chunks.items()})
+
+        print(f"Writing {source_name} to cache", end=" ")
+        data.to_zarr(tmp_path, mode="w", consolidated=True)
+        if store_path.exists():
+            shutil.rmtree(store_path)
+        os.replace(tmp_path, store_path)
+        print("=> done.")
+
+        now = time.time()
+        self._write_info(
+            self._info_path(source_name, key),
+            dict(source=source_name, created=now, last_access=now, size=_directory_size(store_path)),
+        )
+        self.evict(keep=[store_path])
+
+        return xr.open_zarr(store_path)
+
+    # Cleaning
+    # --------
+
+    def entries(self) -> List[dict]:
+        """ Information about all entries, with their paths. """
+        out = []
+        for info_path in self.location.glob("*.json"):
+            info = self._read_info(info_path)
+            info["info_path"] = info_path
+            info["store_path"] = info_path.with_suffix(".zarr")
+            out.append(info)
+        return out
+
+    def _remove(self, entry: dict):
+        entry["info_path"].unlink(missing_ok=True)  # first : entry is no more valid
+        shutil.rmtree(entry["store_path"], ignore_errors=True)
+
+    def invalidate(self, source_name: Optional[str] = None):
+        """ Remove all entries of given source, or all entries if no source given. """
+        if not self.location.exists():
+            return
+        for entry in self.entries():
+            if source_name is None or entry["source"] == source_name:
+                self._remove(entry)
+
+    def evict(self, keep: List[Path] = ()):
+        """ Remove least recently used entries until total size is below max_size. """
+        entries = sorted(self.entries(), key=lambda e: e["last_access"])
+        total = sum(e["size"] for e in entries)
+        for entry in entries:
+            if total <= self.max_size:
+                break
+            if entry["store_path"] in keep:
+                continue
+            self._remove(entry)
+            total -= entry["size"]
+
+
+cleaned_cache = CleanedCache()
+
+
+#%%
 class DataGetter:
     def __init__(
         self,
@@ -50,7 +231,36 @@ class DataGetter:
         cleaning: str = None,
         loading_kwargs={},
         processing_kwargs={},
+        name: str = None,
+        cache: Optional[CleanedCache] = None,
+        copies: Optional[RechunkedCopies] = None,
     ):
+        """
+
+        Parameters
+        ----------
+        file_type:          str
+                            Type of file to load (see get_loader).
+
+        cleaning:           str, optional.
+                            Name of cleaning to apply (see get_processor).
+
+        loading_kwargs:     dict
+                            Kwargs passed to loader.
+
+        processing_kwargs:  dict
+                            Kwargs passed to cleaner.
+
+        name:               str, optional.
+                            Name of data, needed to use cache.
+
+        cache:              CleanedCache, optional.
+                            If given, cleaned datasets are read from / written to it.
+
+        copies:             RechunkedCopies, optional.
+                            If given, cleaned datasets are read from the best of
+                            their rechunked copies, if any.
+        """
         self._loader = get_loader(file_type)()
         self._cleaner = get_processor(cleaning)()
 
@@ -58,6 +268,14 @@ class DataGetter:
         self._loading_kwg = loading_kwargs
         self._cleaning_kwg = processing_kwargs
 
+        # Cache
+        self._cleaning = cleaning
+        self._name = name
+        self._cache = cache
+        self._copies = copies
+        if (cache is not None or copies is not None) and name is None:
+            raise ValueError("A name must be given to use cache or rechunked copies.")
+
     def add_kwg(self, key, value, where="loading"):
         if where == "loading":
             self._loading_kwg[key] = value
@@ -66,10 +284,88 @@ class DataGetter:
         else:
             raise KeyError(f"Unknown value {where} for where arg.")
 
-    def get(self, path: Path, filtering_pattern=""):
+    def _copy_key(self, path_to_data: Path, filtering_pattern="") -> str:
+        """ Key of cleaned data, regardless of how they are chunked. """
+        return CleanedCache.key(
+            self._name,
+            path_to_data,
+            cleaning=self._cleaning,
+            cleaning_kwargs=self._cleaning_kwg,
+            loading_kwargs={
+                k: it for k, it in self._loading_kwg.items() if k not in ["chunks", *PLANNING_KWARGS]
+            },
+            filtering_pattern=filtering_pattern,
+        )
+
+    def write_copy(self, path: Path, access_pattern: str, filtering_pattern="", **kwargs) -> Path:
+        """
+            Write a copy of all cleaned data at path, rechunked for access_pattern
+        (see RechunkedCopies.write, to which kwargs are passed).
+        """
+        if self._copies is None:
+            raise ValueError("No rechunked copies given to write to.")
         path_to_data = check_path_existence(path)
-        data = self._loader.load(
-            path_to_data, filtering_pattern=filtering_pattern, **self._loading_kwg
+        data = self._loader.load(path_to_data, filtering_pattern=filtering_pattern, **self._loading_kwg)
+        data = self._cleaner.clean(data, **self._cleaning_kwg)
+        return self._copies.write(
+            self._name, self._copy_key(path_to_data, filtering_pattern), data, access_pattern, **kwargs
         )
+
+    def get(self, path: Path, filtering_pattern="", selection: Optional[Selection] = None):
+        """
+            Load and clean data at path.
+
+        Parameters
+        ----------
+        path:               Path
+                            Path to data (see check_path_existence).
+
+        filtering_pattern:  str
+                            Pattern of files to load (multiple files data only).
+
+        selection:          Selection, optional.
+                            Time range, bounding box and variables to load. Without
+                            cache, time and variables are pushed down to the loader
+                            so that unused data is never opened. With cache, the whole
+                            cleaned dataset is cached and the selection applied to it.
+                            With rechunked copies, the copy reading the fewest bytes
+                            for the selection is used.
+        """
+        path_to_data = check_path_existence(path)
+        if selection is None:
+            selection = Selection()
+
+        if self._copies is not None:
+            data = self._copies.best(
+                self._name, self._copy_key(path_to_data, filtering_pattern), selection
+            )
+            if data is not None:
+                return data
+
+        key = None
+        if self._cache is not None:
+            key = self._cache.key(
+                self._name,
+                path_to_data,
+                cleaning=self._cleaning,
+                cleaning_kwargs=self._cleaning_kwg,
+                loading_kwargs=self._loading_kwg,
+                filtering_pattern=filtering_pattern,
+            )
+            data = self._cache.get(self._name, key)
+            if data is not None:
+                return selection.apply(data)
+
+        pushed_down = dict(filtering_pattern=filtering_pattern)
+        if key is None:
+            renaming = getattr(self._cleaner, "renaming", {})
+            pushed_down.update(time=selection.time, variables=selection.raw_variables(renaming))
+
+        data = self._loader.load(path_to_data, **pushed_down, **self._loading_kwg)
         data = self._cleaner.clean(data, **self._cleaning_kwg)
+
+        if key is not None and isinstance(data, xr.Dataset):
+            data = self._cache.put(self._name, key, data)
+        if isinstance(data, xr.Dataset):
+            data = selection.apply(data)
         return data
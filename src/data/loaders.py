@@ -2,9 +2,12 @@ import xarray as xr
 import pandas as pd
 
 from pathlib import Path
-import re
 
 from utilities.func import check_matching
+from data.manifest import MFDManifest
+from data.references import ReferenceIndex
+from data.selection import variables_to_drop
+from data.chunks import plan_dataset_chunks, TARGET_CHUNK_BYTES
 
 
 def get_loader(file_type):
@@ -13,6 +16,7 @@ def get_loader(file_type):
     all_loaders = {
         "zarr": ZARRLoader,
         "mfd": MFDLoader,
+        "reference": ReferenceLoader,
         "netcdf": NCLoader,
         "csv": CSVLoader,
     }
@@ -27,51 +31,188 @@ def get_loader(file_type):
 
 #%%
 class Loader:
-    def load(self, path, **kwargs):
+    """
+        Loaders accept, on top of their own kwargs, a selection to push down :
+    filtering_pattern (multiple files only), time (label slice) and variables
+    (raw names of variables to keep, others are never opened).
+
+    Dataset loaders also accept access_pattern ("time-series", "map" or
+    "profile") and target_chunk_bytes, to plan chunks aligned on disk chunks
+    instead of using hard-coded ones (see plan_loading_chunks).
+    """
+
+    def load(self, path, filtering_pattern="", time=None, variables=None, **kwargs):
         pass
 
 
+# Loading kwargs not understood by single dataset openers
+MULTIPLE_FILES_KWARGS = ["parallel", "combine", "concat_dim", "data_vars", "coords", "compat", "join", "preprocess"]
+PLANNING_KWARGS = ["access_pattern", "target_chunk_bytes"]
+
+
+def _metadata_kwargs(kwargs: dict) -> dict:
+    """ Kwargs to open a single dataset lazily, only to read its metadata. """
+    return {
+        k: it for k, it in kwargs.items()
+        if k not in ["chunks", *MULTIPLE_FILES_KWARGS, *PLANNING_KWARGS]
+    }
+
+
+def plan_loading_chunks(open_function, path, kwargs: dict, sizes=None) -> dict:
+    """
+        If an access_pattern is given in loading kwargs, replace chunks by
+    chunks planned from on-disk chunking and shape of data at path (see
+    data.chunks.plan_chunks). Only metadata are read. Return updated kwargs.
+    """
+    access_pattern = kwargs.pop("access_pattern", None)
+    target_bytes = kwargs.pop("target_chunk_bytes", TARGET_CHUNK_BYTES)
+    if access_pattern is None:
+        return kwargs
+
+    with open_function(path, chunks=None, **_metadata_kwargs(kwargs)) as ds:
+        kwargs["chunks"] = plan_dataset_chunks(ds, access_pattern, target_bytes, sizes=sizes)
+    print(f"Chunks planned for {access_pattern} access : {kwargs['chunks']}")
+    return kwargs
+
+
+def _select_time(ds: xr.Dataset, time, time_name="time") -> xr.Dataset:
+    if time is not None and time_name in ds.dims:
+        return ds.sel({time_name: time})
+    return ds
+
+
 #%%
 class MFDLoader(Loader):
     def __init__(self):
         self.file_endings = [".nc", ".gz"]
 
-    def load(self, path, filtering_pattern="", **kwargs):
-        return self._load_mfd(path, filtering_pattern=filtering_pattern, **kwargs)
-
-    def _filter(self, name: str, pattern: str = ""):
-        return (name[-3:] in self.file_endings) and (
-            re.search(pattern, name) is not None
+    def load(self, path, filtering_pattern="", time=None, variables=None, **kwargs):
+        return self._load_mfd(
+            path, filtering_pattern=filtering_pattern, time=time, variables=variables, **kwargs
         )
 
-    def _load_mfd(self, path, filtering_pattern="", **kwargs):
+    def get_manifest(self, path) -> MFDManifest:
+        """ Manifest of files in path, updated with new / modified / removed files. """
+        manifest = MFDManifest(path, file_endings=self.file_endings)
+        manifest.update()
+        return manifest
+
+    @staticmethod
+    def _are_disjoint(manifest: MFDManifest, files) -> bool:
+        """ Whether files, in given order, have increasing and non overlapping time ranges. """
+        entries = [manifest.entries[f.name] for f in files]
+        if any(entry["time_start"] is None for entry in entries):
+            return False
+        return all(
+            pd.Timestamp(previous["time_end"]) < pd.Timestamp(entry["time_start"])
+            for previous, entry in zip(entries[:-1], entries[1:])
+        )
 
-        files = [
-            f
-            for f in Path(path).iterdir()
-            if self._filter(f.name, pattern=filtering_pattern)
-        ]
+    def _load_mfd(self, path, filtering_pattern="", time=None, variables=None, **kwargs):
+        """
+            Files are listed from the manifest of path : only new or modified
+        files are opened to index them, and only files matching
+        filtering_pattern and overlapping time slice are opened afterwards.
+        """
+        manifest = self.get_manifest(path)
+        files = manifest.select(pattern=filtering_pattern, time=time)
 
         if not files:
-            raise FileNotFoundError(f"Location {path} is empty.")
-        files.sort()
+            raise FileNotFoundError(
+                f"No file in location {path} matching '{filtering_pattern}' (time: {time})."
+            )
+
+        # Files are known to follow each other in time : no need to compare
+        # non concatenated variables and coordinates across all files.
+        if kwargs.get("concat_dim") == manifest.time_name and self._are_disjoint(manifest, files):
+            kwargs.setdefault("data_vars", "minimal")
+            kwargs.setdefault("coords", "minimal")
+            kwargs.setdefault("compat", "override")
+
+        if variables is not None:  # variables of first file are assumed to be in all files
+            kwargs["drop_variables"] = variables_to_drop(
+                xr.open_dataset, files[0], variables, **_metadata_kwargs(kwargs)
+            )
+
+        # Planned from first file, with full length of concatenation dimension
+        entries = [manifest.entries[f.name] for f in files]
+        sizes = None
+        if all(entry["n_time"] is not None for entry in entries):
+            sizes = {manifest.time_name: sum(entry["n_time"] for entry in entries)}
+        kwargs = plan_loading_chunks(xr.open_dataset, files[0], kwargs, sizes=sizes)
+
         ds = xr.open_mfdataset(files, **kwargs)
-        return ds.chunk(kwargs["chunks"])
+        ds = _select_time(ds, time, manifest.time_name)
+
+        # Chunks are at most one file long along concatenation dimension :
+        # merge them if longer chunks are asked. Other dimensions are left untouched.
+        concat_dim = kwargs.get("concat_dim")
+        chunks = kwargs.get("chunks")
+        if isinstance(chunks, dict) and concat_dim in chunks:
+            ds = ds.chunk({concat_dim: chunks[concat_dim]})
+        return ds
+
+
+class ReferenceLoader(Loader):
+    """
+        Open a directory of NetCDF4 files as a single virtual Zarr dataset,
+    through a reference index built once (see data.references). Accepts the
+    same loading kwargs as MFDLoader, so that a source can switch between them.
+    """
+
+    @staticmethod
+    def _open_reference(reference_path, **kwargs) -> xr.Dataset:
+        return xr.open_dataset(
+            "reference://",
+            engine="zarr",
+            backend_kwargs=dict(
+                consolidated=False,
+                storage_options=dict(fo=str(reference_path), remote_protocol="file"),
+            ),
+            **kwargs,
+        )
+
+    def load(self, path, filtering_pattern="", time=None, variables=None, **kwargs):
+        concat_dim = kwargs.pop("concat_dim", "time")
+        kwargs.setdefault("chunks", {})
+        for key in ["combine", "parallel"]:  # open_mfdataset only
+            kwargs.pop(key, None)
+
+        index = ReferenceIndex(path, concat_dim=concat_dim)
+        reference_path = index.build(filtering_pattern=filtering_pattern, time=time)
+
+        if variables is not None:
+            kwargs["drop_variables"] = variables_to_drop(
+                self._open_reference, reference_path, variables, **_metadata_kwargs(kwargs)
+            )
+        kwargs = plan_loading_chunks(self._open_reference, reference_path, kwargs)
+        ds = self._open_reference(reference_path, **kwargs)
+        return _select_time(ds, time, concat_dim)
 
 
 class CSVLoader(Loader):
-    def load(self, path, **kwargs):
-        kwargs.pop("filtering_pattern")
+    def load(self, path, filtering_pattern="", time=None, variables=None, **kwargs):
+        # Selection is applied on cleaned data only, as column names depend on files
+        for key in PLANNING_KWARGS:
+            kwargs.pop(key, None)
         return pd.read_csv(path, **kwargs)
 
 
 class ZARRLoader(Loader):
-    def load(self, path, **kwargs):
-        kwargs.pop("filtering_pattern")
-        return xr.open_zarr(path, **kwargs)
+    def load(self, path, filtering_pattern="", time=None, variables=None, **kwargs):
+        if variables is not None:
+            kwargs["drop_variables"] = variables_to_drop(
+                xr.open_zarr, path, variables, **_metadata_kwargs(kwargs)
+            )
+        kwargs = plan_loading_chunks(xr.open_zarr, path, kwargs)
+        return _select_time(xr.open_zarr(path, **kwargs), time)
 
 
 class NCLoader(Loader):
-    def load(self, path, **kwargs):
-        kwargs.pop("filtering_pattern")
-        return xr.open_dataset(path, **kwargs)
+    def load(self, path, filtering_pattern="", time=None, variables=None, **kwargs):
+        if variables is not None:
+            kwargs["drop_variables"] = variables_to_drop(
+                xr.open_dataset, path, variables, **_metadata_kwargs(kwargs)
+            )
+        kwargs = plan_loading_chunks(xr.open_dataset, path, kwargs)
+        return _select_time(xr.open_dataset(path, **kwargs), time)
@@ -0,0 +1,161 @@
+from typing import List, Optional
+
+import os
+import re
+import json
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import xarray as xr
+
+from utilities.paths import paths
+
+MANIFESTS_PATH = paths.cache_path / "manifests"
+
+
+def _read_time_range(file_path: Path, time_name: str = "time") -> dict:
+    """ Time range of one file, reading only its metadata and time coordinate. """
+    try:
+        with xr.open_dataset(file_path, decode_times=True) as ds:
+            times = ds[time_name].values
+            return dict(
+                n_time=int(times.size),
+                time_start=str(pd.Timestamp(times.min())),
+                time_end=str(pd.Timestamp(times.max())),
+            )
+    except Exception as e:  # unreadable metadata (e.g. compressed file) : file is never pruned
+        print(f"Could not read time range of {file_path.name} : {e}")
+        return dict(n_time=None, time_start=None, time_end=None)
+
+
+def _overlaps(entry: dict, time: slice) -> bool:
+    """ Whether file described by entry has times in given (label, inclusive) slice. """
+    if entry["time_start"] is None:
+        return True
+    if time.start is not None and pd.Timestamp(entry["time_end"]) < pd.Timestamp(time.start):
+        return False
+    if time.stop is not None and pd.Timestamp(entry["time_start"]) > pd.Timestamp(time.stop):
+        return False
+    return True
+
+
+class MFDManifest:
+    """
+        Persistent index of the files of a multiple files dataset : name, size,
+    modification time and time range of each file.
+
+    Updating it only stats the directory, and opens only new or modified files
+    (in parallel) to read their time range. Files can then be selected by
+    pattern and time slice without opening the other ones.
+    """
+
+    def __init__(
+            self,
+            directory: Path,
+            file_endings=(".nc", ".gz"),
+            time_name: str = "time",
+            location: Path = MANIFESTS_PATH,
+            max_workers: int = 8,
+    ):
+        """
+
+        Parameters
+        ----------
+        directory:      Path
+                        Directory of files.
+
+        file_endings:   iterable of str
+                        Endings of files to index.
+
+        time_name:      str
+                        Name of time coordinate in files.
+
+        location:       Path
+                        Directory where manifests are saved.
+
+        max_workers:    int
+                        Number of files whose metadata are read at the same time.
+        """
+        self.directory = Path(directory)
+        self.file_endings = tuple(file_endings)
+        self.time_name = time_name
+        self.max_workers = max_workers
+
+        # manifests of the same directory with other endings / time name are other files
+        description = f"{self.directory.resolve()}|{sorted(self.file_endings)}|{time_name}"
+        directory_hash = hashlib.sha1(description.encode()).hexdigest()[:12]
+        self.manifest_file = Path(location) / f"{self.directory.name}_{directory_hash}.json"
+
+        self.entries = {}  # file name -> information
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.manifest_file, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self.entries = {}
+
+    def _save(self):
+        try:
+            self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.manifest_file.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_file, "w") as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp_file, self.manifest_file)
+        except OSError as e:
+            print(f"Could not save manifest at {self.manifest_file} : {e}")
+
+    def update(self) -> bool:
+        """ Incremental rescan of directory. Return True if anything changed. """
+        current = {}
+        for entry in os.scandir(self.directory):
+            if entry.name[-3:] in self.file_endings:
+                stat = entry.stat()
+                current[entry.name] = dict(size=stat.st_size, mtime=stat.st_mtime_ns)
+
+        removed = [name for name in self.entries if name not in current]
+        to_scan = [
+            name for name, info in current.items()
+            if name not in self.entries
+            or self.entries[name]["size"] != info["size"]
+            or self.entries[name]["mtime"] != info["mtime"]
+        ]
+
+        for name in removed:
+            del self.entries[name]
+
+        if to_scan:
+            print(f"Indexing {len(to_scan)} files of {self.directory}", end=" ")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                time_ranges = executor.map(
+                    lambda name: _read_time_range(self.directory / name, self.time_name), to_scan
+                )
+                for name, time_range in zip(to_scan, time_ranges):
+                    self.entries[name] = dict(**current[name], **time_range)
+            print("=> done.")
+
+        changed = bool(removed or to_scan)
+        if changed:
+            self._save()
+        return changed
+
+    def select(self, pattern: str = "", time: Optional[slice] = None) -> List[Path]:
+        """
+            Sorted paths of files whose name matches pattern and, if time is
+        given, that contain times in time slice.
+        """
+        names = [
+            name for name, entry in self.entries.items()
+            if re.search(pattern, name) is not None and (time is None or _overlaps(entry, time))
+        ]
+        return [self.directory / name for name in sorted(names)]
+
+    def time_index(self) -> pd.DataFrame:
+        """ Manifest as a table, sorted by starting time. """
+        df = pd.DataFrame.from_dict(self.entries, orient="index")
+        for col in ["time_start", "time_end"]:
+            df[col] = pd.to_datetime(df[col])
+        return df.sort_values("time_start")
@@ -0,0 +1,268 @@
+from typing import Callable, Dict, List, Optional
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import dataclasses
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from utilities.paths import paths
+from data.sources import DataSource
+from data.selection import Selection
+from data.getters import check_path_existence, input_signature
+
+PRODUCTS_PATH = paths.cache_path / "products"
+
+
+def _entry_hash(source: DataSource) -> str:
+    """ Hash of how a source is loaded and cleaned : a change means a full rebuild. """
+    description = json.dumps(
+        dict(
+            file_type=source.file_type,
+            file_path=str(source.file_path),
+            loading_kwargs=source.loading_kwargs,
+            cleaning=source.cleaning,
+            cleaning_kwargs=source.cleaning_kwargs,
+        ),
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+
+def monthly_mean(data: Dict[str, xr.Dataset], time_name="time") -> xr.Dataset:
+    """ Monthly means of the only input source (e.g. SYMPHONIE surface values). """
+    (ds,) = data.values()
+    return ds.resample({time_name: "1MS"}).mean()
+
+
+class DerivedProduct:
+    """
+        Product computed from DataSource entries (e.g. monthly surface means,
+    profiles, Hovmöller tables), stored as Zarr along with a record of what it
+    was built from : catalog entry, input files (names, sizes, modification
+    times), last input time and number of input times of each source.
+
+    When inputs change, update recomputes only what is needed :
+    - only new files / new times (including times appended to a used file) :
+      compute is called on new times only, and its result is appended to the
+      stored product. With several sources, only times up to the last one
+      common to all of them are used ;
+    - a used input file was removed or shrank, its times up to the last used
+      one changed, or a source entry changed : the product is built again from
+      scratch.
+
+    compute must be local in time : its output for some times depends only on
+    inputs of those times (e.g. per time step, or monthly means of whole months,
+    as model months are appended whole).
+    """
+
+    def __init__(
+            self,
+            name: str,
+            sources: List[str],
+            compute: Callable[[Dict[str, xr.Dataset]], xr.Dataset],
+            time_name: str = "time",
+            selection: Optional[Selection] = None,
+            location: Path = PRODUCTS_PATH,
+            loading_kwargs: Optional[dict] = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        name:           str
+                        Name of product.
+
+        sources:        list of str
+                        Names of input sources in information files.
+
+        compute:        callable
+                        Function of dict source name -> cleaned data, returning
+                        the product (with a time_name dimension, if inputs have one).
+
+        time_name:      str
+                        Name of time dimension of inputs and product.
+
+        selection:      Selection, optional.
+                        Selection of inputs (variables, bounding box, time range).
+
+        location:       Path
+                        Directory where products and their records are written.
+
+        loading_kwargs: dict, optional.
+                        Kwargs to pass to get_data of sources (e.g. access_pattern).
+        """
+        self.name = name
+        self.sources = list(sources)
+        self.compute = compute
+        self.time_name = time_name
+        self.selection = selection if selection is not None else Selection()
+        self.loading_kwargs = loading_kwargs or {}
+
+        self.store_path = Path(location) / f"{name}.zarr"
+        self.record_path = Path(location) / f"{name}.json"
+
+    # Record
+    # ------
+
+    def read_record(self) -> Optional[dict]:
+        if not self.record_path.is_file() or not self.store_path.exists():
+            return None
+        with open(self.record_path, "r") as f:
+            return json.load(f)
+
+    def _write_record(self, record: dict):
+        tmp_path = self.record_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(record, f, indent=1)
+        os.replace(tmp_path, self.record_path)
+
+    def _inputs(self, source: DataSource) -> Dict[str, list]:
+        """ Input file name -> (size, modification time) of source. """
+        path = check_path_existence(source.file_path)
+        return {name: [size, mtime] for name, size, mtime in input_signature(path)}
+
+    def _n_times_until(self, source: DataSource, time_end: str) -> int:
+        """ Number of times of source in selection, up to time_end (included). """
+        stop = pd.Timestamp(time_end)
+        start = None if self.selection.time is None else self.selection.time.start
+        ds = source.get_data(
+            selection=dataclasses.replace(self.selection, time=slice(start, stop)), **self.loading_kwargs
+        )
+        times = ds[self.time_name].values
+        return int((times <= np.datetime64(stop)).sum())
+
+    def _stale_reason(self, record: dict, sources: Dict[str, DataSource]) -> Optional[str]:
+        """
+            Why product must be built from scratch, if it must. A used input file
+        that only grew (e.g. a NetCDF file to which months are appended) does not
+        need a rebuild, as long as its times up to the last used one are the same.
+        """
+        for name, source in sources.items():
+            previous = record["sources"].get(name)
+            if previous is None:
+                return f"new input source {name}"
+            if "n_times" not in previous:
+                return "record of an older version"
+            if previous["entry"] != _entry_hash(source):
+                return f"entry of {name} changed"
+
+            current = self._inputs(source)
+            changed = [f for f, signature in previous["inputs"].items() if current.get(f) != signature]
+            for file_name in changed:
+                if file_name not in current:
+                    return f"input {file_name} of {name} removed"
+                if current[file_name][0] < previous["inputs"][file_name][0]:
+                    return f"input {file_name} of {name} shrank"
+            if changed and previous["time_end"] is None:
+                return f"static input {changed[0]} of {name} modified"
+            if changed and self._n_times_until(source, previous["time_end"]) != previous["n_times"]:
+                return f"times of {name} up to {previous['time_end']} modified"
+        return None
+
+    # Building
+    # --------
+
+    def _load_inputs(self, sources: Dict[str, DataSource], after: Optional[Dict[str, str]] = None):
+        """ Cleaned inputs, only with times strictly after given ones (if any). """
+        data = {}
+        for name, source in sources.items():
+            selection, start = self.selection, None
+            if after is not None and after.get(name) is not None:
+                start = pd.Timestamp(after[name])
+                if selection.time is not None and selection.time.start is not None:
+                    start = max(start, pd.Timestamp(selection.time.start))
+                stop = None if selection.time is None else selection.time.stop
+                selection = dataclasses.replace(selection, time=slice(start, stop))
+
+            # empty selection : nothing to push down to loaders (e.g. features tables)
+            ds = source.get_data(selection=None if selection.is_empty() else selection, **self.loading_kwargs)
+            if start is not None:  # label slices are inclusive
+                ds = ds.sel({self.time_name: ds[self.time_name] > np.datetime64(start)})
+            data[name] = ds
+        return data
+
+    def _write(self, product: xr.Dataset, append: bool):
+        product = product.copy()
+        for var in product.variables:
+            product[var].encoding = {}  # NetCDF encodings are not valid for Zarr
+        if product.chunks:
+            product = product.chunk({dim: max(c) for dim, c in product.chunks.items()})
+
+        if append:
+            product.to_zarr(self.store_path, append_dim=self.time_name, consolidated=True)
+            return
+
+        self.store_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.store_path.with_suffix(f".{os.getpid()}.tmp")
+        product.to_zarr(tmp_path, mode="w", consolidated=True)
+        if self.store_path.exists():
+            shutil.rmtree(self.store_path)
+        os.replace(tmp_path, self.store_path)
+
+    def update(self, rebuild: bool = False) -> xr.Dataset:
+        """
+            Bring product up to date with its inputs, computing only new times
+        when possible, and return it (lazily opened).
+        """
+        t0 = time.time()
+        sources = {name: DataSource(name) for name in self.sources}
+        record = None if rebuild else self.read_record()
+
+        if record is not None:
+            reason = self._stale_reason(record, sources)
+            if reason is not None:
+                print(f"Rebuilding {self.name} : {reason}.")
+                record = None
+
+        after = None if record is None else {n: record["sources"][n]["time_end"] for n in self.sources}
+        data = self._load_inputs(sources, after=after)
+
+        # static inputs (e.g. grids) have no time to update
+        timed = [name for name, ds in data.items() if self.time_name in getattr(ds, "dims", ())]
+        empty = [name for name in timed if data[name].sizes[self.time_name] == 0]
+        if record is not None and (not timed or empty):
+            if timed and len(empty) < len(timed):
+                print(f"No new times in {empty} : new times of other sources are added once they are there too.")
+            print(f"{self.name} is up to date.")
+            return xr.open_zarr(self.store_path)
+        if empty:
+            raise ValueError(f"No data in {empty} for {self.name}.")
+
+        # sources may have new times up to different dates : only common ones are used
+        time_end = None
+        if timed:
+            time_end = min(data[n][self.time_name].values.max() for n in timed)
+            for n in timed:
+                data[n] = data[n].sel({self.time_name: data[n][self.time_name] <= time_end})
+
+        product = self.compute(data)
+        self._write(product, append=record is not None)
+
+        def n_times(name):
+            previous = 0 if record is None else record["sources"][name]["n_times"]
+            return previous + data[name].sizes[self.time_name]
+
+        self._write_record(dict(
+            product=self.name,
+            updated=time.time(),
+            sources={
+                name: dict(
+                    entry=_entry_hash(sources[name]),
+                    inputs=self._inputs(sources[name]),
+                    time_end=str(pd.Timestamp(time_end)) if name in timed else None,
+                    n_times=n_times(name) if name in timed else None,
+                )
+                for name in self.sources
+            },
+        ))
+        action = "Built" if record is None else f"Appended {product.sizes[self.time_name]} times to"
+        print(f"{action} {self.name} in {time.time() - t0:.2f}s.")
+        return xr.open_zarr(self.store_path)
@@ -0,0 +1,207 @@
+from typing import Dict, List, Optional
+
+import os
+import json
+import time
+import shutil
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+try:
+    import zarr
+    from rechunker import rechunk
+except ModuleNotFoundError:  # RechunkedCopies.write raises if used
+    zarr = rechunk = None
+
+from utilities.paths import paths
+from utilities.func import check_matching
+from data.chunks import ACCESS_PATTERNS, TARGET_CHUNK_BYTES, plan_dataset_chunks
+from data.selection import Selection
+
+RECHUNKED_PATH = paths.cache_path / "rechunked"
+
+
+def bytes_read(ds: xr.Dataset) -> int:
+    """
+        Bytes read from store to compute (lazily opened, possibly selected) ds :
+    each dask chunk left after selection needs its whole store chunk.
+    """
+    total = 0
+    for var in ds.data_vars.values():
+        store_chunks = var.encoding.get("chunks")
+        if store_chunks is None or not hasattr(var.data, "npartitions"):
+            total += var.nbytes  # not chunked : read whole
+            continue
+        total += var.data.npartitions * int(np.prod(store_chunks)) * var.dtype.itemsize
+    return total
+
+
+class RechunkedCopies:
+    """
+        Copies of cleaned datasets, stored as Zarr with chunks planned for one
+    access pattern each (see data.chunks) : e.g. long time series at a few points
+    ("time-series") or full maps at a few times ("map").
+
+    Copies are written out-of-core with rechunker, so that memory is bounded
+    whatever the size of the source. Each copy is registered with the key of
+    cleaned data (see CleanedCache.key) : copies of modified inputs are ignored.
+    Among up to date copies, the one reading the fewest bytes for a selection
+    is used.
+    """
+
+    def __init__(self, location: Path = RECHUNKED_PATH):
+        """
+
+        Parameters
+        ----------
+        location:   Path
+                    Directory where copies are written, one sub-directory per source.
+        """
+        self.location = Path(location)
+
+    # Paths
+    # -----
+
+    def _store_path(self, source_name, access_pattern) -> Path:
+        return self.location / source_name / f"{access_pattern}.zarr"
+
+    def _registry_path(self, source_name) -> Path:
+        return self.location / source_name / "copies.json"
+
+    # Registry
+    # --------
+
+    def registry(self, source_name) -> Dict[str, dict]:
+        """ Access pattern -> information about the copy (key, chunks, size...). """
+        registry_path = self._registry_path(source_name)
+        if not registry_path.is_file():
+            return {}
+        with open(registry_path, "r") as f:
+            return json.load(f)
+
+    def _write_registry(self, source_name, registry: dict):
+        registry_path = self._registry_path(source_name)
+        tmp_path = registry_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(registry, f)
+        os.replace(tmp_path, registry_path)
+
+    def patterns(self, source_name, key) -> List[str]:
+        """ Access patterns of up to date copies of given source. """
+        return [p for p, info in self.registry(source_name).items() if info["key"] == key]
+
+    # Writing
+    # -------
+
+    def write(
+            self,
+            source_name,
+            key,
+            data: xr.Dataset,
+            access_pattern: str,
+            max_mem: str = "2GB",
+            target_bytes: float = TARGET_CHUNK_BYTES,
+    ) -> Path:
+        """
+            Write a copy of (lazy) cleaned data, with chunks planned for
+        access_pattern, and register it. Return path of the copy.
+
+        Parameters
+        ----------
+        source_name:    str
+                        Name of the source.
+
+        key:            str
+                        Key of cleaned data (see CleanedCache.key).
+
+        data:           xr.Dataset
+                        Cleaned data, lazily opened.
+
+        access_pattern: str
+                        "time-series", "map" or "profile".
+
+        max_mem:        str
+                        Maximum memory used by one rechunking task (e.g. "2GB").
+
+        target_bytes:   float
+                        Target size of one chunk of the copy, in bytes.
+        """
+        if rechunk is None:
+            raise ModuleNotFoundError("rechunker is needed to write rechunked copies.")
+        check_matching(access_pattern, ACCESS_PATTERNS, "access pattern")
+
+        store_path = self._store_path(source_name, access_pattern)
+        store_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = store_path.with_suffix(f".{os.getpid()}.tmp")
+        temp_store = store_path.with_suffix(f".{os.getpid()}.intermediate")
+
+        chunks = plan_dataset_chunks(data, access_pattern, target_bytes)
+
+        data = data.copy()
+        for var in data.variables:
+            data[var].encoding = {}  # NetCDF encodings are not valid for Zarr
+        if data.chunks:
+            # rechunker needs uniform source chunks
+            data = data.chunk({dim: max(c) for dim, c in data.chunks.items()})
+
+        print(f"Writing {access_pattern} copy of {source_name} (chunks : {chunks})", end=" ")
+        plan = rechunk(data, chunks, max_mem, str(tmp_path), temp_store=str(temp_store))
+        plan.execute()
+        zarr.consolidate_metadata(str(tmp_path))
+
+        shutil.rmtree(temp_store, ignore_errors=True)
+        if store_path.exists():
+            shutil.rmtree(store_path)
+        os.replace(tmp_path, store_path)
+        print("=> done.")
+
+        from data.getters import _directory_size  # data.getters imports this module
+
+        registry = self.registry(source_name)
+        registry[access_pattern] = dict(
+            key=key, chunks=chunks, created=time.time(), size=_directory_size(store_path)
+        )
+        self._write_registry(source_name, registry)
+        return store_path
+
+    # Access
+    # ------
+
+    def open(self, source_name, access_pattern) -> xr.Dataset:
+        return xr.open_zarr(self._store_path(source_name, access_pattern))
+
+    def best(self, source_name, key, selection: Optional[Selection] = None) -> Optional[xr.Dataset]:
+        """
+            Up to date copy of given source reading the fewest bytes for
+        selection, with selection applied. None if there is no such copy.
+        """
+        if selection is None:
+            selection = Selection()
+
+        candidates = []
+        for access_pattern in self.patterns(source_name, key):
+            ds = selection.apply(self.open(source_name, access_pattern))
+            candidates.append((bytes_read(ds), access_pattern, ds))
+        if not candidates:
+            return None
+
+        n_bytes, access_pattern, ds = min(candidates, key=lambda c: c[0])
+        print(f"Using {access_pattern} copy of {source_name} ({n_bytes / 1e6:.1f} MB to read).")
+        return ds
+
+    # Cleaning
+    # --------
+
+    def invalidate(self, source_name: str, access_pattern: Optional[str] = None):
+        """ Remove copy of given access pattern, or all copies of source if none given. """
+        registry = self.registry(source_name)
+        for pattern in list(registry):
+            if access_pattern is None or pattern == access_pattern:
+                del registry[pattern]  # first : copy is no more valid
+                self._write_registry(source_name, registry)
+                shutil.rmtree(self._store_path(source_name, pattern), ignore_errors=True)
+
+
+rechunked_copies = RechunkedCopies()
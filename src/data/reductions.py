@@ -0,0 +1,257 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+import os
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from utilities.paths import paths
+from utilities.func import check_matching
+
+CHECKPOINTS_PATH = paths.cache_path / "reductions"
+
+STATISTICS = ["mean", "std", "var", "min", "max", "count", "climatology"]
+N_MONTHS = 12
+
+
+class RunningStats:
+    """
+        Running count, mean, sum of squared deviations (M2), min and max of a
+    field along one dimension, updated in place one block of samples at a time.
+
+    Mean and M2 of a block are merged with Welford / Chan formulas, so that
+    the variance stays accurate over long series. NaN samples are ignored.
+    """
+
+    fields = ["count", "mean", "m2", "min", "max"]
+
+    def __init__(self, shape: Tuple[int, ...]):
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def update(self, block: np.ndarray, axis: int = 0):
+        """ Add samples of block, along given axis. """
+        valid = ~np.isnan(block)
+        n_b = valid.sum(axis=axis)
+        if not n_b.any():
+            return
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_b = np.where(n_b > 0, np.nansum(block, axis=axis) / n_b, 0)
+            deviations = np.where(valid, block - np.expand_dims(mean_b, axis), 0)
+            m2_b = (deviations ** 2).sum(axis=axis)
+
+            n = self.count + n_b
+            delta = mean_b - self.mean
+            self.mean += np.where(n > 0, delta * n_b / n, 0)
+            self.m2 += m2_b + np.where(n > 0, delta ** 2 * self.count * n_b / n, 0)
+        self.count = n
+
+        np.fmin(self.min, np.nanmin(np.where(valid, block, np.inf), axis=axis), out=self.min)
+        np.fmax(self.max, np.nanmax(np.where(valid, block, -np.inf), axis=axis), out=self.max)
+
+    def statistic(self, name: str, ddof: int = 0) -> np.ndarray:
+        empty = self.count == 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if name == "count":
+                return self.count
+            if name == "mean":
+                return np.where(empty, np.nan, self.mean)
+            if name in ["var", "std"]:
+                var = np.where(self.count > ddof, self.m2 / (self.count - ddof), np.nan)
+                return np.sqrt(var) if name == "std" else var
+            if name in ["min", "max"]:
+                return np.where(empty, np.nan, getattr(self, name))
+        raise KeyError(f"Unknown statistic <{name}>.")
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {f: getattr(self, f) for f in self.fields}
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        for f in self.fields:
+            setattr(self, f, state[f])
+
+
+class StreamingReduction:
+    """
+        Statistics of variables of a dataset along one dimension (time by
+    default), computed by walking its chunks in order : only one chunk is in
+    memory at a time, whatever the length of the series, and no large dask graph
+    is built.
+
+    Partial state can be written to a checkpoint file every few chunks, so that
+    a reduction killed (e.g. at the end of a SLURM walltime) resumes from its
+    last checkpoint.
+    """
+
+    def __init__(
+            self,
+            data: xr.Dataset,
+            variables: Optional[Iterable[str]] = None,
+            dim: str = "time",
+            statistics: Iterable[str] = ("mean", "std"),
+            ddof: int = 0,
+            checkpoint: Optional[Path] = None,
+            checkpoint_every: int = 10,
+    ):
+        """
+
+        Parameters
+        ----------
+        data:               xr.Dataset
+                            Data to reduce, lazily opened (chunks are walked in order).
+
+        variables:          iterable of str, optional.
+                            Variables to reduce. Default to all those with dim.
+
+        dim:                str
+                            Dimension to reduce.
+
+        statistics:         iterable of str
+                            Among "mean", "std", "var", "min", "max", "count" and
+                            "climatology" (monthly means, dim must be time).
+
+        ddof:               int
+                            Delta degrees of freedom of std and var.
+
+        checkpoint:         Path, optional.
+                            File where partial state is written, and read from
+                            when the reduction is started again.
+
+        checkpoint_every:   int
+                            Number of chunks between two checkpoints.
+        """
+        for stat in statistics:
+            check_matching(stat, STATISTICS, "statistic")
+        if variables is None:
+            variables = [v for v in data.data_vars if dim in data[v].dims]
+
+        self.data = data[list(variables)]
+        self.variables = list(variables)
+        self.dim = dim
+        self.statistics = list(statistics)
+        self.ddof = ddof
+        self.checkpoint = None if checkpoint is None else Path(checkpoint)
+        self.checkpoint_every = checkpoint_every
+
+        # blocks follow chunks of reduced variables only (other variables may be
+        # chunked differently, or not at all)
+        chunksizes = self.data[self.variables[0]].chunksizes if self.variables else {}
+        sizes = chunksizes.get(dim, (self.data.sizes[dim],))
+        bounds = np.cumsum((0,) + tuple(sizes))
+        self.blocks = list(zip(bounds[:-1], bounds[1:]))
+        self.next_block = 0
+
+        self._templates = {v: self.data[v].isel({dim: 0}, drop=True) for v in self.variables}
+        shapes = {v: self._templates[v].shape for v in self.variables}
+        self.stats = {v: RunningStats(shapes[v]) for v in self.variables}
+        self.monthly = {}
+        if "climatology" in self.statistics:
+            self.monthly = {v: RunningStats((N_MONTHS,) + shapes[v]) for v in self.variables}
+
+    # Checkpoints
+    # -----------
+
+    def _description(self) -> str:
+        """ What is reduced : a checkpoint of another reduction is never resumed. """
+        return json.dumps(dict(
+            variables=self.variables,
+            dim=self.dim,
+            statistics=self.statistics,
+            blocks=[[int(a), int(b)] for a, b in self.blocks],
+            first=str(self.data[self.dim].values[0]),
+            last=str(self.data[self.dim].values[-1]),
+        ))
+
+    def save_checkpoint(self):
+        arrays = {"description": np.array(self._description()), "next_block": np.array(self.next_block)}
+        for group, accumulators in [("stats", self.stats), ("monthly", self.monthly)]:
+            for var, acc in accumulators.items():
+                arrays.update({f"{group}/{var}/{f}": it for f, it in acc.state().items()})
+
+        self.checkpoint.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.checkpoint.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.checkpoint)
+
+    def load_checkpoint(self) -> bool:
+        """ Restore partial state from checkpoint. Return whether it was restored. """
+        if self.checkpoint is None or not self.checkpoint.is_file():
+            return False
+        with np.load(self.checkpoint) as saved:
+            if str(saved["description"]) != self._description():
+                print(f"Checkpoint {self.checkpoint} is of another reduction : starting from scratch.")
+                return False
+            for group, accumulators in [("stats", self.stats), ("monthly", self.monthly)]:
+                for var, acc in accumulators.items():
+                    acc.set_state({f: saved[f"{group}/{var}/{f}"] for f in acc.fields})
+            self.next_block = int(saved["next_block"])
+        print(f"Resuming reduction at chunk {self.next_block} / {len(self.blocks)}.")
+        return True
+
+    # Reduction
+    # ---------
+
+    def _update(self, block: xr.Dataset):
+        months = None
+        if self.monthly:
+            months = pd.DatetimeIndex(block[self.dim].values).month.values - 1
+
+        for var in self.variables:
+            values = block[var].transpose(self.dim, ...).values.astype(float)
+            self.stats[var].update(values, axis=0)
+            if months is None:
+                continue
+            for month in np.unique(months):
+                monthly = RunningStats(values.shape[1:])
+                monthly.set_state({f: it[month] for f, it in self.monthly[var].state().items()})
+                monthly.update(values[months == month], axis=0)
+                for f, it in monthly.state().items():
+                    getattr(self.monthly[var], f)[month] = it
+
+    def run(self) -> Dict[str, xr.Dataset]:
+        """ Walk remaining chunks, then return statistics (see result). """
+        self.load_checkpoint()
+        t0 = time.time()
+        for n in range(self.next_block, len(self.blocks)):
+            start, stop = self.blocks[n]
+            self._update(self.data.isel({self.dim: slice(start, stop)}).compute())
+            self.next_block = n + 1
+            if self.checkpoint is not None and (self.next_block % self.checkpoint_every == 0):
+                self.save_checkpoint()
+        if self.checkpoint is not None:
+            self.save_checkpoint()
+        print(f"Reduced {len(self.blocks)} chunks along {self.dim} in {time.time() - t0:.2f}s.")
+        return self.result()
+
+    def _as_dataset(self, arrays: Dict[str, np.ndarray], month=False) -> xr.Dataset:
+        out = {}
+        for var, values in arrays.items():
+            template = self._templates[var]
+            if month:
+                out[var] = xr.DataArray(
+                    values, dims=("month",) + template.dims,
+                    coords={**template.coords, "month": np.arange(1, N_MONTHS + 1)},
+                )
+            else:
+                out[var] = template.copy(data=values)
+        return xr.Dataset(out)
+
+    def result(self) -> Dict[str, xr.Dataset]:
+        """ Statistic name -> Dataset of reduced variables (month dimension for climatology). """
+        out = {}
+        for stat in self.statistics:
+            if stat == "climatology":
+                out[stat] = self._as_dataset(
+                    {v: acc.statistic("mean") for v, acc in self.monthly.items()}, month=True
+                )
+            else:
+                out[stat] = self._as_dataset({v: acc.statistic(stat, self.ddof) for v, acc in self.stats.items()})
+        return out
@@ -0,0 +1,159 @@
+from typing import List, Optional
+
+import os
+import json
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from kerchunk.hdf import SingleHdf5ToZarr
+    from kerchunk.combine import MultiZarrToZarr
+except ModuleNotFoundError:  # ReferenceIndex raises if used
+    SingleHdf5ToZarr = MultiZarrToZarr = None
+
+from utilities.paths import paths
+from data.manifest import MFDManifest
+
+REFERENCES_PATH = paths.cache_path / "references"
+
+
+def _dump_json(data: dict, path: Path):
+    """ Write to a temporary file first so that a reference file is never half-written. """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _load_json(path: Path) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class ReferenceIndex:
+    """
+        Virtual Zarr view of a directory of NetCDF4 / HDF5 files : each variable
+    chunk is mapped to its byte range in the original files (kerchunk references).
+
+    References of each file are built once and kept as long as the file is not
+    modified ; combining them into one index only reads these small JSON files.
+    """
+
+    def __init__(
+            self,
+            directory: Path,
+            concat_dim: str = "time",
+            location: Path = REFERENCES_PATH,
+            max_workers: int = 8,
+    ):
+        """
+
+        Parameters
+        ----------
+        directory:      Path
+                        Directory of files.
+
+        concat_dim:     str
+                        Dimension along which files are concatenated.
+
+        location:       Path
+                        Directory where references are saved.
+
+        max_workers:    int
+                        Number of files indexed at the same time.
+        """
+        if SingleHdf5ToZarr is None:
+            raise ModuleNotFoundError("kerchunk is needed to build reference indexes.")
+
+        self.directory = Path(directory)
+        self.concat_dim = concat_dim
+        self.max_workers = max_workers
+
+        directory_hash = hashlib.sha1(str(self.directory.resolve()).encode()).hexdigest()[:12]
+        self.location = Path(location) / f"{self.directory.name}_{directory_hash}"
+
+        # Compressed files can not be referenced : only NetCDF4 / HDF5 ones are indexed
+        self.manifest = MFDManifest(self.directory, file_endings=(".nc",), time_name=concat_dim)
+
+    def _file_reference_path(self, name: str) -> Path:
+        entry = self.manifest.entries[name]
+        return self.location / "files" / f"{name}_{entry['size']}_{entry['mtime']}.json"
+
+    def _build_file_reference(self, name: str) -> Path:
+        reference_path = self._file_reference_path(name)
+        if not reference_path.is_file():
+            file_path = self.directory / name
+            with open(file_path, "rb") as f:
+                references = SingleHdf5ToZarr(f, str(file_path), inline_threshold=0).translate()
+            _dump_json(references, reference_path)
+        return reference_path
+
+    def _clean_files(self, keep: List[Path]):
+        """ Remove references of modified or removed files. """
+        files_location = self.location / "files"
+        if not files_location.is_dir():
+            return
+        for f in files_location.iterdir():
+            if f not in keep:
+                f.unlink()
+
+    def _clean_combined(self, keep: List[Path]):
+        """
+            Remove combined references of which an input file reference is not in
+        keep (its file was modified or removed), with the list of their inputs.
+        """
+        if not self.location.is_dir():
+            return
+        keep = {r.name for r in keep}
+        for combined_path in self.location.glob("combined_*.json"):
+            inputs_path = combined_path.with_suffix(".inputs")
+            if not inputs_path.is_file() or not set(_load_json(inputs_path)) <= keep:
+                combined_path.unlink(missing_ok=True)
+                inputs_path.unlink(missing_ok=True)
+        for inputs_path in self.location.glob("combined_*.inputs"):
+            if not inputs_path.with_suffix(".json").is_file():
+                inputs_path.unlink(missing_ok=True)
+
+    def build(self, filtering_pattern: str = "", time: Optional[slice] = None) -> Path:
+        """
+            Build (or reuse) combined references of files matching filtering_pattern
+        and overlapping time slice. Return path of combined reference file.
+        """
+        self.manifest.update()
+        files = self.manifest.select(pattern=filtering_pattern, time=time)
+        if not files:
+            raise FileNotFoundError(
+                f"No file in location {self.directory} matching '{filtering_pattern}' (time: {time})."
+            )
+
+        all_references = [self._file_reference_path(name) for name in self.manifest.entries]
+        self._clean_files(keep=all_references)
+        self._clean_combined(keep=all_references)
+
+        references = [self._file_reference_path(f.name) for f in files]
+        key = hashlib.sha1("".join(r.name for r in references).encode()).hexdigest()[:16]
+        combined_path = self.location / f"combined_{key}.json"
+        if combined_path.is_file():
+            return combined_path
+
+        to_build = [f.name for f, r in zip(files, references) if not r.is_file()]
+        if to_build:
+            print(f"Building references of {len(to_build)} files of {self.directory}", end=" ")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(self._build_file_reference, to_build))
+            print("=> done.")
+
+        combined = MultiZarrToZarr(
+            [_load_json(r) for r in references],
+            concat_dims=[self.concat_dim],
+            coo_map={self.concat_dim: f"cf:{self.concat_dim}"},  # files may have different time units
+            remote_protocol="file",
+        ).translate()
+
+        # combined files of other selections are kept as long as all their files are
+        # unchanged : inputs are written first, so that a combined file always has them
+        _dump_json([r.name for r in references], combined_path.with_suffix(".inputs"))
+        _dump_json(combined, combined_path)
+        return combined_path
@@ -0,0 +1,80 @@
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from dataclasses import dataclass
+
+import numpy as np
+import xarray as xr
+
+TIME_NAME = "time"
+
+
+@dataclass(frozen=True)
+class Selection:
+    """
+        Subset of a source to load : time range, longitude / latitude bounding
+    box and variables. Names are those of cleaned data (e.g. "tem", "lon_t").
+
+    Time and variables are pushed down to loaders (files pruning, dropped
+    variables) ; the bounding box is applied lazily right after cleaning, since
+    raw horizontal coordinates of some sources are only indices.
+    """
+
+    time: Optional[slice] = None
+    lon: Optional[Tuple[float, float]] = None  # (min, max)
+    lat: Optional[Tuple[float, float]] = None  # (min, max)
+    variables: Optional[Tuple[str, ...]] = None
+
+    def __post_init__(self):
+        if self.variables is not None and isinstance(self.variables, str):
+            object.__setattr__(self, "variables", (self.variables,))
+        elif self.variables is not None:
+            object.__setattr__(self, "variables", tuple(self.variables))
+
+    def is_empty(self) -> bool:
+        return self.time is None and self.lon is None and self.lat is None and self.variables is None
+
+    def raw_variables(self, renaming: dict) -> Optional[List[str]]:
+        """ Names of selected variables before cleaning, given cleaner renaming (raw -> clean). """
+        if self.variables is None:
+            return None
+        inverse = {clean: raw for raw, clean in renaming.items()}
+        return [inverse.get(v, v) for v in self.variables]
+
+    def apply(self, ds: xr.Dataset) -> xr.Dataset:
+        """ Select time range, bounding box and variables of a cleaned dataset. """
+        if self.variables is not None:
+            # depth fields are kept, as they are needed to interpolate variables
+            depths = [v for v in ds.data_vars if v[:5] == "depth" and v not in self.variables]
+            ds = ds[list(self.variables) + depths]
+        if self.time is not None and TIME_NAME in ds.dims:
+            ds = ds.sel({TIME_NAME: self.time})
+
+        for prefix, bounds in [("lon", self.lon), ("lat", self.lat)]:
+            if bounds is None:
+                continue
+            for dim in ds.dims:
+                if dim.split("_")[0] == prefix and dim in ds.coords:
+                    ds = ds.sel({dim: _bounds_slice(ds[dim].values, bounds)})
+        return ds
+
+
+def _bounds_slice(values: np.ndarray, bounds: Tuple[float, float]) -> slice:
+    """ Label slice between bounds, following the order of coordinate values. """
+    lower, upper = min(bounds), max(bounds)
+    if values.size > 1 and values[0] > values[-1]:
+        return slice(upper, lower)
+    return slice(lower, upper)
+
+
+def variables_to_drop(
+        open_function: Callable[..., xr.Dataset],
+        path,
+        variables: Iterable[str],
+        **kwargs,
+) -> List[str]:
+    """
+        Names of data variables, other than given ones, of dataset at path.
+    Only metadata are read : dataset is opened without chunks then closed.
+    """
+    with open_function(path, chunks=None, **kwargs) as ds:
+        return [v for v in ds.data_vars if v not in variables]
@@ -1,15 +1,25 @@
-from typing import Optional, List
+from typing import Optional, List, Dict
 
+import time
+import json
 import yaml
 from pathlib import Path
 from copy import deepcopy
 from functools import singledispatch
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 
-from data.getters import DataGetter
+from data.getters import DataGetter, cleaned_cache, check_path_existence, input_signature
+from data.rechunked import rechunked_copies
+from data.reductions import StreamingReduction, CHECKPOINTS_PATH
+from data.selection import Selection
+from data.catalog import get_catalog
 
 from utilities.paths import paths
+from utilities.zones import get_zone_masks, zone_masks_as_dataarray
+from utilities.static_fields import StaticFields, write_static_fields
 
 default_information_location = paths.config_path / "data_sources"
+STATIC_FIELDS_PATH = paths.cache_path / "static_fields"
 
 
 def check_validity(information: dict, values_to_check) -> bool:
@@ -59,9 +69,9 @@ def load_yaml_file(info_file: str, info_location: Path) -> dict:
 
 
 def open_multiple_yaml_files(location: Path) -> dict:
-    # TODO : make it being called only once
     """
     Open and merge into one dict all .yml files at given location.
+    Files are only parsed once per process (see data.catalog).
 
     Parameters
     ----------
@@ -72,20 +82,7 @@ def open_multiple_yaml_files(location: Path) -> dict:
 
     Dict of merged files.
     """
-    # Get files to process
-    list_of_files = [f for f in location.iterdir() if f.suffix == ".yml"]
-
-    # Merge dicts
-    dic = {}
-    for file_name in list_of_files:
-        with open(file_name, "r") as f:
-            tmp_dic = yaml.safe_load(f)
-
-            if tmp_dic is None:  # empty file
-                tmp_dic = {}
-            dic.update(tmp_dic)
-
-    return dic
+    return get_catalog(location).to_dict()
 
 
 # %%
@@ -112,6 +109,7 @@ class DataSource:
         """
 
         # Instantiate important attributes, for clarity
+        self.info_file_name = info_file_name  # key of the source in information files
         self.name = None
         self.file_type = None
         self.file_path = None
@@ -123,9 +121,11 @@ class DataSource:
         self.cleaning = None
         self.loading_kwargs = {}
         self.cleaning_kwargs = {}
+        self.cache = False  # whether to keep cleaned data in cache (see data.getters)
+        self.rechunked = False  # whether to read rechunked copies, if any (see data.rechunked)
 
         # Load info
-        info = open_multiple_yaml_files(info_location)[info_file_name]
+        info = get_catalog(info_location)[info_file_name]
         # check_validity(info, need_to_be)  # check that no data_sources is missing
         # => Not working as I intended : not all attributes are necessary but var(.)
         # => load them all.
@@ -136,20 +136,147 @@ class DataSource:
             setattr(self, entry, value)
 
         self.d = None  # actual data
+        self.loading_time = None  # in seconds, set by get_data
 
         if filtering_pattern is not None:
             self.get_data(filtering_pattern)
 
-    def get_data(self, filtering_pattern=""):
-        """ Actually load data in attribute .d using given path."""
-        print("Loading", self.name, end=" ")
+    def get_data(
+            self,
+            filtering_pattern="",
+            use_cache: Optional[bool] = None,
+            selection: Optional[Selection] = None,
+            access_pattern: Optional[str] = None,
+            use_copies: Optional[bool] = None,
+    ):
+        """
+        Actually load data in attribute .d using given path.
+
+        Parameters
+        ----------
+        filtering_pattern:  str
+                            Pattern of files to load (multiple files data only).
+
+        use_cache:          bool, optional.
+                            Whether to use cache of cleaned data. Default to
+                            "cache" entry of information file (False if none).
+
+        selection:          Selection, optional.
+                            Time range, bounding box and variables to load
+                            (see DataGetter.get).
+
+        access_pattern:     str, optional.
+                            "time-series", "map" or "profile" : chunks are planned
+                            for this access (see data.chunks). Default to
+                            "access_pattern" loading kwarg of information file, if any.
+
+        use_copies:         bool, optional.
+                            Whether to read the best rechunked copy for selection,
+                            if any. Default to "rechunked" entry of information file
+                            (False if none).
+        """
+        if use_cache is None:
+            use_cache = self.cache
+        if use_copies is None:
+            use_copies = self.rechunked
+
+        loading_kwargs = dict(self.loading_kwargs)
+        if access_pattern is not None:
+            loading_kwargs["access_pattern"] = access_pattern
+
+        print("Loading", self.name)
+        t0 = time.time()
         d = DataGetter(
-            self.file_type, self.cleaning, self.loading_kwargs, self.cleaning_kwargs
-        ).get(self.file_path, filtering_pattern=filtering_pattern)
-        print("=> done.")
+            self.file_type,
+            self.cleaning,
+            loading_kwargs,
+            self.cleaning_kwargs,
+            name=self.info_file_name,
+            cache=cleaned_cache if use_cache else None,
+            copies=rechunked_copies if use_copies else None,
+        ).get(self.file_path, filtering_pattern=filtering_pattern, selection=selection)
+        self.loading_time = time.time() - t0
+        print(f"=> {self.name} done in {self.loading_time:.2f}s.")
         self.d = d
         return d
 
+    def invalidate_cache(self):
+        """ Remove all cached cleaned data of this source. """
+        cleaned_cache.invalidate(self.info_file_name)
+
+    def write_rechunked_copy(self, access_pattern: str, filtering_pattern="", **kwargs):
+        """
+            Write a copy of all cleaned data of this source, rechunked for
+        access_pattern ("time-series", "map" or "profile"). Memory is bounded by
+        max_mem kwarg (see RechunkedCopies.write). Copies are then used by
+        get_data if use_copies is True.
+        """
+        print("Rechunking", self.name)
+        return DataGetter(
+            self.file_type,
+            self.cleaning,
+            dict(self.loading_kwargs),
+            self.cleaning_kwargs,
+            name=self.info_file_name,
+            copies=rechunked_copies,
+        ).write_copy(self.file_path, access_pattern, filtering_pattern=filtering_pattern, **kwargs)
+
+    def invalidate_rechunked_copies(self, access_pattern: Optional[str] = None):
+        """ Remove rechunked copies of this source (of one access pattern only, if given). """
+        rechunked_copies.invalidate(self.info_file_name, access_pattern)
+
+    def reduce_streaming(
+            self,
+            statistics=("mean", "std"),
+            variables=None,
+            dim="time",
+            selection: Optional[Selection] = None,
+            checkpoint=False,
+            **kwargs
+    ) -> Dict:
+        """
+            Statistics of data along dim (see data.reductions.STATISTICS),
+        computed chunk after chunk, in order, with bounded memory. Data are
+        loaded first (with given selection) if not already.
+
+        Parameters
+        ----------
+        statistics: iterable of str
+                    Statistics to compute, e.g. ("mean", "std", "climatology").
+
+        variables:  iterable of str, optional.
+                    Variables to reduce. Default to all those with dim.
+
+        dim:        str
+                    Dimension to reduce.
+
+        selection:  Selection, optional.
+                    Selection used if data are not loaded yet.
+
+        checkpoint: bool or Path, default: False
+                    Checkpoint file of partial state, to resume a killed reduction.
+                    If True, a file named after the source and dim is used.
+
+        kwargs:     dict
+                    Kwargs passed to StreamingReduction (ddof, checkpoint_every).
+
+        Returns
+        -------
+        Dict of statistic name -> Dataset.
+        """
+        if self.d is None:
+            self.get_data(selection=selection)
+        if checkpoint is True:
+            checkpoint = CHECKPOINTS_PATH / f"{self.info_file_name}_{dim}.npz"
+        return StreamingReduction(
+            self.d,
+            variables=variables,
+            dim=dim,
+            statistics=statistics,
+            checkpoint=checkpoint or None,
+            **kwargs
+        ).run()
+
     # Manipulation
     # ------------
 
@@ -220,7 +347,49 @@ def get_dataset(name: str, filtering_pattern: str):
     return DataSource(name, filtering_pattern).d
 
 
-def create_sources(*names, info_location=default_information_location, gridded=False):
+def create_sources(
+        *names,
+        info_location=default_information_location,
+        gridded=False,
+        load=False,
+        filtering_pattern="",
+        max_workers=1,
+        selection: Optional[Selection] = None,
+        access_pattern: Optional[str] = None,
+):
+    """
+    Create one source per given name.
+
+    Parameters
+    ----------
+    names:              str
+                        Names of sources in information files.
+
+    info_location:      Path
+                        Path to directory where .yml information files are stored.
+
+    gridded:            bool, default: False
+                        Whether to create GriddedSource or DataSource objects.
+
+    load:               bool, default: False
+                        Whether to directly load data of created sources.
+
+    filtering_pattern:  str
+                        Filtering pattern used if load is True.
+
+    max_workers:        int, default: 1
+                        Number of sources loaded concurrently if load is True.
+
+    selection:          Selection, optional.
+                        Selection used if load is True.
+
+    access_pattern:     str, optional.
+                        Access pattern used if load is True (see DataSource.get_data).
+
+    Returns
+    -------
+    One source if only one name is given, list of sources otherwise.
+    """
     out = []
     for nm in names:
         if not gridded:
@@ -229,6 +398,12 @@ def create_sources(*names, info_location=default_information_location, gridded=F
             dts = GriddedSource(nm, info_location=info_location)
         out.append(dts)
 
+    if load:
+        load_sources(
+            out, filtering_pattern=filtering_pattern, max_workers=max_workers,
+            selection=selection, access_pattern=access_pattern,
+        )
+
     if len(out) == 1:
         out = out[0]
 
@@ -239,9 +414,99 @@ def load_source(sources: DataSource, filtering_pattern: str = ""):
     sources.get_data(filtering_pattern=filtering_pattern)
 
 
-def load_sources(sources: List[DataSource], filtering_pattern: str = ""):
+def submit_sources(
+        sources: List[DataSource],
+        filtering_pattern: str = "",
+        max_workers: int = 4,
+        executor: Optional[ThreadPoolExecutor] = None,
+        selection: Optional[Selection] = None,
+        access_pattern: Optional[str] = None,
+) -> Dict[str, Future]:
+    """
+        Start loading given sources concurrently, and return immediately.
+    Loading is done in threads : opening files and cleaning mostly wait for I/O
+    and are lazy (dask) for big datasets.
+
+    Returned futures are indexed by source key (info_file_name), so that a script
+    can wait only for sources it needs next :
+
+    >>> futures = submit_sources([ostia, grid, t0])
+    >>> ostia_data = futures["OSTIA_monthly"].result()
+
+    Parameters
+    ----------
+    sources:            list of DataSource
+                        Sources to load.
+
+    filtering_pattern:  str
+                        Filtering pattern passed to each get_data.
+
+    max_workers:        int, default: 4
+                        Maximum number of sources loaded at the same time.
+
+    executor:           ThreadPoolExecutor, optional.
+                        Executor to use. If not given, a new one is created and
+                        shut down (without waiting) once all tasks are submitted.
+
+    selection:          Selection, optional.
+                        Selection passed to each get_data.
+
+    access_pattern:     str, optional.
+                        Access pattern passed to each get_data.
+
+    Returns
+    -------
+    Dict of futures, whose results are loaded data.
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="load_source")
+
+    futures = {
+        sr.info_file_name: executor.submit(
+            sr.get_data,
+            filtering_pattern=filtering_pattern,
+            selection=selection,
+            access_pattern=access_pattern,
+        )
+        for sr in sources
+    }
+
+    if own_executor:
+        executor.shutdown(wait=False)  # tasks already submitted still run
+
+    return futures
+
+
+def load_sources(
+        sources: List[DataSource],
+        filtering_pattern: str = "",
+        max_workers: int = 1,
+        selection: Optional[Selection] = None,
+        access_pattern: Optional[str] = None,
+):
+    """
+        Load data of given sources, one after another if max_workers is 1,
+    concurrently otherwise. Print loading time of each source.
+    """
+    if max_workers <= 1:
+        for sr in sources:
+            sr.get_data(
+                filtering_pattern=filtering_pattern, selection=selection, access_pattern=access_pattern
+            )
+        return
+
+    t0 = time.time()
+    futures = submit_sources(
+        sources, filtering_pattern=filtering_pattern, max_workers=max_workers,
+        selection=selection, access_pattern=access_pattern,
+    )
+    for future in as_completed(futures.values()):
+        future.result()  # raise loading errors, if any
+
+    print(f"Loaded {len(sources)} sources in {time.time() - t0:.2f}s :")
     for sr in sources:
-        sr.get_data(filtering_pattern=filtering_pattern)
+        print(f"  - {sr.info_file_name} : {sr.loading_time:.2f}s")
 
 
 # %%
@@ -251,9 +516,56 @@ class GriddedSource(DataSource):
 
     lon_t = None
     lat_t = None
+    static_fields = None  # memory-mapped static fields of grid sources (see get_static_fields)
+
+    def _static_signature(self) -> list:
+        """ Input files and cleaning of source : static fields are exported again if they change. """
+        path = check_path_existence(self.file_path)
+        signature = [input_signature(path), self.cleaning, self.cleaning_kwargs]
+        return json.loads(json.dumps(signature, default=str))  # as read back from header
+
+    def get_static_fields(self, rebuild: bool = False) -> StaticFields:
+        """
+            Time-independent variables of a grid source (coordinates, bathymetry,
+        depths, masks), exported once to a memory-mapped file (see
+        utilities.static_fields). Arrays are then zero-copy views of this file,
+        shared by all processes, without opening nor cleaning the grid again.
+        """
+        if self.static_fields is not None and not rebuild:
+            return self.static_fields
+
+        path = STATIC_FIELDS_PATH / f"{self.info_file_name}.bin"
+        signature = self._static_signature()
+        if not rebuild and path.is_file():
+            store = StaticFields(path)
+            if store.attrs.get("signature") == signature:
+                self.static_fields = store
+                return store
+
+        d = self.d if self.d is not None else self.get_data()
+        fields = {
+            name: (list(var.dims), var.values)
+            for name, var in d.variables.items()
+            if "time" not in var.dims and var.dtype.kind in "biuf"
+        }
+        print(f"Exporting static fields of {self.info_file_name} to {path}")
+        write_static_fields(path, fields, attrs=dict(signature=signature))
+        self.static_fields = StaticFields(path)
+        return self.static_fields
+
+    def get_bathymetry(self, name="hm_w"):
+        """ Bathymetry (maximum depth) of a grid source, as a read-only memory-mapped DataArray. """
+        return self.get_static_fields().dataarray(name)
 
     def _get_space_coord(self, coord, index_name, var_type="t"):
 
+        if self.d is None and self.data_type == "grid":
+            # read from memory-mapped static fields, without loading grid
+            static_fields = self.get_static_fields()
+            for name in [f"{coord}_{var_type}", coord]:
+                if name in static_fields:
+                    return static_fields.dataarray(name)
+
         if self.d is None:
             self.get_data()
 
@@ -297,3 +609,13 @@ class GriddedSource(DataSource):
             )
 
         return getattr(self, attr_name)
+
+    def get_zone_masks(self, zones: List[str], var_type="t", use_cache=True):
+        """
+        Masks of given zones on the grid of the source, as a (zone, lat, lon) DataArray.
+        """
+        lon, lat = self.get_lon(var_type=var_type), self.get_lat(var_type=var_type)
+        masks = get_zone_masks(
+            zones, lon.values, lat.values, grid_name=self.info_file_name, use_cache=use_cache
+        )
+        return zone_masks_as_dataarray(masks, lon, lat)
@@ -0,0 +1,240 @@
+from typing import Dict, Iterable, Optional
+
+import json
+import inspect
+import functools
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from data.selection import Selection
+from data.products import DerivedProduct
+
+from utilities.paths import paths
+from utilities.zones import get_zone_bbox, get_zone_polygon, get_zone_masks, zone_masks_as_dataarray, hash_arrays
+from utilities.interpolation import VerticalInterpolator
+
+HOVMOLLERS_PATH = paths.cache_path / "hovmollers"
+
+DEFAULT_DEPTHS = np.linspace(0, 500, 100)
+FLAT_TOLERANCE = 1e-3  # in m : levels closer than this in all columns are flat
+
+
+def _vertical_dim(depth: xr.DataArray, horizontal) -> str:
+    (z_dim,) = [d for d in depth.dims if d not in horizontal]
+    return z_dim
+
+
+def levels_are_flat(depth: xr.DataArray, horizontal, mask: Optional[xr.DataArray] = None) -> bool:
+    """
+        Whether each level has the same depth in all (masked) columns, as on
+    z-levels grids (e.g. GLORYS), but not on s / VQS grids (e.g. SYMPHONIE).
+    """
+    if not set(horizontal) & set(depth.dims):
+        return True
+    if mask is not None:
+        depth = depth.where(mask)
+    spread = depth.max(horizontal) - depth.min(horizontal)
+    return bool((spread.fillna(0) <= FLAT_TOLERANCE).all())
+
+
+def hovmoller(
+        ds: xr.Dataset,
+        var: str,
+        depths: np.ndarray = DEFAULT_DEPTHS,
+        mask: Optional[xr.DataArray] = None,
+        depth_var: str = "depth_t",
+        horizontal=("lat_t", "lon_t"),
+        h_sign=1,
+        method="linear",
+        depth_name="depth",
+) -> xr.DataArray:
+    """
+        (time, depth) horizontal mean of var over (masked) columns, on given
+    depth levels.
+
+    When levels are flat (see levels_are_flat), vertical interpolation has the
+    same weights in all columns : the horizontal mean is taken first, and only
+    one profile per timestep is interpolated. Otherwise, only masked columns are
+    interpolated, then averaged.
+
+    Parameters
+    ----------
+    ds:         xr.Dataset
+                Dataset with var and depth_var.
+
+    var:        str
+                Name of variable, e.g. "sal".
+
+    depths:     np.ndarray
+                Depth levels of output.
+
+    mask:       xr.DataArray, optional.
+                Boolean horizontal mask of columns to average. Default to all.
+
+    depth_var:  str
+                Name of depth of each point of var (1-D on z-levels grids).
+
+    horizontal: tuple of str
+                Horizontal dimensions of var.
+
+    h_sign:     int
+                Sign convention of output levels (see interp_variable).
+
+    method:     str, default: "linear"
+                Vertical interpolation method (see VerticalInterpolator).
+
+    depth_name: str
+                Name of output vertical dimension.
+
+    Returns
+    -------
+    xr.DataArray
+    """
+    horizontal = list(horizontal)
+    field, depth = ds[var], ds[depth_var]
+    if mask is not None:
+        field = field.where(mask)
+    z_dim = _vertical_dim(depth, horizontal)
+    if field.chunks is not None:
+        field = field.chunk({z_dim: -1})  # interpolation needs whole columns
+
+    if levels_are_flat(depth, horizontal, mask):
+        field = field.mean(horizontal)
+        if set(horizontal) & set(depth.dims):
+            depth = depth.where(mask).mean(horizontal) if mask is not None else depth.mean(horizontal)
+        interpolator = VerticalInterpolator(depth, depths, h_sign=h_sign, z_dim=z_dim, method=method)
+        out = interpolator(field, depth_name=depth_name)
+    else:
+        columns = dict(_column=horizontal)
+        field, depth = field.stack(columns), depth.stack(columns)
+        if mask is not None:
+            inside = np.flatnonzero(mask.transpose(*horizontal).values.ravel())
+            field, depth = field.isel(_column=inside), depth.isel(_column=inside)
+        interpolator = VerticalInterpolator(
+            depth.transpose(z_dim, "_column"), depths, h_sign=h_sign, z_dim=z_dim, method=method
+        )
+        out = interpolator(field, depth_name=depth_name).mean("_column")
+
+    return out.rename(var)
+
+
+#%% Products
+def _zone_hovmoller(data: Dict[str, xr.Dataset], zone: str, var: str, depths: np.ndarray, **kwargs) -> xr.Dataset:
+    """ Hovmöller of the only input source over zone, columns out of zone being masked. """
+    ((source, ds),) = data.items()
+    lat_name, lon_name = kwargs.get("horizontal", ("lat_t", "lon_t"))
+    masks = get_zone_masks([zone], ds[lon_name].values, ds[lat_name].values, grid_name=source)
+    mask = zone_masks_as_dataarray(masks, ds[lon_name], ds[lat_name]).sel(zone=zone, drop=True)
+    return hovmoller(ds, var, depths, mask=mask, **kwargs).to_dataset()
+
+
+def hovmoller_product(
+        zone: str,
+        source: str,
+        var: str,
+        depths: np.ndarray = DEFAULT_DEPTHS,
+        time_slice: Optional[slice] = None,
+        location: Path = HOVMOLLERS_PATH,
+        **kwargs,
+) -> DerivedProduct:
+    """
+        Hovmöller of var of source over zone, as a derived product (see
+    data.products) : new times of source are appended to it, and a modified
+    input rebuilds it. Its name is keyed by zone polygon, depth levels, time
+    range and hovmoller kwargs (defaults included), so that modified zones or
+    options never return an old product.
+    """
+    options = {
+        name: parameter.default for name, parameter in inspect.signature(hovmoller).parameters.items()
+        if parameter.default is not inspect.Parameter.empty and name not in ["depths", "mask"]
+    }
+    options.update(kwargs, time_slice=str(time_slice))
+    options = json.dumps(options, sort_keys=True, default=str)
+    key = hash_arrays(
+        get_zone_polygon(zone), np.asarray(depths, dtype=float), np.frombuffer(options.encode(), dtype=np.uint8)
+    )
+
+    lon_min, lon_max, lat_min, lat_max = get_zone_bbox(zone)
+    return DerivedProduct(
+        name=f"{source}_{var}_{zone}_{key}",
+        sources=[source],
+        compute=functools.partial(_zone_hovmoller, zone=zone, var=var, depths=depths, **kwargs),
+        selection=Selection(time=time_slice, lon=(lon_min, lon_max), lat=(lat_min, lat_max), variables=(var,)),
+        location=location,
+        loading_kwargs=dict(access_pattern="profile"),  # whole columns in each chunk
+    )
+
+
+def build_hovmoller(
+        zone: str,
+        source: str,
+        var: str,
+        depths: np.ndarray = DEFAULT_DEPTHS,
+        time_slice: Optional[slice] = None,
+        location: Path = HOVMOLLERS_PATH,
+        rebuild: bool = False,
+        **kwargs,
+) -> xr.DataArray:
+    """
+        (time, depth) mean of var of source over zone, kept up to date as a
+    compact Zarr product (see hovmoller_product).
+
+    Only the bounding box of the zone is read from raw outputs (see Selection),
+    with whole columns in each chunk ; columns out of zone are then masked.
+
+    Parameters
+    ----------
+    zone:       str
+                Name of zone, as in ZONES/<zone>.csv.
+
+    source:     str
+                Name of model source in information files.
+
+    var:        str
+                Name of variable (after cleaning), e.g. "sal".
+
+    depths:     np.ndarray
+                Depth levels of product.
+
+    time_slice: slice, optional.
+                Time range of product. Default to all.
+
+    location:   Path
+                Directory where products are written.
+
+    rebuild:    bool, default: False
+                Whether to compute product again from scratch.
+
+    kwargs:     dict
+                Kwargs to pass to hovmoller (method, depth_var, horizontal, h_sign...).
+
+    Returns
+    -------
+    xr.DataArray
+    """
+    product = hovmoller_product(zone, source, var, depths, time_slice=time_slice, location=location, **kwargs)
+    return product.update(rebuild=rebuild)[var]
+
+
+def build_hovmollers(
+        zone: str,
+        sources: Iterable[str],
+        var: str,
+        depths: np.ndarray = DEFAULT_DEPTHS,
+        max_workers: int = 4,
+        **kwargs,
+) -> Dict[str, xr.DataArray]:
+    """
+        Hovmöllers of several sources over the same zone (see build_hovmoller),
+    built concurrently in threads. Return source name -> (time, depth) DataArray.
+    """
+    sources = list(sources)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hovmoller") as executor:
+        futures = {
+            source: executor.submit(build_hovmoller, zone, source, var, depths=depths, **kwargs)
+            for source in sources
+        }
+    return {source: futures[source].result() for source in sources}
@@ -0,0 +1,159 @@
+from typing import Iterable, List, Optional, Tuple
+
+import functools
+from pathlib import Path
+
+import dask
+import pandas as pd
+import xarray as xr
+
+from data.sources import default_information_location
+from data.catalog import get_catalog
+from data.products import DerivedProduct
+
+from utilities.paths import paths
+
+PROFILES_STORE_PATH = paths.cache_path / "profiles" / "argo_profiles_0_2000.zarr"
+
+FEATURES_SOURCE = "ARGO_features"
+PROFILES_SUFFIX = "_profiles_2000"  # source of sim is <sim>_profiles_2000
+
+# Profile dimension of ALL_<SIM>_0_2000.nc files, labelled as argo_features.csv index
+PROFILE_DIM = "file"
+
+
+def profile_sources() -> List[str]:
+    """ Names of simulations (ARGO included) whose profiles are described in catalog. """
+    names = get_catalog(default_information_location).names()
+    return [n[:-len(PROFILES_SUFFIX)] for n in names if n.endswith(PROFILES_SUFFIX)]
+
+
+def cycle_index(features: pd.DataFrame, files: Iterable[str]) -> pd.DataFrame:
+    """
+        Zone, cycle (rank of profile in its zone) and year of given profile files,
+    indexed by file.
+    """
+    index = features.loc[list(files), ["zone", "year"]].copy()
+    index["cycle"] = index.groupby("zone").cumcount()
+    return index
+
+
+def _to_zone_cycle(ds: xr.Dataset, index: pd.DataFrame) -> xr.Dataset:
+    """ (profile, depth) dataset of profiles to (zone, cycle, depth), padded with NaN. """
+    ds = ds.sel({PROFILE_DIM: index.index.values})
+    ds = ds.assign_coords(
+        zone=(PROFILE_DIM, index["zone"].values),
+        cycle=(PROFILE_DIM, index["cycle"].values),
+    )
+    return ds.drop_vars(PROFILE_DIM).set_index({PROFILE_DIM: ["zone", "cycle"]}).unstack(PROFILE_DIM)
+
+
+def _profile_store(data: dict, sims: List[str]) -> xr.Dataset:
+    """
+        (sim, zone, cycle, depth) store of profiles of given simulations, with
+    file and year of each (zone, cycle) as coordinates, from features and
+    profile sources. Only profiles present in all simulations are kept.
+    """
+    features = data[FEATURES_SOURCE]
+    sources = {sim: data[f"{sim}{PROFILES_SUFFIX}"] for sim in sims}
+
+    files = set(features.index)
+    for ds in sources.values():
+        files &= set(ds[PROFILE_DIM].values)
+    index = cycle_index(features, [f for f in features.index if f in files])
+
+    store = xr.concat(
+        [_to_zone_cycle(ds, index) for ds in sources.values()],
+        dim=pd.Index(sims, name="sim"),
+        join="outer",
+    )
+    labels = index.rename_axis(PROFILE_DIM).reset_index().set_index(["zone", "cycle"]).to_xarray()
+    store = store.assign_coords(file=labels[PROFILE_DIM], year=labels["year"])
+    return store.chunk({"sim": 1, "zone": 1, "cycle": -1, "depth": -1})
+
+
+def profile_product(sims: Iterable[str], path: Path = PROFILES_STORE_PATH) -> DerivedProduct:
+    """
+        Store of profiles of given simulations (see _profile_store), as a derived
+    product (see data.products) : it is written again only if an input file or
+    entry changed, or if simulations were added.
+    """
+    sims = sorted(sims)
+    path = Path(path)
+    return DerivedProduct(
+        name=path.stem,
+        sources=[FEATURES_SOURCE, *[f"{sim}{PROFILES_SUFFIX}" for sim in sims]],
+        compute=functools.partial(_profile_store, sims=sims),
+        location=path.parent,
+    )
+
+
+def build_profile_store(sims: Optional[Iterable[str]] = None, path: Path = PROFILES_STORE_PATH) -> Path:
+    """ Write profiles of given simulations (all known ones by default) to a Zarr store at path. """
+    sims = list(sims) if sims is not None else profile_sources()
+    profile_product(sims, path=path).update(rebuild=True)
+    return Path(path)
+
+
+def open_profile_store(sims: Iterable[str], path: Path = PROFILES_STORE_PATH, rebuild: bool = False) -> xr.Dataset:
+    """
+        Open store lazily, (re)building it first if it is missing, misses one of
+    given sims, or if an input was modified since it was written. Simulations
+    already stored are kept.
+    """
+    sims = set(sims)
+    record = profile_product(sims, path=path).read_record()
+    if record is not None:
+        sims |= {s[:-len(PROFILES_SUFFIX)] for s in record["sources"] if s.endswith(PROFILES_SUFFIX)}
+    return profile_product(sims, path=path).update(rebuild=rebuild)
+
+
+def load_sims(
+        sims: Iterable[str],
+        zones: Optional[Iterable[str]] = None,
+        years: Optional[Iterable[int]] = None,
+        path: Path = PROFILES_STORE_PATH,
+        rebuild: bool = False,
+) -> xr.Dataset:
+    """
+        Profiles of ARGO and co-located simulations, as a lazy
+    (sim, zone, cycle, depth) dataset.
+
+    Profiles are read from a consolidated Zarr store chunked by sim and zone,
+    written once from ALL_<SIM>_0_2000.nc files and argo_features.csv (see
+    build_profile_store) : opening it only reads metadata, and filtering and
+    statistics over cycles stay lazy (see profiles_mean_std).
+
+    Parameters
+    ----------
+    sims:       iterable of str
+                Simulations to load, e.g. ["ARGO", "NT0", "T1"].
+
+    zones:      iterable of str, optional.
+                Zones to keep. Default to all.
+
+    years:      iterable of int, optional.
+                Years of profiles to keep, others being masked. Default to all.
+
+    path:       Path
+                Path to profile store.
+
+    rebuild:    bool, default: False
+                Whether to write the store again from input files.
+
+    Returns
+    -------
+    xr.Dataset
+    """
+    sims = list(sims)
+    ds = open_profile_store(sims, path=path, rebuild=rebuild).sel(sim=sims)
+    if zones is not None:
+        ds = ds.sel(zone=list(zones))
+    if years is not None:
+        ds = ds.where(ds.year.isin(list(years)))
+    return ds
+
+
+def profiles_mean_std(ds: xr.Dataset, dim="cycle") -> Tuple[xr.Dataset, xr.Dataset]:
+    """ Mean and std of profiles over dim, computed out of core with one read of ds. """
+    return dask.compute(ds.mean(dim), ds.std(dim))
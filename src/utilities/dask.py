@@ -1,7 +1,15 @@
+from typing import Optional
+
+from contextlib import contextmanager
+
 from utilities.paths import paths
+from utilities.profiles import FORCED_PROFILE_KEY, execution_profile, uses_profile  # noqa: F401 (re-exported)
 
+import dask
 from dask import distributed
 from dask.distributed import Client, LocalCluster
+from dask.system import CPU_COUNT
+from distributed.system import MEMORY_LIMIT
 
 try:
     import dask_jobqueue
@@ -9,21 +17,104 @@ except ModuleNotFoundError:
     pass
 
 
+# Fractions of worker memory limit at which data is spilled to disk, worker is
+# paused, and restarted. Spilling starts early as chunks of most sources are large.
+MEMORY_THRESHOLDS = {
+    "distributed.worker.memory.target": 0.6,
+    "distributed.worker.memory.spill": 0.7,
+    "distributed.worker.memory.pause": 0.85,
+    "distributed.worker.memory.terminate": 0.95,
+}
+
+# Chunks a thread should be able to hold at once (inputs, output, temporaries)
+CHUNKS_PER_THREAD = 4
+
+# Config changed by init_dask_cluster, per cluster, undone by close_dask_cluster
+_cluster_settings = {}
+
+
+def _config_env_exports(config: dict) -> list:
+    """ Shell lines setting dask config of a new process, through DASK_* environment variables. """
+    return [
+        f"export DASK_{key.upper().replace('.', '__').replace('-', '_')}={value}"
+        for key, value in config.items()
+    ]
+
+
+def resource_aware_workers(
+        chunk_bytes: float,
+        threads_per_worker: int = 2,
+        n_cores: Optional[int] = None,
+        memory: Optional[float] = None,
+        memory_fraction: float = 0.9,
+) -> dict:
+    """
+        Size local workers from available cores and memory of the node, and
+    from chunk size : as many workers as cores allow, as long as each thread can
+    hold CHUNKS_PER_THREAD chunks in memory.
+
+    Parameters
+    ----------
+    chunk_bytes:        float
+                        Size of chunks processed, in bytes (e.g. planned ones,
+                        see data.chunks.dataset_chunk_bytes).
+
+    threads_per_worker: int
+                        Number of threads of each worker.
+
+    n_cores:            int, optional.
+                        Number of cores to use. Default to all available ones.
+
+    memory:             float, optional.
+                        Memory to use, in bytes. Default to all available memory.
+
+    memory_fraction:    float
+                        Fraction of memory given to workers, the rest being left
+                        to the scheduler, client and system.
+
+    Returns
+    -------
+    Dict with n_workers, threads_per_worker and memory_limit (bytes per worker).
+    """
+    n_cores = n_cores or CPU_COUNT
+    memory = (memory or MEMORY_LIMIT) * memory_fraction
+
+    threads_per_worker = max(min(threads_per_worker, n_cores), 1)
+    memory_per_thread = CHUNKS_PER_THREAD * chunk_bytes
+    max_threads = max(int(memory // memory_per_thread), 1)
+    n_workers = max(min(n_cores, max_threads) // threads_per_worker, 1)
+
+    return dict(
+        n_workers=n_workers,
+        threads_per_worker=threads_per_worker,
+        memory_limit=int(memory / n_workers),
+    )
+
+
 def _slurm_cluster(
     cluster_name="my_cluster",
     client_name="my_client",
     walltime="00:30:00",
     n_scale=1,
+    adaptive=False,
     **kwargs
 ):
+    # Workers start in new processes on other nodes : memory thresholds are
+    # given to them through their job environment
+    prologue = list(kwargs.pop("job_script_prologue", [])) + _config_env_exports(MEMORY_THRESHOLDS)
+
     # Cluster with default jobqueue parameters
     cluster = dask_jobqueue.SLURMCluster(
         name=cluster_name,
         walltime=walltime,
         local_directory=paths.logs_path,
+        job_script_prologue=prologue,
         **kwargs
     )
-    cluster.scale(n=n_scale)
+    if adaptive:  # n_scale jobs at most, released when idle
+        cluster.adapt(minimum_jobs=1, maximum_jobs=n_scale)
+    else:
+        cluster.scale(n=n_scale)
 
     # Client
     client = distributed.Client(cluster, name=client_name)
@@ -35,15 +126,26 @@ def _local_cluster(
     threads_per_worker=2,
     cluster_name="my_cluster",
     client_name="my_client",
+    adaptive=False,
+    chunk_bytes=None,
     **kwargs
 ):
+    if adaptive and chunk_bytes is None:
+        raise ValueError("chunk_bytes is needed to size adaptive local workers.")
+    if adaptive:  # n_workers is a maximum, computed from resources
+        sizing = resource_aware_workers(chunk_bytes, threads_per_worker=threads_per_worker)
+        n_workers, threads_per_worker = sizing["n_workers"], sizing["threads_per_worker"]
+        kwargs.setdefault("memory_limit", sizing["memory_limit"])
+
     cluster = LocalCluster(
-        n_workers=n_workers,
+        n_workers=1 if adaptive else n_workers,
         threads_per_worker=threads_per_worker,
         local_directory=paths.logs_path,
         name=cluster_name,
         **kwargs
     )
+    if adaptive:
+        cluster.adapt(minimum=1, maximum=n_workers)
     client = Client(cluster, name=client_name)
     return cluster, client
 
@@ -57,6 +159,8 @@ def init_dask_cluster(
         client_name: str = "my_client",
         walltime: str = "00:30:00",
         n_scale: int = 1,
+        adaptive: bool = False,
+        chunk_bytes: Optional[float] = None,
         **kwargs
 ):
     """
@@ -77,6 +181,15 @@ def init_dask_cluster(
                     Lifetime of cluster.
     n_scale:        int
                     Number of time to scale cluster.
+    adaptive:       bool, default: False
+                    Whether to let the cluster scale with the load. Local
+                    workers are then sized from cores, memory and chunk_bytes
+                    (see resource_aware_workers), n_workers being ignored ;
+                    SLURM clusters use up to n_scale jobs.
+    chunk_bytes:    float, optional.
+                    Size of chunks processed, in bytes, e.g. largest chunk of
+                    loaded data (see data.chunks.dataset_chunk_bytes). Needed
+                    by adaptive local clusters.
     kwargs:         dict
                     Kwargs to pass to cluster.
     Returns
@@ -86,26 +199,64 @@ def init_dask_cluster(
     client
 
     """
-    if cluster_type.lower() == "slurm":
-        cluster, client = _slurm_cluster(
-            cluster_name=cluster_name,
-            client_name=client_name,
-            walltime=walltime,
-            n_scale=n_scale,
-            **kwargs
-        )
-    elif cluster_type.lower() == "local":
-        cluster, client = _local_cluster(
-            n_workers=n_workers,
-            threads_per_worker=threads_per_worker,
-            cluster_name=cluster_name,
-            client_name=client_name,
-            **kwargs
-        )
-    else:
+    # Local workers get memory thresholds from config of this process (SLURM
+    # ones from their job script) ; stages run on the cluster, whatever profile
+    # they declare. Both are undone by close_dask_cluster.
+    if cluster_type.lower() not in ["slurm", "local"]:
         raise ValueError(f"Unknown cluster type : {cluster_type}.")
+    settings = dask.config.set({**MEMORY_THRESHOLDS, FORCED_PROFILE_KEY: "distributed"})
+
+    try:
+        if cluster_type.lower() == "slurm":
+            cluster, client = _slurm_cluster(
+                cluster_name=cluster_name,
+                client_name=client_name,
+                walltime=walltime,
+                n_scale=n_scale,
+                adaptive=adaptive,
+                **kwargs
+            )
+        else:
+            cluster, client = _local_cluster(
+                n_workers=n_workers,
+                threads_per_worker=threads_per_worker,
+                cluster_name=cluster_name,
+                client_name=client_name,
+                adaptive=adaptive,
+                chunk_bytes=chunk_bytes,
+                **kwargs
+            )
+    except Exception:
+        settings.__exit__(None, None, None)
+        raise
+    _cluster_settings[id(cluster)] = settings
 
     if display_link:
         print("=> Client dashboard :", client.dashboard_link)
 
     return cluster, client
+
+
+def close_dask_cluster(cluster, client):
+    """ Close client, then cluster (workers are stopped, SLURM jobs cancelled). """
+    client.close()
+    cluster.close()
+    settings = _cluster_settings.pop(id(cluster), None)
+    if settings is not None:  # back to config before cluster, and profiles declared by stages
+        settings.__exit__(None, None, None)
+
+
+@contextmanager
+def dask_cluster(*args, **kwargs):
+    """
+        Context manager version of init_dask_cluster (same arguments) : cluster
+    and client are closed on exit, even if an error occurred.
+
+    >>> with dask_cluster("local", adaptive=True) as (cluster, client):
+    ...     ds.mean("time").compute()
+    """
+    cluster, client = init_dask_cluster(*args, **kwargs)
+    try:
+        yield cluster, client
+    finally:
+        close_dask_cluster(cluster, client)
@@ -1,14 +1,94 @@
+from typing import Dict
+
 import xarray as xr
 
+from pathlib import Path
+from functools import lru_cache
+from dataclasses import dataclass
+
 from utilities.paths import paths
 
 PATH = paths.grids_path
 
+GRID_CACHE_SIZE = 4  # number of grids kept open at the same time
+VAR_TYPES = ["t", "u", "v", "w"]
+
 
-def get_grid(configuration="SEA_312", coordinates=None):
-    if coordinates is not None and coordinates is not "":
+def get_grid_path(configuration="SEA_312", coordinates=None) -> Path:
+    if coordinates is not None and coordinates != "":
         suffix = f"_{coordinates}"
     else:
         suffix = ""
     grid_name = f"grid_{configuration}{suffix}.nc"
-    return xr.open_dataset(PATH / grid_name)
\ No newline at end of file
+    return PATH / grid_name
+
+
+@lru_cache(maxsize=GRID_CACHE_SIZE)
+def _open_grid(path: Path, mtime_ns: int) -> xr.Dataset:
+    # mtime_ns is only part of the cache key : a modified grid file is opened again
+    return xr.open_dataset(path)
+
+
+def get_grid(configuration="SEA_312", coordinates=None) -> xr.Dataset:
+    """
+        Open SYMPHONIE grid of given configuration. Grids are cached (LRU) :
+    calling it again with same arguments returns the same Dataset, unless the
+    file was modified in between.
+    """
+    path = get_grid_path(configuration, coordinates)
+    return _open_grid(path, path.stat().st_mtime_ns)
+
+
+#%%
+def _read_only(variable: xr.Variable) -> xr.Variable:
+    """ Load variable in memory and forbid any modification of its values. """
+    variable = variable.load()
+    variable.values.flags.writeable = False
+    return variable
+
+
+@dataclass(frozen=True)
+class GridCoordinates:
+    """
+        1-D coordinates and depth fields derived from a SYMPHONIE grid.
+    Arrays are read-only, so that they can be shared between all datasets
+    cleaned with the same grid.
+    """
+
+    lon: Dict[str, xr.Variable]  # var_type -> 1-D longitudes (mean along latitude)
+    lat: Dict[str, xr.Variable]  # var_type -> 1-D latitudes (mean along longitude)
+    depths: Dict[str, xr.Variable]  # depth_t, depth_u, ... -> depth fields
+
+
+@lru_cache(maxsize=GRID_CACHE_SIZE)
+def _grid_coordinates(path: Path, mtime_ns: int) -> GridCoordinates:
+    grid = _open_grid(path, mtime_ns)
+
+    lon, lat = {}, {}
+    for var_type in VAR_TYPES:
+        if f"longitude_{var_type}" not in grid.variables:
+            continue
+        lon[var_type] = _read_only(grid.variables[f"longitude_{var_type}"].mean(axis=0))
+        lat[var_type] = _read_only(grid.variables[f"latitude_{var_type}"].mean(axis=1))
+
+    depths = {
+        name: _read_only(grid.variables[name].copy(deep=False))
+        for name in grid.variables if name[:5] == "depth"
+    }
+
+    return GridCoordinates(lon=lon, lat=lat, depths=depths)
+
+
+def get_grid_coordinates(configuration="SEA_312", coordinates=None) -> GridCoordinates:
+    """
+        Extract explicit coordinates values (1-D lon / lat for each variable type,
+    and depth fields) from given SYMPHONIE grid. Computed once per grid file.
+    """
+    path = get_grid_path(configuration, coordinates)
+    return _grid_coordinates(path, path.stat().st_mtime_ns)
+
+
+def clear_grid_cache():
+    """ Forget all opened grids and derived coordinates. """
+    _grid_coordinates.cache_clear()
+    _open_grid.cache_clear()
@@ -1,17 +1,78 @@
 import numpy as np
 import xarray as xr
 
-from wrf import interplevel
+try:
+    from wrf import interplevel
+except ModuleNotFoundError:
+    interplevel = None
 
-import tqdm
+try:
+    import numba
+except ModuleNotFoundError:
+    numba = None
 
 
-def interp_variable(var: xr.DataArray, depth3d: xr.DataArray, depth1d: np.ndarray, h_sign=1, depth_name="depth_t", **kwargs):
+def interp_variable(
+        var: xr.DataArray,
+        depth3d: xr.DataArray,
+        depth1d: np.ndarray,
+        h_sign=1,
+        depth_name="depth_t",
+        method="linear",
+        backend="numpy",
+        **kwargs
+):
+    """
+    Interpolate var from 3-D depths (s / VQS coordinates) to 1-D depth levels.
+
+    Parameters
+    ----------
+    var:        xr.DataArray
+                Field to interpolate.
+
+    depth3d:    xr.DataArray
+                Depth of each point of var.
+
+    depth1d:    np.ndarray
+                Depth levels to interpolate to.
+
+    h_sign:     int
+                Sign of output levels, depths being counted positive downward if 1.
+
+    depth_name: str
+                Name of output vertical dimension.
+
+    method:     str, default: "linear"
+                "linear" or "conservative" (layer-averaged). See VerticalInterpolator.
+
+    backend:    str, default: "numpy"
+                "numpy", "numba" or "wrf" (linear only, legacy).
+
+    kwargs:     dict
+                Kwargs to pass to wrf.interplevel (wrf backend only).
+
+    Returns
+    -------
+    xr.DataArray
+    """
 
     if len(depth3d.shape) == 1:
         print("Base depth field provided is 1d, should be 3d. Returning base data.")
         return var
 
+    if backend == "wrf":
+        return _interp_variable_wrf(var, depth3d, depth1d, h_sign=h_sign, depth_name=depth_name, **kwargs)
+
+    interpolator = VerticalInterpolator(
+        depth3d, depth1d, h_sign=h_sign, method=method, backend=backend
+    )
+    return interpolator(var, depth_name=depth_name)
+
+
+def _interp_variable_wrf(var, depth3d, depth1d, h_sign=1, depth_name="depth_t", **kwargs):
+    if interplevel is None:
+        raise ModuleNotFoundError("wrf-python is needed for backend 'wrf'.")
+
     sign3d = np.sign(depth3d.mean()) * h_sign
     sign1d = np.sign(depth1d.mean()) * h_sign
 
@@ -22,27 +83,370 @@ def interp_variable(var: xr.DataArray, depth3d: xr.DataArray, depth1d: np.ndarra
     return data
 
 
+#%% Linear
+def linear_weights(depth: np.ndarray, levels: np.ndarray):
+    """
+        Indices and weights of a linear interpolation along last axis.
+
+    Parameters
+    ----------
+    depth:  np.ndarray
+            (..., nz) depths of each column, increasing along last axis.
+
+    levels: np.ndarray
+            (nl,) depths to interpolate to.
+
+    Returns
+    -------
+    index:  np.ndarray
+            (..., nl) index of level just above (in depth) each target level.
+
+    weight: np.ndarray
+            (..., nl) weight of level index + 1. NaN where target level is out of
+            column range (or column is masked).
+    """
+    nz = depth.shape[-1]
+
+    # number of levels above each target level => index of lower bound
+    # (one level at a time, to avoid a (..., nl, nz) temporary array)
+    count = np.empty(depth.shape[:-1] + levels.shape, dtype=np.intp)
+    for i, level in enumerate(levels):
+        count[..., i] = (depth <= level).sum(axis=-1)
+    index = np.clip(count - 1, 0, nz - 2)
+
+    z0 = np.take_along_axis(depth, index, axis=-1)
+    z1 = np.take_along_axis(depth, index + 1, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = (levels - z0) / (z1 - z0)
+
+    # outside of column (or NaN depth) : no value
+    weight[~((weight >= 0) & (weight <= 1))] = np.nan
+
+    return index, weight
+
+
+def apply_linear_weights(
+        values: np.ndarray,
+        index: np.ndarray,
+        weight: np.ndarray,
+        out: np.ndarray = None,
+        block_size: int = 16,
+) -> np.ndarray:
+    """
+        Interpolate values (..., nz) with precomputed index and weight (see linear_weights).
+    Leading dimensions of values (e.g. time) are processed by blocks, and results
+    are directly written in out, to bound temporary memory.
+    """
+    n_lead = values.ndim - index.ndim
+    lead_shape = values.shape[:n_lead]
+    if out is None:
+        out = np.empty(lead_shape + index.shape, dtype=np.result_type(values, weight))
+
+    flat_values = values.reshape((-1,) + values.shape[n_lead:])
+    flat_out = out.reshape((-1,) + index.shape)
+    for start in range(0, flat_values.shape[0], block_size):
+        block = flat_values[start:start + block_size]
+        v0 = np.take_along_axis(block, index[None], axis=-1)
+        v1 = np.take_along_axis(block, index[None] + 1, axis=-1)
+        # out = v0 + weight * (v1 - v0)
+        np.subtract(v1, v0, out=v1)
+        np.multiply(v1, weight, out=v1)
+        np.add(v0, v1, out=flat_out[start:start + block_size])
+
+    return out
+
+
+#%% Conservative
+def layer_interfaces(depth: np.ndarray) -> np.ndarray:
+    """
+        Interfaces (..., nz + 1) of layers centered on depth (..., nz) : middle of
+    consecutive levels, and half a layer above / below first / last levels.
+    """
+    middle = (depth[..., :-1] + depth[..., 1:]) / 2
+    first = depth[..., :1] - (middle[..., :1] - depth[..., :1])
+    last = depth[..., -1:] + (depth[..., -1:] - middle[..., -1:])
+    return np.concatenate([first, middle, last], axis=-1)
+
+
+def conservative_weights(interfaces: np.ndarray, target_interfaces: np.ndarray):
+    """
+        Position of target interfaces in source layers, to compute layer averages
+    from cumulative integrals of a piecewise constant profile.
+
+    Parameters
+    ----------
+    interfaces:         np.ndarray
+                        (..., nz + 1) increasing interfaces of source layers.
+
+    target_interfaces:  np.ndarray
+                        (nl + 1,) increasing interfaces of target layers.
+
+    Returns
+    -------
+    index:      np.ndarray
+                (..., nl + 1) source layer containing each target interface.
+
+    offset:     np.ndarray
+                (..., nl + 1) distance between target interface and top of this
+                layer, clipped to the layer (above / below column => 0 / thickness).
+
+    thickness:  np.ndarray
+                (..., nz) thickness of source layers.
+    """
+    thickness = np.diff(interfaces, axis=-1)
+    index, _ = linear_weights(interfaces, target_interfaces)  # layer index = lower interface index
+    top = np.take_along_axis(interfaces, index, axis=-1)
+    with np.errstate(invalid="ignore"):
+        offset = np.clip(
+            target_interfaces - top, 0, np.take_along_axis(thickness, index, axis=-1)
+        )
+    return index, offset, thickness
+
+
+def apply_conservative_weights(
+        values: np.ndarray,
+        index: np.ndarray,
+        offset: np.ndarray,
+        thickness: np.ndarray,
+) -> np.ndarray:
+    """
+        Layer-averaged remapping of values (..., nz) with precomputed weights (see
+    conservative_weights). Each target layer gets the mean of source layers weighted
+    by their overlap with it. NaN source values are ignored ; target layers with no
+    valid overlap are NaN.
+    """
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0)
+
+    def integral(v):
+        # cumulative integral of v at each target interface
+        cumulated = np.cumsum(v * thickness, axis=-1)
+        cumulated = np.concatenate([np.zeros_like(cumulated[..., :1]), cumulated], axis=-1)
+        full = np.take_along_axis(cumulated, np.broadcast_to(index, v.shape[:-1] + index.shape[-1:]), axis=-1)
+        partial = np.take_along_axis(v, np.broadcast_to(index, v.shape[:-1] + index.shape[-1:]), axis=-1)
+        return full + partial * offset
+
+    total = np.diff(integral(valid.astype(values.dtype)), axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total > 0, np.diff(integral(values), axis=-1) / total, np.nan)
+
+
+#%% Compiled kernels
+def _linear_kernel(values, depth, levels, out):
+    # values : (n_values, nz), depth : (n_columns, nz), n_values = n_lead * n_columns
+    # levels are sorted : search of bounding levels starts where previous one ended
+    n_columns, nz = depth.shape
+    for i in range(values.shape[0]):
+        col = i % n_columns
+        k = 0
+        for j in range(levels.size):
+            while k < nz - 2 and depth[col, k + 1] < levels[j]:
+                k += 1
+            z0, z1 = depth[col, k], depth[col, k + 1]
+            if z0 <= levels[j] <= z1 and z1 > z0:
+                w = (levels[j] - z0) / (z1 - z0)
+                out[i, j] = values[i, k] + w * (values[i, k + 1] - values[i, k])
+            else:
+                out[i, j] = np.nan
+
+
+def _conservative_kernel(values, interfaces, target_interfaces, out):
+    # values : (n_values, nz), interfaces : (n_columns, nz + 1)
+    n_columns = interfaces.shape[0]
+    nz = values.shape[1]
+    for i in range(values.shape[0]):
+        col = i % n_columns
+        for j in range(target_interfaces.size - 1):
+            num, total = 0.0, 0.0
+            for k in range(nz):
+                if np.isnan(values[i, k]):
+                    continue
+                overlap = (
+                    min(interfaces[col, k + 1], target_interfaces[j + 1])
+                    - max(interfaces[col, k], target_interfaces[j])
+                )
+                if overlap > 0:
+                    num += overlap * values[i, k]
+                    total += overlap
+            out[i, j] = num / total if total > 0 else np.nan
+
+
+if numba is not None:
+    # nogil : kernels can run in parallel on threads (e.g. dask threaded scheduler)
+    _linear_kernel = numba.njit(nogil=True, cache=True)(_linear_kernel)
+    _conservative_kernel = numba.njit(nogil=True, cache=True)(_conservative_kernel)
+
+
+def _run_kernel(kernel, values, column_field, target, n_out):
+    if numba is None:
+        raise ModuleNotFoundError("numba is needed for backend 'numba'.")
+    flat_values = np.ascontiguousarray(values.reshape(-1, values.shape[-1]), dtype=float)
+    flat_field = np.ascontiguousarray(column_field.reshape(-1, column_field.shape[-1]), dtype=float)
+    out = np.empty((flat_values.shape[0], n_out))
+    kernel(flat_values, flat_field, target, out)
+    return out.reshape(values.shape[:-1] + (n_out,))
+
+
+#%%
+BACKENDS = ("numpy", "numba")
+METHODS = ("linear", "conservative")
+
+
+class VerticalInterpolator:
+    """
+        Interpolation of a field from 3-D depths (s / VQS coordinates) to fixed
+    depth levels, for all timesteps at once.
+
+    Methods:
+    - "linear" : linear interpolation between the two closest levels.
+    - "conservative" : each output level is the mean over the layer between
+      the middles of its neighbouring output levels (layer-averaged remapping).
+
+    Backends:
+    - "numpy" : vectorized, with indices / weights computed once from depths.
+    - "numba" : compiled column by column, without the GIL.
+    """
+
+    def __init__(
+            self,
+            depth3d: xr.DataArray,
+            depth1d: np.ndarray,
+            h_sign=1,
+            z_dim=None,
+            method="linear",
+            backend="numpy",
+    ):
+        """
+
+        Parameters
+        ----------
+        depth3d:    xr.DataArray
+                    Depth of each point of the field to interpolate.
+
+        depth1d:    np.ndarray
+                    Depth levels to interpolate to.
+
+        h_sign:     int
+                    Sign convention of output levels (as in interp_variable).
+
+        z_dim:      str, optional.
+                    Name of vertical dimension. First dimension of depth3d by default.
+
+        method:     str, default: "linear"
+                    "linear" or "conservative".
+
+        backend:    str, default: "numpy"
+                    "numpy" or "numba".
+        """
+        if method not in METHODS:
+            raise ValueError(f"Unknown interpolation method : {method}. Please provide one of {METHODS}.")
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown interpolation backend : {backend}. Please provide one of {BACKENDS}.")
+        self.method, self.backend = method, backend
+
+        depth1d = np.asarray(depth1d, dtype=float)
+        self.z_dim = depth3d.dims[0] if z_dim is None else z_dim
+
+        # Same sign convention as interp_variable
+        sign3d = np.sign(float(depth3d.mean())) * h_sign
+        sign1d = np.sign(depth1d.mean()) * h_sign
+        self.levels = sign1d * depth1d
+
+        depth = depth3d.transpose(..., self.z_dim)
+        self.horizontal_dims = depth.dims[:-1]
+        depth = sign3d * depth.values
+
+        # Work with depths increasing along vertical axis
+        self.reverse = bool(np.nanmean(depth[..., 0]) > np.nanmean(depth[..., -1]))
+        if self.reverse:
+            depth = depth[..., ::-1]
+
+        # Output levels are processed sorted, and put back in given order
+        self._order = np.argsort(self.levels)
+        self._sorted_levels = self.levels[self._order]
+
+        # Fields needed by each column, computed once
+        if method == "linear" and backend == "numpy":
+            self._columns = linear_weights(depth, self.levels)
+        elif method == "linear":
+            self._columns = (depth,)
+        elif backend == "numpy":
+            self._target_interfaces = layer_interfaces(self._sorted_levels)
+            self._columns = conservative_weights(layer_interfaces(depth), self._target_interfaces)
+        else:
+            self._target_interfaces = layer_interfaces(self._sorted_levels)
+            self._columns = (layer_interfaces(depth),)
+
+    def interp_numpy(self, values: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+            Interpolate (..., *horizontal, nz) values to (..., *horizontal, nl).
+        Results are written in out if given (e.g. a preallocated buffer).
+        """
+        return self._interp_block(values, *self._columns, out=out)
+
+    def _interp_block(self, values, *columns, out=None):
+        if self.reverse:
+            values = values[..., ::-1]
+
+        if self.method == "linear" and self.backend == "numpy":
+            return apply_linear_weights(values, *columns, out=out)
+
+        if self.method == "linear":
+            interpolated = _run_kernel(_linear_kernel, values, columns[0], self._sorted_levels, self.levels.size)
+        elif self.backend == "numpy":
+            interpolated = apply_conservative_weights(values, *columns)
+        else:
+            interpolated = _run_kernel(
+                _conservative_kernel, values, columns[0], self._target_interfaces, self.levels.size
+            )
+
+        # back to given levels order
+        result = np.empty_like(interpolated) if out is None else out
+        result[..., self._order] = interpolated
+        return result
+
+    def __call__(self, var: xr.DataArray, depth_name="depth") -> xr.DataArray:
+        """
+            Interpolate var, with all its timesteps at once. Dask-backed var is
+        interpolated chunk by chunk (chunks must span the whole vertical dimension).
+        """
+        # Column fields as DataArrays, so that they are chunked like var
+        core_dims = [f"_{self.z_dim}_column{i}" for i in range(len(self._columns))]
+        columns = [
+            xr.DataArray(c, dims=(*self.horizontal_dims, core_dim))
+            for c, core_dim in zip(self._columns, core_dims)
+        ]
+        out = xr.apply_ufunc(
+            self._interp_block,
+            var,
+            *columns,
+            input_core_dims=[[self.z_dim], *[[d] for d in core_dims]],
+            output_core_dims=[[depth_name]],
+            exclude_dims={self.z_dim},
+            dask="parallelized",
+            output_dtypes=[np.result_type(var.dtype, float)],
+            dask_gufunc_kwargs=dict(output_sizes={depth_name: self.levels.size}),
+        )
+        out = out.assign_coords({depth_name: self.levels})
+
+        # same dimensions order as var, with depth_name instead of vertical dimension
+        dims = [depth_name if d == self.z_dim else d for d in var.dims]
+        return out.transpose(*dims)
+
+
 @xr.register_dataset_accessor("interpolation")
 class InterpAccessor:
 
     def __init__(self, dataset):
         self._obj = dataset
 
-    def _interp(self, var, depth1d, h_sign=1, depth_name="depth"):
+    def _interp(self, var, depth1d, h_sign=1, depth_name="depth", method="linear", backend="numpy"):
 
         var_type = self._obj[var].dims[-1][-1]
 
         depth3d = self._obj[f"depth_{var_type}"]
 
-        das = []
-        for t in tqdm.tqdm(self._obj["time"]):
-            da = interp_variable(
-                self._obj[var].sel(time=t),
-                depth3d,
-                depth1d,
-                h_sign=h_sign,
-                depth_name=depth_name
-            ).assign_coords(time=t)
-            das.append(da)
-
-        return xr.concat(das, dim="time")
\ No newline at end of file
+        interpolator = VerticalInterpolator(
+            depth3d, depth1d, h_sign=h_sign, method=method, backend=backend
+        )
+        return interpolator(self._obj[var], depth_name=depth_name)
@@ -1,5 +1,8 @@
 import xarray as xr
 import numpy as np
+import pandas as pd
+
+from utilities.profiles import uses_profile
 
 # from dataclasses import dataclass
 #
@@ -72,3 +75,147 @@ my_metrics = dict(
     bias=bias,
     diff_std=diff_std,
 )
+
+
+#%%
+def compute_metrics(
+        d1: xr.Dataset,
+        d_ref: xr.Dataset,
+        metrics=tuple(my_metrics),
+        weights=None,
+        dim=None,
+        metric_dim="metric",
+) -> xr.Dataset:
+    """
+        Compute several metrics at once. The difference, the validity mask and the
+    normalized weights are computed only once and shared by all metrics, and
+    everything stays lazy for dask-backed data (a single .compute() evaluates all
+    metrics). Results are the same as each function of my_metrics.
+
+    Parameters
+    ----------
+    d1:         xr.Dataset or xr.DataArray
+                Data to evaluate.
+
+    d_ref:      xr.Dataset or xr.DataArray
+                Reference data. Broadcast against d1 (e.g. d1 with a "sim" dimension
+                and d_ref without).
+
+    metrics:    iterable of str
+                Names of metrics to compute, among keys of my_metrics.
+
+    weights:    xr.DataArray, optional.
+                Weights along dim. Uniform if not given.
+
+    dim:        str or list of str, optional.
+                Dimension(s) along which metrics are computed. All by default.
+
+    metric_dim: str
+                Name of the output dimension indexing metrics.
+
+    Returns
+    -------
+    Same type as d1, with a new metric_dim dimension.
+    """
+    metrics = list(metrics)
+    for name in metrics:
+        if name not in my_metrics:
+            raise KeyError(
+                f"Unknown metric <{name}>. Please provide one of the following : ",
+                tuple(my_metrics.keys()),
+            )
+
+    # Shared intermediates
+    diff = d1 - d_ref
+    valid = diff.notnull()
+    if weights is None:
+        w = valid.astype(float)
+    else:
+        w = weights.where(valid, 0)
+    total = w.sum(dim=dim)
+    norm = w / total
+
+    def w_mean(x):
+        # same as .weighted(weights).mean(dim), NaN being skipped : NaN where no value is valid
+        return (x.fillna(0) * norm).sum(dim=dim).where(total > 0)
+
+    results = {}
+    if "bias" in metrics or "diff_std" in metrics:
+        results["bias"] = w_mean(diff)
+    if "rmse" in metrics:
+        results["rmse"] = np.sqrt(w_mean(diff ** 2))
+    if "mae" in metrics:
+        results["mae"] = w_mean(np.abs(diff))
+    if "mare" in metrics:
+        # 0 / 0 relative errors are left out of numerator and weights
+        ratio = np.abs(diff / d_ref)
+        w_ratio = w.where(ratio.notnull(), 0)
+        total_ratio = w_ratio.sum(dim=dim)
+        results["mare"] = ((ratio.fillna(0) * w_ratio).sum(dim=dim) / total_ratio).where(total_ratio > 0)
+    if "diff_std" in metrics:
+        results["diff_std"] = np.sqrt(w_mean((diff - results["bias"]) ** 2))
+
+    return xr.concat(
+        [results[name] for name in metrics],
+        dim=pd.Index(metrics, name=metric_dim),
+        coords="minimal",
+        compat="override",
+    )
+
+
+@uses_profile("threads")  # NumPy reductions release the GIL
+def evaluate_against_reference(
+        data: xr.DataArray,
+        ref_sim: str,
+        metrics=tuple(my_metrics),
+        weights=None,
+        dim="depth",
+        sim_dim="sim",
+        as_table=True,
+):
+    """
+        Compare all simulations of data to a reference one, for every other
+    dimension (e.g. zone) at once : all comparisons are one broadcast computation
+    instead of one .sel per (zone, simulation) pair.
+
+    Parameters
+    ----------
+    data:       xr.DataArray or xr.Dataset
+                Data with a sim_dim dimension, including reference, e.g. (sim, zone, depth).
+
+    ref_sim:    str
+                Name of reference along sim_dim.
+
+    metrics:    iterable of str
+                Names of metrics to compute, among keys of my_metrics.
+
+    weights:    xr.DataArray, optional.
+                Weights along dim, possibly depending on other dimensions (e.g. zone).
+
+    dim:        str or list of str
+                Dimension(s) along which metrics are computed.
+
+    sim_dim:    str
+                Name of dimension indexing simulations.
+
+    as_table:   bool, default: True
+                Whether to return a tidy pd.DataFrame (one row per metric and
+                coordinates) or the computed xarray object.
+
+    Returns
+    -------
+    pd.DataFrame or computed output of compute_metrics.
+    """
+    d_ref = data.sel({sim_dim: ref_sim}, drop=True)
+    d1 = data.drop_sel({sim_dim: ref_sim})
+    if weights is not None and sim_dim not in weights.dims:
+        weights = weights.drop_vars(sim_dim, errors="ignore")  # e.g. weights of reference sim
+
+    result = compute_metrics(d1, d_ref, metrics=metrics, weights=weights, dim=dim).compute()
+
+    if not as_table:
+        return result
+    if isinstance(result, xr.DataArray):
+        return result.to_dataframe(name="value").reset_index()
+    return result.to_dataframe().reset_index()
+
@@ -20,6 +20,9 @@ class MyPaths:
     # where to put logs
     logs_path: Path = project_path / "logs"
 
+    # where to put caches (parsed config files, intermediate products...)
+    cache_path: Path = project_path / "cache"
+
     #
     config_path: Path = project_path / "conf"
 
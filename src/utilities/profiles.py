@@ -0,0 +1,91 @@
+from typing import Optional
+
+import functools
+from contextlib import contextmanager
+
+import dask
+
+from utilities.func import check_matching
+
+
+# Named schedulers a pipeline stage can ask for
+EXECUTION_PROFILES = {
+    "threads": "threads",  # NumPy / numba reductions, which release the GIL
+    "synchronous": "synchronous",  # single thread, for debugging and profiling
+    "distributed": None,  # current dask.distributed client
+}
+
+# Config key of a profile forced over those declared by stages
+FORCED_PROFILE_KEY = "execution-profile"
+
+
+def _profile_scheduler(profile: str, client=None):
+    if profile != "distributed":
+        return EXECUTION_PROFILES[profile]
+    if client is not None:
+        return client
+    from dask import distributed  # only needed by this profile
+    try:
+        return distributed.get_client()
+    except ValueError:
+        raise ValueError("No dask client running : start one first (see init_dask_cluster).")
+
+
+@contextmanager
+def execution_profile(profile: str, force: bool = False, client=None, num_workers: Optional[int] = None):
+    """
+        Compute dask collections with given profile (see EXECUTION_PROFILES)
+    inside the context. Only the default scheduler changes : a running cluster
+    is neither restarted nor closed.
+
+    A forced profile wins over the ones declared by stages (see uses_profile) :
+    e.g. force "synchronous" to debug a whole pipeline. Clusters started by
+    init_dask_cluster force "distributed" until they are closed.
+
+    Parameters
+    ----------
+    profile:        str
+                    "threads", "synchronous" or "distributed".
+
+    force:          bool, default: False
+                    Whether nested (non forced) profiles are ignored.
+
+    client:         distributed.Client, optional.
+                    Client of "distributed" profile. Default to current one.
+
+    num_workers:    int, optional.
+                    Number of threads of "threads" profile.
+
+    Yields
+    ------
+    Name of profile actually used.
+    """
+    check_matching(profile, EXECUTION_PROFILES, "execution profile")
+
+    forced = dask.config.get(FORCED_PROFILE_KEY, None)
+    if forced is not None and not force:
+        yield forced
+        return
+
+    settings = {"scheduler": _profile_scheduler(profile, client)}
+    if force:
+        settings[FORCED_PROFILE_KEY] = profile
+    if num_workers is not None and profile == "threads":
+        settings["num_workers"] = num_workers
+    with dask.config.set(settings):
+        yield profile
+
+
+def uses_profile(profile: str, **profile_kwargs):
+    """
+        Decorator declaring the execution profile a pipeline stage needs :
+    the stage computes within execution_profile(profile, **profile_kwargs).
+    """
+    def decorator(fun):
+        @functools.wraps(fun)
+        def staged_fun(*args, **kwargs):
+            with execution_profile(profile, **profile_kwargs):
+                return fun(*args, **kwargs)
+        return staged_fun
+
+    return decorator
@@ -0,0 +1,252 @@
+from typing import Dict, Tuple
+
+import os
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+from utilities.paths import paths
+from utilities.func import check_matching
+from utilities.zones import hash_arrays
+
+WEIGHTS_CACHE_PATH = paths.cache_path / "regridding"
+
+METHODS = ["bilinear", "conservative"]
+
+
+#%% Weights along one axis
+def _ascending(axis: np.ndarray) -> Tuple[np.ndarray, bool]:
+    reverse = bool(axis.size > 1 and axis[0] > axis[-1])
+    return (axis[::-1] if reverse else axis), reverse
+
+
+def linear_matrix(src: np.ndarray, dst: np.ndarray) -> sparse.csr_matrix:
+    """
+        (n_dst, n_src) weights of a linear interpolation along one axis.
+    Rows of points out of src range are empty.
+    """
+    src, reverse = _ascending(np.asarray(src, dtype=float))
+    dst = np.asarray(dst, dtype=float)
+
+    i = np.clip(np.searchsorted(src, dst) - 1, 0, src.size - 2)
+    w = (dst - src[i]) / (src[i + 1] - src[i])
+    rows = np.flatnonzero((dst >= src[0]) & (dst <= src[-1]))
+
+    cols = np.concatenate([i[rows], i[rows] + 1])
+    if reverse:
+        cols = src.size - 1 - cols
+    data = np.concatenate([1 - w[rows], w[rows]])
+    return sparse.csr_matrix((data, (np.tile(rows, 2), cols)), shape=(dst.size, src.size))
+
+
+def cell_edges(centers: np.ndarray) -> np.ndarray:
+    """ Edges of cells of given centers : middles between centers, extrapolated at both ends. """
+    centers = np.asarray(centers, dtype=float)
+    middles = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([[2 * centers[0] - middles[0]], middles, [2 * centers[-1] - middles[-1]]])
+
+
+def overlap_matrix(src_edges: np.ndarray, dst_edges: np.ndarray) -> sparse.csr_matrix:
+    """
+        (n_dst, n_src) fraction of each destination cell covered by each source
+    cell, along one axis. Cells out of source range are partially covered.
+    """
+    src_edges, src_reverse = _ascending(np.asarray(src_edges, dtype=float))
+    dst_edges, dst_reverse = _ascending(np.asarray(dst_edges, dtype=float))
+    n_src, n_dst = src_edges.size - 1, dst_edges.size - 1
+
+    rows, cols, data = [], [], []
+    for k in range(n_dst):
+        a, b = dst_edges[k], dst_edges[k + 1]
+        first = max(np.searchsorted(src_edges, a, "right") - 1, 0)
+        last = min(np.searchsorted(src_edges, b, "left"), n_src)
+        for l in range(first, last):
+            overlap = min(b, src_edges[l + 1]) - max(a, src_edges[l])
+            if overlap > 0:
+                rows.append(k)
+                cols.append(l)
+                data.append(overlap / (b - a))
+
+    rows, cols = np.array(rows, dtype=int), np.array(cols, dtype=int)
+    if dst_reverse:
+        rows = n_dst - 1 - rows
+    if src_reverse:
+        cols = n_src - 1 - cols
+    return sparse.csr_matrix((data, (rows, cols)), shape=(n_dst, n_src))
+
+
+#%% Weights on grids
+def compute_weights(
+        src_lon: np.ndarray,
+        src_lat: np.ndarray,
+        dst_lon: np.ndarray,
+        dst_lat: np.ndarray,
+        method: str = "bilinear",
+) -> sparse.csr_matrix:
+    """
+        (n_dst, n_src) regridding weights between rectilinear grids (1-D lon /
+    lat), for fields flattened in (lat, lon) order. Weights are separable : they
+    are the Kronecker product of weights along latitude and along longitude.
+
+    - "bilinear" : linear interpolation along each axis.
+    - "conservative" : area-weighted average of source cells overlapping each
+      destination cell (overlaps in sin(latitude) along latitude).
+    """
+    check_matching(method, METHODS, "regridding method")
+    if method == "bilinear":
+        w_lat, w_lon = linear_matrix(src_lat, dst_lat), linear_matrix(src_lon, dst_lon)
+    else:
+        def sin_edges(lat):  # cell areas are proportional to differences of sin(latitude)
+            return np.sin(np.deg2rad(np.clip(cell_edges(lat), -90, 90)))
+
+        w_lat = overlap_matrix(sin_edges(src_lat), sin_edges(dst_lat))
+        w_lon = overlap_matrix(cell_edges(src_lon), cell_edges(dst_lon))
+    return sparse.kron(w_lat, w_lon, format="csr")
+
+
+def _save_weights(path, weights: sparse.csr_matrix):
+    """ Write weights to a temporary file first so that a cache file is never half-written. """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npz")
+    sparse.save_npz(tmp_path, weights)
+    os.replace(tmp_path, path)
+
+
+_weights: Dict[str, sparse.csr_matrix] = {}
+
+
+def get_weights(
+        src_lon: np.ndarray,
+        src_lat: np.ndarray,
+        dst_lon: np.ndarray,
+        dst_lat: np.ndarray,
+        method: str = "bilinear",
+        use_cache: bool = True,
+) -> sparse.csr_matrix:
+    """
+        Regridding weights (see compute_weights), computed once per pair of
+    grids and method. Weights are kept in memory and on disk, keyed by hashes of
+    both grids.
+    """
+    grids = [np.asarray(a, dtype=float) for a in (src_lon, src_lat, dst_lon, dst_lat)]
+    key = f"{method}_{hash_arrays(*grids)}"
+    if use_cache and key in _weights:
+        return _weights[key]
+
+    path = WEIGHTS_CACHE_PATH / f"{key}.npz"
+    if use_cache and path.is_file():
+        weights = sparse.load_npz(path).tocsr()
+    else:
+        weights = compute_weights(*grids, method=method)
+        if use_cache:
+            _save_weights(path, weights)
+
+    if use_cache:
+        _weights[key] = weights
+    return weights
+
+
+#%% Regridding
+class Regridder:
+    """
+        Regrid fields from a rectilinear grid to another, with weights computed
+    once per pair of grids (see get_weights). All leading dimensions (time,
+    depth...) of a field are regridded by one sparse matrix product.
+
+    Masked (NaN) source points are left out : weights are normalized by the
+    weight of valid points, and destination points with less than min_coverage
+    of valid weight are masked.
+    """
+
+    def __init__(
+            self,
+            src_lon: xr.DataArray,
+            src_lat: xr.DataArray,
+            dst_lon: xr.DataArray,
+            dst_lat: xr.DataArray,
+            method: str = "bilinear",
+            min_coverage: float = 0.5,
+            use_cache: bool = True,
+    ):
+        """
+
+        Parameters
+        ----------
+        src_lon, src_lat:   xr.DataArray
+                            1-D coordinates of source grid.
+
+        dst_lon, dst_lat:   xr.DataArray
+                            1-D coordinates of destination grid.
+
+        method:             str, default: "bilinear"
+                            "bilinear" or "conservative".
+
+        min_coverage:       float
+                            Minimum fraction of valid weight of a destination point.
+
+        use_cache:          bool, default: True
+                            Whether to read / write weights from / to cache.
+        """
+        self.src_dims = (src_lat.dims[0], src_lon.dims[0])
+        self.dst_dims = (dst_lat.dims[0], dst_lon.dims[0])
+        self.dst_shape = (dst_lat.size, dst_lon.size)
+        self.dst_coords = {self.dst_dims[0]: dst_lat.values, self.dst_dims[1]: dst_lon.values}
+        self.min_coverage = min_coverage
+
+        self.weights = get_weights(
+            src_lon.values, src_lat.values, dst_lon.values, dst_lat.values,
+            method=method, use_cache=use_cache,
+        )
+        # Total weight of each destination point (less than 1 at domain edges)
+        self._full_coverage = np.asarray(self.weights.sum(axis=1)).ravel()
+
+    def regrid_values(self, values: np.ndarray) -> np.ndarray:
+        """ Regrid (..., src_lat, src_lon) values to (..., dst_lat, dst_lon). """
+        lead_shape = values.shape[:-2]
+        flat = values.reshape(-1, values.shape[-2] * values.shape[-1])
+
+        valid = ~np.isnan(flat)
+        out = (self.weights @ np.where(valid, flat, 0).T).T
+
+        # mask is most often the same for all fields (e.g. land) : one product only
+        if valid.all():
+            coverage = self._full_coverage[None]
+        elif (valid == valid[:1]).all():
+            coverage = (self.weights @ valid[0].astype(float))[None]
+        else:
+            coverage = (self.weights @ valid.T.astype(float)).T
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out = np.where(coverage >= self.min_coverage * self._full_coverage, out / coverage, np.nan)
+        out[:, self._full_coverage == 0] = np.nan  # out of source grid
+        return out.reshape(lead_shape + self.dst_shape)
+
+    def _regrid_dataarray(self, var: xr.DataArray) -> xr.DataArray:
+        if var.chunks is not None:
+            var = var.chunk({d: -1 for d in self.src_dims})  # one chunk per horizontal field
+        # temporary names, in case source and destination dims have the same names
+        out_dims = [f"_{d}_regridded" for d in self.dst_dims]
+        out = xr.apply_ufunc(
+            self.regrid_values,
+            var,
+            input_core_dims=[list(self.src_dims)],
+            output_core_dims=[out_dims],
+            dask="parallelized",
+            output_dtypes=[np.result_type(var.dtype, float)],
+            dask_gufunc_kwargs=dict(output_sizes=dict(zip(out_dims, self.dst_shape))),
+        )
+        out = out.rename(dict(zip(out_dims, self.dst_dims)))
+        return out.assign_coords(self.dst_coords)
+
+    def __call__(self, data):
+        """
+            Regrid a DataArray, or all variables of a Dataset on source grid (other
+        variables are kept as they are).
+        """
+        if isinstance(data, xr.DataArray):
+            return self._regrid_dataarray(data)
+
+        on_grid = [v for v in data.data_vars if set(self.src_dims) <= set(data[v].dims)]
+        others = data.drop_vars(on_grid + [d for d in self.src_dims if d in data.variables])
+        return xr.merge([others, *[self._regrid_dataarray(data[v]).rename(v) for v in on_grid]])
@@ -0,0 +1,117 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+import os
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+MAGIC = b"STATICF1"
+ALIGNMENT = 64  # bytes : offsets of header end and of each array are multiples of it
+_LENGTH = struct.Struct("<Q")  # header length, after magic
+
+
+def _aligned(n: int) -> int:
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def write_static_fields(
+        path: Path,
+        fields: Dict[str, Tuple[Iterable[str], np.ndarray]],
+        attrs: Optional[dict] = None,
+):
+    """
+        Write static fields (grid coordinates, bathymetry, masks...) to one binary
+    file : magic, header length, JSON header (name -> dtype, shape, dims, offset,
+    and attrs), then raw C-ordered arrays, each starting at an aligned offset.
+    The file is written to a temporary file first, so that it is never half-written.
+
+    Parameters
+    ----------
+    path:   Path
+            Path to file.
+
+    fields: dict
+            Field name -> (dims, values).
+
+    attrs:  dict, optional.
+            JSON serializable attributes of store (e.g. input signature).
+    """
+    arrays = {name: (list(dims), np.ascontiguousarray(values)) for name, (dims, values) in fields.items()}
+
+    # offsets depend on header length, which depends on offsets : header is
+    # padded to a fixed size large enough for any offset value
+    description = {
+        name: dict(dtype=values.dtype.str, shape=list(values.shape), dims=dims, offset=0)
+        for name, (dims, values) in arrays.items()
+    }
+    header_size = _aligned(
+        len(MAGIC) + _LENGTH.size + len(json.dumps(dict(attrs=attrs or {}, fields=description)))
+        + 32 * len(arrays)
+    )
+    offset = header_size
+    for name, (_, values) in arrays.items():
+        description[name]["offset"] = offset
+        offset = _aligned(offset + values.nbytes)
+
+    header = json.dumps(dict(attrs=attrs or {}, fields=description)).encode()
+    header = header.ljust(header_size - len(MAGIC) - _LENGTH.size, b" ")
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + _LENGTH.pack(len(header)) + header)
+        for name, (_, values) in arrays.items():
+            f.seek(description[name]["offset"])
+            f.write(values.tobytes())
+        f.truncate(offset)
+    os.replace(tmp_path, path)
+
+
+class StaticFields:
+    """
+        Read-only view of a file written by write_static_fields. The file is
+    memory-mapped once : arrays are zero-copy views of the mapping, read lazily
+    from disk and shared by all processes reading the same file (page cache).
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a static fields file.")
+            (length,) = _LENGTH.unpack(f.read(_LENGTH.size))
+            header = json.loads(f.read(length))
+        self.attrs = header["attrs"]
+        self.fields = header["fields"]
+        self._map = np.memmap(self.path, dtype=np.uint8, mode="r")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.fields
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """ Values of field, as a read-only view of the mapped file. """
+        field = self.fields[name]
+        dtype = np.dtype(field["dtype"])
+        size = int(np.prod(field["shape"], dtype=np.int64)) * dtype.itemsize
+        values = self._map[field["offset"]:field["offset"] + size].view(dtype).reshape(field["shape"])
+        return values.view(np.ndarray)
+
+    def names(self):
+        return list(self.fields)
+
+    def dataarray(self, name: str) -> xr.DataArray:
+        """ Field as a DataArray, with stored 1-D fields named as its dimensions as coordinates. """
+        dims = self.fields[name]["dims"]
+        coords = {
+            d: (d, self[d]) for d in dims
+            if d != name and d in self.fields and self.fields[d]["dims"] == [d]
+        }
+        return xr.DataArray(self[name], dims=dims, coords=coords, name=name)
+
+    def items(self) -> Dict[str, Tuple[list, np.ndarray]]:
+        """ Field name -> (dims, values), as taken by write_static_fields. """
+        return {name: (self.fields[name]["dims"], self[name]) for name in self.fields}
@@ -0,0 +1,176 @@
+from typing import Dict, Iterable, Tuple
+
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from matplotlib import path as mpath
+
+from utilities.paths import paths
+from utilities.static_fields import StaticFields, write_static_fields
+
+ZONES_PATH = paths.raw_data_path / "ZONES"
+MASKS_CACHE_PATH = paths.cache_path / "zone_masks"
+
+
+def get_zone_polygon(zone: str) -> np.ndarray:
+    """ Return (n_vertices, 2) array of (longitude, latitude) of given zone. """
+    coord = pd.read_csv(ZONES_PATH / f"{zone}.csv")
+    return coord[["longitude", "latitude"]].values.astype(float)
+
+
+def get_zone_path(zone: str) -> mpath.Path:
+    return mpath.Path(get_zone_polygon(zone))
+
+
+def get_zone_bbox(zone: str) -> Tuple[float, float, float, float]:
+    """ Return (lon_min, lon_max, lat_min, lat_max) of given zone. """
+    polygon = get_zone_polygon(zone)
+    return (
+        polygon[:, 0].min(), polygon[:, 0].max(),
+        polygon[:, 1].min(), polygon[:, 1].max(),
+    )
+
+
+def hash_arrays(*arrays: np.ndarray) -> str:
+    """ Short hash of arrays values, to use in cache keys. """
+    h = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(str((array.dtype, array.shape)).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()[:16]
+
+
+#%%
+def rasterize_polygons(
+        polygons: Dict[str, np.ndarray],
+        lons: np.ndarray,
+        lats: np.ndarray,
+) -> Dict[str, np.ndarray]:
+    """
+        Compute, for each polygon, which grid points are inside it.
+    Grid points are built only once, and each polygon is tested with a single
+    vectorized call, restricted to points inside the polygon bounding box.
+
+    Parameters
+    ----------
+    polygons:   dict
+                Zone name -> (n_vertices, 2) array of (longitude, latitude).
+
+    lons:       np.ndarray
+                1-D longitudes, or 2-D longitudes of a curvilinear grid.
+
+    lats:       np.ndarray
+                1-D latitudes, or 2-D latitudes of a curvilinear grid.
+
+    Returns
+    -------
+    Dict of boolean masks, of shape (lat, lon) for 1-D coordinates and
+    same shape as lons / lats otherwise.
+    """
+    lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+    if lons.ndim == 1 and lats.ndim == 1:
+        lons, lats = np.meshgrid(lons, lats)
+    points = np.column_stack([lons.ravel(), lats.ravel()])
+
+    masks = {}
+    for zone, polygon in polygons.items():
+        lon_min, lat_min = polygon.min(axis=0)
+        lon_max, lat_max = polygon.max(axis=0)
+        in_bbox = (
+            (points[:, 0] >= lon_min) & (points[:, 0] <= lon_max)
+            & (points[:, 1] >= lat_min) & (points[:, 1] <= lat_max)
+        )
+
+        mask = np.zeros(points.shape[0], dtype=bool)
+        mask[in_bbox] = mpath.Path(polygon).contains_points(points[in_bbox])
+        masks[zone] = mask.reshape(lons.shape)
+
+    return masks
+
+
+def _masks_store_path(grid_name: str, grid_hash: str) -> Path:
+    return MASKS_CACHE_PATH / f"{grid_name}_{grid_hash}.bin"
+
+
+def get_zone_masks(
+        zones: Iterable[str],
+        lons: np.ndarray,
+        lats: np.ndarray,
+        grid_name: str = "",
+        use_cache: bool = True,
+) -> Dict[str, np.ndarray]:
+    """
+        Get masks of given zones on given grid, computing only those not
+    already cached. Masks of a grid are cached in one memory-mapped file (see
+    utilities.static_fields), keyed by grid hash, where each mask is keyed by
+    zone name and polygon hash : modifying a zone or using another grid never
+    returns a wrong mask. Cached masks are read-only views of this file.
+
+    Parameters
+    ----------
+    zones:      iterable of str
+                Names of zones, as in ZONES/<zone>.csv.
+
+    lons:       np.ndarray
+                Longitudes of grid.
+
+    lats:       np.ndarray
+                Latitudes of grid.
+
+    grid_name:  str
+                Name of grid, only used to make cache files readable.
+
+    use_cache:  bool, default: True
+                Whether to read / write masks from / to cache.
+
+    Returns
+    -------
+    Dict of boolean masks of shape (lat, lon) (see rasterize_polygons).
+    """
+    lons, lats = np.asarray(lons), np.asarray(lats)
+    store_path = _masks_store_path(grid_name, hash_arrays(lons, lats))
+    store = StaticFields(store_path) if use_cache and store_path.is_file() else None
+
+    masks, to_compute, keys = {}, {}, {}
+    for zone in zones:
+        polygon = get_zone_polygon(zone)
+        keys[zone] = f"{zone}_{hash_arrays(polygon)}"
+        if store is not None and keys[zone] in store:
+            masks[zone] = store[keys[zone]]
+        else:
+            to_compute[zone] = polygon
+
+    if to_compute:
+        computed = rasterize_polygons(to_compute, lons, lats)
+        masks.update(computed)
+        if use_cache:
+            fields = store.items() if store is not None else {}
+            fields.update({keys[zone]: (["lat", "lon"], mask) for zone, mask in computed.items()})
+            write_static_fields(store_path, fields)
+
+    # in requested order, cached and computed masks being mixed above
+    return {zone: masks[zone] for zone in keys}
+
+
+def get_mask_zone(zone: str, lons, lats, grid_name: str = "") -> np.ndarray:
+    """ Mask of one zone, of shape (lon, lat). """
+    return get_zone_masks([zone], lons, lats, grid_name=grid_name)[zone].T
+
+
+def zone_masks_as_dataarray(
+        masks: Dict[str, np.ndarray],
+        lon: xr.DataArray,
+        lat: xr.DataArray,
+        zone_dim: str = "zone",
+) -> xr.DataArray:
+    """ Stack masks computed on 1-D coordinates into a (zone, lat, lon) DataArray. """
+    return xr.DataArray(
+        np.stack(list(masks.values())),
+        dims=(zone_dim, lat.dims[0], lon.dims[0]),
+        coords={zone_dim: list(masks.keys()), lat.dims[0]: lat.values, lon.dims[0]: lon.values},
+    )